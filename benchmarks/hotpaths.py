@@ -0,0 +1,188 @@
+"""
+Times the main operations of the library on synthetic datasets (a folder of small .npy files and a labels CSV file
+per size): prepopulate, extract_feature (a scalar and an array feature), extract_feature_dependent_feature,
+return_features_numpy, return_labels_numpy, dump_feature, copy_features and return_multiple_convert_numpy. Every size
+is run in a separate process, the results (time, throughput and peak RSS per operation, database size) are printed as
+JSON, together with the current commit; with --baseline, the throughput of each operation is compared with the one
+stored in an earlier report (for example, one produced on another commit).
+
+Usage: python benchmarks/hotpaths.py [--sizes N [N ...]] [--length L] [--output FILE] [--baseline FILE]
+"""
+__author__ = 'George Oblapenko'
+__license__ = "GPL"
+__maintainer__ = "George Oblapenko"
+__email__ = "kunstmord@kunstmord.com"
+
+import sys
+import json
+import platform
+import argparse
+import resource
+import subprocess
+from os import makedirs
+from os.path import join, dirname, abspath, getsize
+from tempfile import mkdtemp
+from shutil import rmtree
+from time import time
+import numpy as np
+import sqlalchemy
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'src'))
+from dataset import LabeledDataSet
+
+HISTOGRAM_BINS = 32
+
+
+def load_array(path):
+    """
+    Converter used by the benchmark: reads the array stored in a data point file
+    """
+    return np.load(path)
+
+
+def mean_value(path):
+    """
+    Scalar extractor used by the benchmark
+    """
+    return float(np.load(path).mean())
+
+
+def histogram(path):
+    """
+    Array extractor used by the benchmark
+    """
+    return np.histogram(np.load(path), bins=HISTOGRAM_BINS, range=(0., 1.))[0].astype(np.float64)
+
+
+def centered_histogram(path, features):
+    """
+    Dependent extractor used by the benchmark (uses the stored histogram and mean_value features)
+    """
+    return features['histogram'] - features['mean_value']
+
+
+def make_files(folder, size, length):
+    """
+    Writes size .npy files with random arrays of the given length and a labels CSV file, returns the path to the
+    folder with the files and the path to the labels file
+    """
+    random_state = np.random.RandomState(0)
+    data_folder = join(folder, 'data')
+    makedirs(data_folder)
+    with open(join(folder, 'labels.csv'), 'w') as f:
+        f.write('id,label\n')
+        for a in xrange(size):
+            np.save(join(data_folder, '%07d.npy' % a), random_state.rand(length).astype(np.float32))
+            f.write('%07d,%d\n' % (a, a % 10))
+    return data_folder, join(folder, 'labels.csv')
+
+
+def peak_rss():
+    """
+    Returns the peak resident set size of the process so far, in MB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / 1e6
+    return peak / 1e3
+
+
+def run_size(size, length):
+    """
+    Runs all the timed operations on a dataset with size data points, returns a dictionary of results
+    """
+    folder = mkdtemp()
+    try:
+        data_folder, labels_path = make_files(folder, size, length)
+        data_set = LabeledDataSet(data_folder, folder, labels_path, custom_name='bench.db', file_suffix='.npy')
+        copy_set = LabeledDataSet(data_folder, folder, labels_path, custom_name='copy.db', file_suffix='.npy')
+        dumped = np.random.RandomState(1).rand(size, HISTOGRAM_BINS)
+        operations = [
+            ('prepopulate', data_set.prepopulate),
+            ('extract_feature (scalar)', lambda: data_set.extract_feature(mean_value)),
+            ('extract_feature (array)', lambda: data_set.extract_feature(histogram)),
+            ('extract_feature_dependent_feature', lambda: data_set.extract_feature_dependent_feature(
+                centered_histogram)),
+            ('return_features_numpy', data_set.return_features_numpy),
+            ('return_labels_numpy', data_set.return_labels_numpy),
+            ('dump_feature', lambda: data_set.dump_feature('dumped', dumped)),
+            ('copy_features', lambda: copy_set.copy_features(data_set.dbpath)),
+            ('return_multiple_convert_numpy', lambda: data_set.return_multiple_convert_numpy(1, size, load_array)),
+        ]
+        copy_set.prepopulate()
+        results = {}
+        for name, operation in operations:
+            start = time()
+            operation()
+            elapsed = time() - start
+            results[name] = {'seconds': elapsed, 'rows_per_second': size / elapsed, 'peak_rss_mb': peak_rss()}
+        data_set.close()
+        copy_set.close()
+        return {'size': size, 'length': length, 'operations': results, 'db_size_mb': getsize(data_set.dbpath) / 1e6}
+    finally:
+        rmtree(folder)
+
+
+def git_commit():
+    """
+    Returns the hash of the current commit of the repository (None if it is not available)
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=dirname(abspath(__file__)),
+                                       stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, baseline):
+    """
+    Prints the ratio of the throughput of each operation to its throughput in the baseline report (sizes missing in
+    the baseline are skipped), ratios below 1 mean the operation got slower
+    """
+    baseline_runs = dict((run['size'], run) for run in baseline['runs'])
+    print >> sys.stderr, 'compared with commit %s:' % baseline.get('commit')
+    for run in report['runs']:
+        if run['size'] not in baseline_runs:
+            continue
+        for name in sorted(run['operations']):
+            old = baseline_runs[run['size']]['operations'].get(name)
+            if old is not None:
+                ratio = run['operations'][name]['rows_per_second'] / old['rows_per_second']
+                print >> sys.stderr, '%8d %-36s %6.2fx' % (run['size'], name, ratio)
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='amounts of data points')
+    parser.add_argument('--length', type=int, default=256, help='length of the array stored in each file')
+    parser.add_argument('--output', default=None, help='file the JSON results are written to (default: stdout)')
+    parser.add_argument('--baseline', default=None, help='JSON report to compare the results with')
+    parser.add_argument('--single', type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single is not None:
+        # child process: a single size, so that peak RSS is measured separately for each size
+        json.dump(run_size(args.single, args.length), sys.stdout)
+        return None
+    runs = []
+    for size in args.sizes:
+        output = subprocess.check_output([sys.executable, abspath(__file__), '--single', str(size),
+                                          '--length', str(args.length)])
+        runs.append(json.loads(output))
+    report = {'commit': git_commit(), 'python': platform.python_version(), 'numpy': np.__version__,
+              'sqlalchemy': sqlalchemy.__version__, 'platform': platform.platform(), 'runs': runs}
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            compare(report, json.load(f))
+    return None
+
+
+if __name__ == '__main__':
+    main()
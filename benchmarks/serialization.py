@@ -0,0 +1,114 @@
+"""
+Compares the storage formats of array features: the format used by older versions (a pickled dictionary of features
+per data point) and the per-feature BLOBs written with each available codec (see serialization). For every format, the
+size of the database file and the throughput of reading all values into a 2d array are printed.
+
+Usage: python benchmarks/serialization.py [--rows N] [--length L] [--repeat R]
+"""
+__author__ = 'George Oblapenko'
+__license__ = "GPL"
+__maintainer__ = "George Oblapenko"
+__email__ = "kunstmord@kunstmord.com"
+
+import sys
+import argparse
+import cPickle as pickle
+from os.path import join, dirname, abspath, getsize
+from tempfile import mkdtemp
+from shutil import rmtree
+from time import time
+import numpy as np
+from sqlalchemy import create_engine
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'src'))
+import database
+import featurestore
+import serialization
+
+
+def make_data(rows, length):
+    """
+    Returns the arrays the formats are compared on: dense random floats and sparse integer histograms
+    """
+    random_state = np.random.RandomState(0)
+    histograms = np.zeros([rows, length], dtype=np.int32)
+    histograms[:, :length // 8] = random_state.randint(0, 50, size=[rows, length // 8])
+    return [('dense float64', random_state.rand(rows, length)), ('sparse int32 histogram', histograms)]
+
+
+def bench_pickle(path, name, values, repeat):
+    """
+    Stores the values the way older versions did (one pickled dictionary of features per data point) and reads them
+    back, returns the file size and the best read time
+    """
+    engine = create_engine('sqlite:////' + path)
+    engine.execute('CREATE TABLE "test set" (id INTEGER PRIMARY KEY, features BLOB)')
+    connection = engine.raw_connection()
+    connection.executemany('INSERT INTO "test set" (id, features) VALUES (?, ?)',
+                           ((a + 1, buffer(pickle.dumps({name: value}, pickle.HIGHEST_PROTOCOL)))
+                            for a, value in enumerate(values)))
+    connection.commit()
+    best = None
+    for r in xrange(repeat):
+        start = time()
+        result = np.array([pickle.loads(bytes(row[0]))[name] for row in
+                           connection.execute('SELECT features FROM "test set" ORDER BY id')])
+        elapsed = time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    assert np.array_equal(result, values)
+    connection.close()
+    engine.dispose()
+    return getsize(path), best
+
+
+def bench_codec(path, name, values, codec, repeat):
+    """
+    Stores the values as a feature with the given codec and reads them back with featurestore.read_numpy, returns
+    the file size and the best read time
+    """
+    database.configure(path, {})
+    engine = database.get_engine(path)
+    featurestore.Base.metadata.create_all(engine)
+    session = database.get_session(path)
+    info = featurestore.create_feature_for_value(session, name, values[0], codec)
+    featurestore.write_columns(session, info, range(1, len(values) + 1), featurestore.encode_many(info, values))
+    session.commit()
+    best = None
+    for r in xrange(repeat):
+        start = time()
+        result = featurestore.read_numpy(session, info)[1]
+        elapsed = time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    assert np.array_equal(result, values)
+    session.close()
+    database.dispose(path)
+    return getsize(path), best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=20000, help='amount of data points')
+    parser.add_argument('--length', type=int, default=256, help='length of the feature arrays')
+    parser.add_argument('--repeat', type=int, default=3, help='amount of reads (the best one is reported)')
+    args = parser.parse_args()
+
+    folder = mkdtemp()
+    try:
+        print '%-24s %-10s %12s %12s %12s' % ('data', 'format', 'file (MB)', 'read (MB/s)', 'read (rows/s)')
+        for data_name, values in make_data(args.rows, args.length):
+            results = [('pickle', bench_pickle(join(folder, data_name + '-pickle.db'), 'feature', values,
+                                               args.repeat))]
+            for codec in serialization.available_codecs():
+                results.append((codec, bench_codec(join(folder, data_name + '-' + codec + '.db'), 'feature', values,
+                                                   codec, args.repeat)))
+            for format_name, (size, elapsed) in results:
+                print '%-24s %-10s %12.2f %12.1f %12.0f' % (data_name, format_name, size / 1e6,
+                                                            values.nbytes / 1e6 / elapsed, len(values) / elapsed)
+    finally:
+        rmtree(folder)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,7 @@
 from distutils.core import setup
 
 setup(name='mldatalib',
-      version='0.2.1',
+      version='0.3',
       description='Library for data analysis - extracting, storing and retrieving features',
       author='George Oblapenko',
       author_email='kunstmord@kunstmord.com',
@@ -0,0 +1,112 @@
+"""
+Provides the SQLite engines used by the library, configured with a set of PRAGMA statements (by default: WAL journal,
+synchronous=NORMAL, a bigger page cache and memory-mapped I/O), so that long extractions write faster and the database
+can be read while a write is in progress. One engine (with a pool of open connections) is kept per database and
+process, so repeated calls don't pay for creating an engine and opening the file.
+"""
+__author__ = 'George Oblapenko'
+__license__ = "GPL"
+__maintainer__ = "George Oblapenko"
+__email__ = "kunstmord@kunstmord.com"
+
+from os import getpid
+from functools import partial
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+DEFAULT_PRAGMAS = {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'cache_size': -65536, 'mmap_size': 268435456}
+
+_pragmas = {}
+_engines = {}
+
+
+def configure(dbpath, pragmas=None):
+    """
+    Sets the PRAGMA statements which are executed on every new connection to a database
+
+    Parameters
+    ----------
+    dbpath : string, path to SQLite database file
+    pragmas : dict mapping pragma names to values (for example, {'synchronous': 'FULL'}), if None, DEFAULT_PRAGMAS
+    are used, if empty, SQLite defaults are used. default value: None
+
+    Returns
+    -------
+    None
+    """
+    if _pragmas.get(dbpath) != pragmas:
+        dispose(dbpath)
+    if pragmas is None:
+        _pragmas.pop(dbpath, None)
+    else:
+        _pragmas[dbpath] = pragmas
+    return None
+
+
+def _apply_pragmas(pragmas, dbapi_connection, connection_record):
+    """
+    Executes PRAGMA statements on a new DB-API connection (used as a 'connect' event listener)
+    """
+    cursor = dbapi_connection.cursor()
+    for name in pragmas:
+        cursor.execute('PRAGMA ' + name + ' = ' + str(pragmas[name]))
+    cursor.close()
+
+
+def get_engine(dbpath):
+    """
+    Returns the SQLAlchemy engine of an SQLite database, its connections are configured with the pragmas set for the
+    database (see configure). The engine is created on the first call and reused afterwards (engines are not shared
+    between processes, a forked process creates its own).
+
+    Parameters
+    ----------
+    dbpath : string, path to SQLite database file
+
+    Returns
+    -------
+    engine : SQLAlchemy engine
+    """
+    key = (dbpath, getpid())
+    if key not in _engines:
+        engine = create_engine('sqlite:////' + dbpath, poolclass=QueuePool,
+                               connect_args={'check_same_thread': False})
+        event.listen(engine, 'connect', partial(_apply_pragmas, _pragmas.get(dbpath, DEFAULT_PRAGMAS)))
+        _engines[key] = (engine, sessionmaker(bind=engine))
+    return _engines[key][0]
+
+
+def get_session(dbpath):
+    """
+    Returns a new SQLAlchemy session bound to the engine of an SQLite database (see get_engine)
+
+    Parameters
+    ----------
+    dbpath : string, path to SQLite database file
+
+    Returns
+    -------
+    session : SQLAlchemy session
+    """
+    get_engine(dbpath)
+    return _engines[(dbpath, getpid())][1]()
+
+
+def dispose(dbpath):
+    """
+    Closes the connections of the engine of a database (if there is one) and forgets it, the next get_engine call will
+    create a new engine
+
+    Parameters
+    ----------
+    dbpath : string, path to SQLite database file
+
+    Returns
+    -------
+    None
+    """
+    engine = _engines.pop((dbpath, getpid()), (None, None))[0]
+    if engine is not None:
+        engine.dispose()
+    return None
@@ -3,19 +3,279 @@ __license__ = "GPL"
 __maintainer__ = "George Oblapenko"
 __email__ = "kunstmord@kunstmord.com"
 
-from os.path import join, isfile
-from os import walk
-from sqlalchemy import create_engine
+from os.path import join, basename, isfile, isdir, islink
+from os import listdir, makedirs, remove, rename, getpid, stat
+from shutil import rmtree
+from hashlib import sha1
+from itertools import imap, izip, islice
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+from collections import deque
+from time import time
+from zlib import crc32
+from sqlalchemy import func, select
 from sqlalchemy.orm import sessionmaker
 import numpy as np
 import trainset
 import testset
 import errors
+import database
+import featurestore
+import labelstore
+import scheduler
+import instrumentation
+import featurematrix
 from misc import cutoff_filename
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+def _extraction_worker(task):
+    """
+    Calls an extractor (or a converter) on a single data point (module-level, so that it can be sent to worker
+    processes)
+
+    Parameters
+    ----------
+    task : tuple, the extractor function followed by the arguments it should be called with
+
+    Returns
+    -------
+    The value returned by the extractor
+    """
+    return task[0](*task[1:])
+
+
+def _timed_call(function, *args):
+    """
+    Calls a function and returns the time the call took (in seconds) and the value it returned (module-level, so that
+    it can be sent to worker processes: a task (function, args...) becomes (_timed_call, function, args...))
+    """
+    start = time()
+    value = function(*args)
+    return time() - start, value
+
+
+def _record_latencies(results, metrics, name, stage='extractor'):
+    """
+    Yields the values of an iterable of (seconds, value) results (see _timed_call), adding the times to the latency
+    histogram of name in metrics
+    """
+    for seconds, value in results:
+        metrics.record_latency(name, seconds, stage)
+        yield value
+
+
+def _open_pool(n_jobs, pool, backend='process'):
+    """
+    Returns the pool which should be used for extraction (or conversion) and a flag telling whether it was created here
+    (and thus should be closed by the caller)
+
+    Parameters
+    ----------
+    n_jobs : int, number of workers, if equal to 1, no pool is created, if equal to -1, one worker per CPU is used
+    pool : object with imap(function, iterable, chunksize) and apply_async(function, args) methods (a
+    multiprocessing.Pool, for example) or None, if not None, n_jobs is ignored
+    backend : string, 'process' to create a pool of processes, 'thread' to create a pool of threads.
+    default value: 'process'
+
+    Returns
+    -------
+    pool : pool object or None
+    owned : boolean, True if the pool was created by this function
+    """
+    if pool is not None:
+        return pool, False
+    if n_jobs == 1:
+        return None, False
+    if n_jobs == -1:
+        n_jobs = cpu_count()
+    if backend == 'thread':
+        return ThreadPool(n_jobs), True
+    return Pool(n_jobs), True
+
+
+def _imap_extractor(pool, tasks, chunksize):
+    """
+    Lazily calls the extractors for an iterable of tasks (see _extraction_worker), either serially or in a pool;
+    results are returned in the same order as the tasks
+    """
+    if pool is None:
+        return imap(_extraction_worker, tasks)
+    return pool.imap(_extraction_worker, tasks, chunksize)
+
+
+def _imap_bounded(pool, tasks, prefetch):
+    """
+    Lazily calls the functions of an iterable of tasks (see _extraction_worker), either serially or in a pool, keeping
+    at most prefetch tasks submitted ahead of the consumer (so that memory use stays bounded); results are returned in
+    the same order as the tasks
+    """
+    if pool is None:
+        for task in tasks:
+            yield _extraction_worker(task)
+        return
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(_extraction_worker, (task,)))
+        if len(pending) >= prefetch:
+            yield pending.popleft().get()
+    while len(pending) > 0:
+        yield pending.popleft().get()
+
+
+def _merge_cached(keys, cached, results, new_cached):
+    """
+    Yields the cached value for each key which is in the cache and the next extracted value for the other keys (the
+    extracted values are also added to new_cached, so that they can be stored in the cache later)
+
+    Parameters
+    ----------
+    keys : list of strings, cache keys of the data points
+    cached : dict mapping keys to cached values
+    results : iterator over the values extracted for the data points which are not in the cache
+    new_cached : dict to which the extracted values are added
+
+    Returns
+    -------
+    A generator of feature values, one per key
+    """
+    for key in keys:
+        if key in cached:
+            yield cached[key]
+        else:
+            feature_val = next(results)
+            new_cached[key] = feature_val
+            yield feature_val
+
+
+def _extract_rows(session, set_object, folder_path, extractor, extractor_name, info, dependent, verbose, add_args,
+                  n_jobs, pool, chunksize, batch_size, cache=None, codec=None, metrics=None):
+    """
+    Runs an extractor over the data points which have no value of the feature yet (except the ones flagged as deleted,
+    see sync_base) and writes the results to the database; the extractor calls may be distributed over a process
+    pool, while all database writes are done by the calling process, a batch at a time (every commit is a checkpoint,
+    so an interrupted extraction can be resumed without redoing the committed data points)
+
+    Parameters
+    ----------
+    session : SQLAlchemy session
+    set_object : object (either TestSet or TrainSet) which is stored in the database
+    folder_path : string, path to folder where the files are stored
+    extractor : function
+    extractor_name : string, name under which the feature is stored
+    info : FeatureInfo object of the feature or None if the feature doesn't exist yet (it will be created when the
+    first value is extracted)
+    dependent : boolean, if True, the extractor also receives the dictionary of the data point's features
+    verbose : int, see extract_feature_base
+    add_args : optional arguments for the extractor, see extract_feature_base
+    n_jobs : int, number of worker processes, see _open_pool
+    pool : pool object or None, see _open_pool
+    chunksize : int, amount of data points sent to a worker process at once
+    batch_size : int, amount of data points after which the results are committed to the database
+    cache : ExtractionCache object or None, if not None, values are taken from the cache when possible and the
+    extracted values are stored in it (only for extractors which don't depend on other features). default value: None
+    codec : string or None, codec of the feature if it is created here (see featurestore.create_feature).
+    default value: None
+    metrics : Metrics object or None, if not None, the time spent reading from the database ('db read'), in the
+    extractor ('extractor', with a latency histogram), encoding values ('serialization'), writing and committing them
+    ('commit') and in the cache ('cache') is added to it, as well as the progress of the extraction.
+    default value: None
+
+    Returns
+    -------
+    None
+    """
+    timer = instrumentation.maybe_timer
+    with timer(metrics, 'db read'):
+        rows, tasks = _extraction_tasks(session, set_object, folder_path, extractor, info, dependent, add_args)
+    if metrics is not None:
+        metrics.set_total(len(rows))
+
+    keys = None
+    if cache is not None:
+        with timer(metrics, 'cache'):
+            keys = [cache.key(task[1], extractor, add_args) for task in tasks]
+            cached = cache.get_many(keys)
+        new_cached = {}
+        tasks = [task for task, key in izip(tasks, keys) if key not in cached]
+    if metrics is not None:
+        tasks = [(_timed_call,) + task for task in tasks]
+
+    new_values = []
+    pool, owned = _open_pool(n_jobs, pool)
+    try:
+        results = _imap_extractor(pool, tasks, chunksize)
+        if metrics is not None:
+            results = _record_latencies(results, metrics, extractor_name)
+        if keys is not None:
+            results = _merge_cached(keys, cached, results, new_cached)
+        for a, ((row_id, row_path), feature_val) in enumerate(izip(rows, results)):
+            with timer(metrics, 'serialization'):
+                if info is None:
+                    info = featurestore.create_feature_for_value(session, extractor_name, feature_val, codec)
+                new_values.append({'id': row_id, 'value': featurestore.encode_value(info, feature_val)})
+            if metrics is not None:
+                metrics.advance()
+            if verbose > 0:
+                if a % verbose == 0:
+                    print a
+            if len(new_values) == batch_size:
+                with timer(metrics, 'commit'):
+                    featurestore.write_values(session, info, new_values)
+                    session.commit()
+                new_values = []
+                if keys is not None:
+                    with timer(metrics, 'cache'):
+                        cache.put_many(new_cached)
+                    new_cached.clear()
+    finally:
+        if owned is True:
+            pool.close()
+            pool.join()
+    with timer(metrics, 'commit'):
+        if info is not None:
+            featurestore.write_values(session, info, new_values)
+        session.commit()
+    if keys is not None:
+        with timer(metrics, 'cache'):
+            cache.put_many(new_cached)
+    return None
+
+
+def _extraction_tasks(session, set_object, folder_path, extractor, info, dependent, add_args):
+    """
+    Returns the (id, path) rows of the data points which have no value of the feature yet (see _extract_rows) and the
+    extraction tasks for them (see _extraction_worker)
+    """
+    query = session.query(set_object.id, set_object.path).filter(set_object.deleted.isnot(True))
+    if info is not None:
+        query = query.filter(~set_object.id.in_(select([featurestore.value_table(info).c.id])))
+    rows = query.order_by(set_object.id).all()
+    if dependent is True:
+        # extractors which declare their inputs (see scheduler.requires) only get these features
+        stored = [(stored_info.name, featurestore.read_values(session, stored_info))
+                  for stored_info in featurestore.feature_infos(session, getattr(extractor, 'requires', 'all'))]
+    tasks = []
+    for row_id, row_path in rows:
+        task = [extractor, join(folder_path, row_path)]
+        if dependent is True:
+            task.append(dict((name, values[row_id]) for name, values in stored if row_id in values))
+        if add_args is not None:
+            task.append(add_args)
+        tasks.append(tuple(task))
+    return rows, tasks
+
 
 def extract_feature_base(dbpath, folder_path, set_object, extractor, force_extraction=False, verbose=0,
-                         add_args=None, custom_name=None):
+                         add_args=None, custom_name=None, n_jobs=1, pool=None, chunksize=16, batch_size=1000,
+                         cache=None, codec=None, metrics=None):
     """
     Generic function which extracts a feature and stores it in the database
 
@@ -25,15 +285,29 @@ def extract_feature_base(dbpath, folder_path, set_object, extractor, force_extra
     folder_path : string, path to folder where the files are stored
     set_object : object (either TestSet or TrainSet) which is stored in the database
     extractor : function, which takes the path of a data point and *args as parameters and returns a feature
-    force_extraction : boolean, if True - will re-extract feature even if a feature with this name already
-    exists in the database, otherwise, will only extract if the feature doesn't exist in the database.
-    default value: False
+    force_extraction : boolean, if True - will re-extract feature for all data points even if a feature with this name
+    already exists in the database, otherwise, will only extract it for the data points which don't have a value of
+    this feature in the database (for example, data points added after the last extraction or not reached by an
+    interrupted extraction). default value: False
     verbose : int, if bigger than 0, will print the current number of the file for which data is being extracted
     ever verbose steps (for example, verbose=500 will print 0, 500, 1000 etc.). default value: 0
     add_args : optional arguments for the extractor (list/dictionary/tuple/whatever). if None, the
     extractor should take only one input argument - the file path. default value: None
     custom_name : string, optional name for the feature (it will be stored in the database with the custom_name
     instead of extractor function name). if None, the extractor function name will be used. default value: None
+    n_jobs : int, number of worker processes used to run the extractor, if equal to -1, one process per CPU is used.
+    The extractor (and add_args) must be picklable, i.e. defined at the top level of a module. default value: 1
+    pool : object with an imap(function, iterable, chunksize) method (for example, a multiprocessing.Pool) used to
+    run the extractor, if not None, n_jobs is ignored and the pool is not closed afterwards. default value: None
+    chunksize : int, amount of data points sent to a worker process at once. default value: 16
+    batch_size : int, amount of data points after which the extracted values are committed to the database (if the
+    extraction is interrupted, the committed values are kept). default value: 1000
+    cache : ExtractionCache object, if not None, the extractor is only called for files for which the cache has no
+    value yet (see extractcache.ExtractionCache) and the extracted values are added to the cache. default value: None
+    codec : string, name of the codec applied to the stored values when the feature is created, for array and object
+    features (see serialization, for example 'zlib'), if None, the values are stored uncompressed. default value: None
+    metrics : Metrics object, if not None, it is reset and collects the timings and the progress of the extraction (see
+    instrumentation.Metrics). default value: None
 
     Returns
     -------
@@ -43,39 +317,26 @@ def extract_feature_base(dbpath, folder_path, set_object, extractor, force_extra
         extractor_name = extractor.__name__
     else:
         extractor_name = custom_name
-    engine = create_engine('sqlite:////' + dbpath)
-    session_cl = sessionmaker(bind=engine)
-    session = session_cl()
-    a = 0
-
-    tmp_object = session.query(set_object).get(1)
-    if tmp_object.features is None:
-        for i in session.query(set_object).order_by(set_object.id):
-            if add_args is None:
-                i.features = {extractor_name: extractor(join(folder_path, i.path))}
-            else:
-                i.features = {extractor_name: extractor(join(folder_path, i.path), add_args)}
-            if verbose > 0:
-                if a % verbose == 0:
-                    print a
-            a += 1
-    elif (extractor_name not in tmp_object.features) or force_extraction is True:
-        for i in session.query(set_object).order_by(set_object.id):
-            if add_args is None:
-                i.features[extractor_name] = extractor(join(folder_path, i.path))
-            else:
-                i.features[extractor_name] = extractor(join(folder_path, i.path), add_args)
-            if verbose > 0:
-                if a % verbose == 0:
-                    print a
-            a += 1
-    session.commit()
+    if metrics is not None:
+        metrics.start(extractor_name)
+    session = database.get_session(dbpath)
+
+    info = featurestore.feature_info(session, extractor_name)
+    if info is not None and force_extraction is True:
+        featurestore.drop_feature(session, info)
+        session.commit()
+        info = None
+    _extract_rows(session, set_object, folder_path, extractor, extractor_name, info, False, verbose, add_args, n_jobs,
+                  pool, chunksize, batch_size, cache, codec, metrics)
     session.close()
+    if metrics is not None:
+        metrics.finish()
     return None
 
 
 def extract_feature_dependent_feature_base(dbpath, folder_path, set_object, extractor, force_extraction=False,
-                                           verbose=0, add_args=None, custom_name=None):
+                                           verbose=0, add_args=None, custom_name=None, n_jobs=1, pool=None,
+                                           chunksize=16, batch_size=1000, codec=None, metrics=None):
     """
     Generic function which extracts a feature which may be dependent on other features and stores it in the database
 
@@ -86,15 +347,27 @@ def extract_feature_dependent_feature_base(dbpath, folder_path, set_object, extr
     set_object : object (either TestSet or TrainSet) which is stored in the database
     extractor : function, which takes the path of a data point, a dictionary of all other features and *args as
     parameters and returns a feature
-    force_extraction : boolean, if True - will re-extract feature even if a feature with this name already
-    exists in the database, otherwise, will only extract if the feature doesn't exist in the database.
-    default value: False
+    force_extraction : boolean, if True - will re-extract feature for all data points even if a feature with this name
+    already exists in the database, otherwise, will only extract it for the data points which don't have a value of
+    this feature in the database (for example, data points added after the last extraction or not reached by an
+    interrupted extraction). default value: False
     verbose : int, if bigger than 0, will print the current number of the file for which data is being extracted
     ever verbose steps (for example, verbose=500 will print 0, 500, 1000 etc.). default value: 0
     add_args : optional arguments for the extractor (list/dictionary/tuple/whatever). if None, the
     extractor should take only two input arguments - the file path and a dictionary of features. default value: None
     custom_name : string, optional name for the feature (it will be stored in the database with the custom_name
     instead of extractor function name). if None, the extractor function name will be used. default value: None
+    n_jobs : int, number of worker processes used to run the extractor, if equal to -1, one process per CPU is used.
+    The extractor (and add_args) must be picklable, i.e. defined at the top level of a module. default value: 1
+    pool : object with an imap(function, iterable, chunksize) method (for example, a multiprocessing.Pool) used to
+    run the extractor, if not None, n_jobs is ignored and the pool is not closed afterwards. default value: None
+    chunksize : int, amount of data points sent to a worker process at once. default value: 16
+    batch_size : int, amount of data points after which the extracted values are committed to the database (if the
+    extraction is interrupted, the committed values are kept). default value: 1000
+    codec : string, name of the codec applied to the stored values when the feature is created, for array and object
+    features (see serialization, for example 'zlib'), if None, the values are stored uncompressed. default value: None
+    metrics : Metrics object, if not None, it is reset and collects the timings and the progress of the extraction (see
+    instrumentation.Metrics). default value: None
 
     Returns
     -------
@@ -104,34 +377,261 @@ def extract_feature_dependent_feature_base(dbpath, folder_path, set_object, extr
         extractor_name = extractor.__name__
     else:
         extractor_name = custom_name
-    engine = create_engine('sqlite:////' + dbpath)
-    session_cl = sessionmaker(bind=engine)
-    session = session_cl()
-    a = 0
-
-    tmp_object = session.query(set_object).get(1)
-    if tmp_object.features is None:
-        for i in session.query(set_object).order_by(set_object.id):
-            if add_args is None:
-                i.features = {extractor_name: extractor(join(folder_path, i.path), None)}
+    if metrics is not None:
+        metrics.start(extractor_name)
+    session = database.get_session(dbpath)
+
+    info = featurestore.feature_info(session, extractor_name)
+    if info is not None and force_extraction is True:
+        featurestore.drop_feature(session, info)
+        session.commit()
+        info = None
+    _extract_rows(session, set_object, folder_path, extractor, extractor_name, info, True, verbose, add_args, n_jobs,
+                  pool, chunksize, batch_size, None, codec, metrics)
+    session.close()
+    if metrics is not None:
+        metrics.finish()
+    return None
+
+
+def extract_features_base(dbpath, folder_path, set_object, extractors, force_extraction=False, verbose=0,
+                          add_args=None, n_jobs=1, pool=None, chunksize=16, batch_size=1000, codec=None, loader=None,
+                          metrics=None):
+    """
+    Generic function which extracts several features in a single pass over the data points: the extractors are
+    ordered by their dependencies (see scheduler.requires), all the missing features of a data point are computed by
+    one task (which may be sent to a worker process, and in which the file is decoded at most once, by the loader) and
+    only the stored features which are needed as inputs are read; the values of a batch of data points are written in
+    one transaction
+
+    Parameters
+    ----------
+    dbpath : string, path to SQLite database file
+    folder_path : string, path to folder where the files are stored
+    set_object : object (either TestSet or TrainSet) which is stored in the database
+    extractors : list of extractor functions or of (name, extractor) tuples, an extractor decorated with
+    scheduler.requires(names) takes the path of a data point, a dictionary of the features it requires and *args as
+    parameters, any other extractor takes the path of a data point and *args
+    force_extraction : boolean, if True - will re-extract the features for all data points, otherwise, will only
+    extract the features which are missing for each data point. default value: False
+    verbose : int, if bigger than 0, will print the current number of the data point for which data is being extracted
+    ever verbose steps. default value: 0
+    add_args : optional arguments for all the extractors (list/dictionary/tuple/whatever). default value: None
+    n_jobs : int, number of worker processes, if equal to -1, one process per CPU is used. The extractors (and
+    add_args) must be picklable, i.e. defined at the top level of a module. default value: 1
+    pool : object with an imap(function, iterable, chunksize) method (for example, a multiprocessing.Pool) used to
+    run the extractors, if not None, n_jobs is ignored and the pool is not closed afterwards. default value: None
+    chunksize : int, amount of data points sent to a worker process at once. default value: 16
+    batch_size : int, amount of data points after which the extracted values are committed to the database.
+    default value: 1000
+    codec : string, name of the codec of the features created here, see extract_feature_base. default value: None
+    loader : function, if not None, it is called once per data point with the path of its file and its result (for
+    example, a decoded image) is passed to the extractors instead of the path (it must be picklable if n_jobs is not
+    1). default value: None
+    metrics : Metrics object, if not None, it is reset and collects the timings and the progress of the extraction
+    (the loader is timed as 'file io', each extractor gets a latency histogram, see instrumentation.Metrics).
+    default value: None
+
+    Returns
+    -------
+    stages : list of lists of feature names, the order in which the features are computed (see scheduler.build_plan)
+    """
+    timer = instrumentation.maybe_timer
+    if metrics is not None:
+        metrics.start('extract_features')
+    session = database.get_session(dbpath)
+    stored_infos = dict((info.name, info) for info in featurestore.feature_infos(session))
+    plan, stages = scheduler.build_plan(extractors, stored_infos)
+    names = [step[0] for step in plan]
+    if force_extraction is True:
+        for name in names:
+            if name in stored_infos:
+                featurestore.drop_feature(session, stored_infos.pop(name))
+        session.commit()
+    infos = dict((name, stored_infos.get(name)) for name in names)
+    with timer(metrics, 'db read'):
+        done = {}
+        for name in names:
+            if infos[name] is not None:
+                table = featurestore.value_table(infos[name])
+                done[name] = set(row_id for (row_id,) in session.execute(select([table.c.id])))
             else:
-                i.features = {extractor_name: extractor(join(folder_path, i.path), None, add_args)}
-            if verbose > 0:
-                if a % verbose == 0:
-                    print a
-            a += 1
-    elif (extractor_name not in tmp_object.features) or force_extraction is True:
-        for i in session.query(set_object).order_by(set_object.id):
+                done[name] = set()
+        rows = []
+        for row_id, row_path in session.query(set_object.id, set_object.path)\
+                .filter(set_object.deleted.isnot(True)).order_by(set_object.id):
+            missing = frozenset(name for name in names if row_id not in done[name])
+            if len(missing) > 0:
+                rows.append((row_id, row_path, missing))
+        done = None
+    inputs = [name for name in scheduler.input_names(plan) if name in stored_infos]
+    if metrics is not None:
+        metrics.set_total(len(rows))
+        run_row = scheduler.run_row_timed
+    else:
+        run_row = scheduler.run_row
+
+    pool, owned = _open_pool(n_jobs, pool)
+    try:
+        for start in xrange(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            ids = [row[0] for row in batch]
+            with timer(metrics, 'db read'):
+                stored = [(name, featurestore.read_values(session, stored_infos[name], ids)) for name in inputs]
+            tasks = [(run_row, plan, join(folder_path, row_path),
+                      dict((name, values[row_id]) for name, values in stored if row_id in values), missing, add_args,
+                      loader)
+                     for row_id, row_path, missing in batch]
+            new_values = dict((name, []) for name in names)
+            results = _imap_extractor(pool, tasks, chunksize)
+            for a, ((row_id, row_path, missing), row_values) in enumerate(izip(batch, results)):
+                if metrics is not None:
+                    row_values, timings = row_values
+                    for name, stage, seconds in timings:
+                        metrics.record_latency(name, seconds, stage)
+                with timer(metrics, 'serialization'):
+                    for name in names:
+                        if name not in row_values:
+                            continue
+                        feature_val = row_values[name]
+                        if infos[name] is None:
+                            infos[name] = featurestore.create_feature_for_value(session, name, feature_val, codec)
+                        new_values[name].append({'id': row_id, 'value': featurestore.encode_value(infos[name],
+                                                                                                  feature_val)})
+                if metrics is not None:
+                    metrics.advance()
+                if verbose > 0:
+                    if (start + a) % verbose == 0:
+                        print start + a
+            with timer(metrics, 'commit'):
+                for name in names:
+                    if infos[name] is not None:
+                        featurestore.write_values(session, infos[name], new_values[name])
+                session.commit()
+    finally:
+        if owned is True:
+            pool.close()
+            pool.join()
+        session.close()
+    if metrics is not None:
+        metrics.finish()
+    return stages
+
+
+def extract_feature_batched_base(dbpath, folder_path, set_object, extractor, loader, force_extraction=False,
+                                 verbose=0, add_args=None, custom_name=None, batch_size=256, n_jobs=1, pool=None,
+                                 backend='thread', prefetch=None, codec=None, metrics=None):
+    """
+    Generic function which extracts a feature with a batch extractor: the files of batch_size data points are loaded
+    into a preallocated stacked array (the next files are loaded in the background while the extractor runs) and the
+    extractor is called once per batch, the rows of its result are written to the database as the values of the data
+    points (in one transaction per batch)
+
+    Parameters
+    ----------
+    dbpath : string, path to SQLite database file
+    folder_path : string, path to folder where the files are stored
+    set_object : object (either TestSet or TrainSet) which is stored in the database
+    extractor : function, which takes an (N, ...) array (the loaded files of N data points, stacked) and *args as
+    parameters and returns an array (or a list) of N values. The stacked array is reused for the next batch, so the
+    extractor should not keep references to it
+    loader : function, which takes the path of a data point and returns a numpy array, all arrays should have the same
+    shape and dtype
+    force_extraction : boolean, if True - will re-extract feature for all data points, otherwise, will only extract it
+    for the data points which don't have a value of this feature in the database. default value: False
+    verbose : int, if bigger than 0, will print the amount of processed data points after each batch.
+    default value: 0
+    add_args : optional arguments for the extractor (list/dictionary/tuple/whatever). if None, the
+    extractor should take only one input argument - the stacked array. default value: None
+    custom_name : string, optional name for the feature, if None, the extractor function name will be used.
+    default value: None
+    batch_size : int, amount of data points passed to the extractor at once. default value: 256
+    n_jobs : int, number of workers running the loader, if equal to -1, one worker per CPU is used. default value: 1
+    pool : pool object (see _open_pool) used to run the loader, if not None, n_jobs and backend are ignored.
+    default value: None
+    backend : string, 'thread' or 'process', the kind of pool created when n_jobs is not 1 (with 'process', the
+    loader must be picklable). default value: 'thread'
+    prefetch : int, maximal amount of files being loaded ahead of the one copied into the stacked array, if None,
+    batch_size is used. default value: None
+    codec : string, name of the codec of the feature if it is created here, see extract_feature_base.
+    default value: None
+    metrics : Metrics object, if not None, it is reset and collects the timings and the progress of the extraction
+    (loader calls are timed as 'file io', extractor calls, one per batch, as 'extractor', see
+    instrumentation.Metrics). default value: None
+
+    Returns
+    -------
+    None
+    """
+    if custom_name is None:
+        extractor_name = extractor.__name__
+    else:
+        extractor_name = custom_name
+    if prefetch is None:
+        prefetch = batch_size
+    timer = instrumentation.maybe_timer
+    if metrics is not None:
+        metrics.start(extractor_name)
+    session = database.get_session(dbpath)
+    info = featurestore.feature_info(session, extractor_name)
+    if info is not None and force_extraction is True:
+        featurestore.drop_feature(session, info)
+        session.commit()
+        info = None
+    with timer(metrics, 'db read'):
+        query = session.query(set_object.id, set_object.path).filter(set_object.deleted.isnot(True))
+        if info is not None:
+            query = query.filter(~set_object.id.in_(select([featurestore.value_table(info).c.id])))
+        rows = query.order_by(set_object.id).all()
+    if metrics is not None:
+        metrics.set_total(len(rows))
+
+    stacked = None
+    pool, owned = _open_pool(n_jobs, pool, backend)
+    try:
+        if metrics is None:
+            loaded = _imap_bounded(pool, ((loader, join(folder_path, row_path)) for row_id, row_path in rows),
+                                   prefetch)
+        else:
+            loaded = _record_latencies(_imap_bounded(pool, ((_timed_call, loader, join(folder_path, row_path))
+                                                            for row_id, row_path in rows), prefetch),
+                                       metrics, getattr(loader, '__name__', 'loader'), 'file io')
+        for start in xrange(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            for a, value in enumerate(islice(loaded, len(batch))):
+                value = np.asarray(value)
+                if stacked is None:
+                    stacked = np.empty((batch_size,) + value.shape, dtype=value.dtype)
+                if value.shape != stacked.shape[1:]:
+                    raise errors.WrongSize(batch[a][1])
+                stacked[a] = value
+            extractor_start = time()
             if add_args is None:
-                i.features[extractor_name] = extractor(join(folder_path, i.path), i.features)
+                result = extractor(stacked[:len(batch)])
             else:
-                i.features[extractor_name] = extractor(join(folder_path, i.path), i.features, add_args)
+                result = extractor(stacked[:len(batch)], add_args)
+            if metrics is not None:
+                metrics.record_latency(extractor_name, time() - extractor_start)
+            if len(result) != len(batch):
+                raise errors.WrongSize(extractor_name)
+            with timer(metrics, 'serialization'):
+                if info is None:
+                    info = featurestore.create_feature_for_value(session, extractor_name, result[0], codec)
+                encoded = featurestore.encode_many(info, result)
+            with timer(metrics, 'commit'):
+                featurestore.write_columns(session, info, [row[0] for row in batch], encoded)
+                session.commit()
+            if metrics is not None:
+                metrics.advance(len(batch))
             if verbose > 0:
-                if a % verbose == 0:
-                    print a
-            a += 1
-    session.commit()
-    session.close()
+                print start + len(batch)
+    finally:
+        if owned is True:
+            pool.close()
+            pool.join()
+        session.close()
+    if metrics is not None:
+        metrics.finish()
     return None
 
 
@@ -149,29 +649,83 @@ def return_features_base(dbpath, set_object, names):
     Returns
     -------
     return_list : list of lists, each 'inside list' corresponds to a single data point, each element of the 'inside
-    list' is a feature (can be of any type)
+    list' is a feature (can be of any type), features are in the order of names (or in the order they were created,
+    if names is equal to 'all'), a missing value is returned as None
     """
-    engine = create_engine('sqlite:////' + dbpath)
-    session_cl = sessionmaker(bind=engine)
-    session = session_cl()
+    session = database.get_session(dbpath)
+    stored = [featurestore.read_values(session, info) for info in featurestore.feature_infos(session, names)]
     return_list = []
-    if names == 'all':
-        for i in session.query(set_object).order_by(set_object.id):
-            row_list = []
-            for feature in i.features:
-                row_list.append(i.features[feature])
-            return_list.append(row_list[:])
-    else:
-        for i in session.query(set_object).order_by(set_object.id):
-            row_list = []
-            for feature in i.features:
-                if feature in names:
-                    row_list.append(i.features[feature])
-            return_list.append(row_list[:])
+    for (row_id,) in session.query(set_object.id).filter(set_object.deleted.isnot(True)).order_by(set_object.id):
+        return_list.append([values.get(row_id) for values in stored])
+    session.close()
     return return_list
 
 
-def return_features_numpy_base(dbpath, set_object, points_amt, names):
+def _fill_features(session, set_object, infos, row_ids, return_array, metrics=None):
+    """
+    Reads features for a range of data points and writes them into a preallocated array (one bulk read and one
+    vectorized assignment per feature)
+
+    Parameters
+    ----------
+    session : SQLAlchemy session
+    set_object : object (either TestSet or TrainSet) which is stored in the database
+    infos : list of FeatureInfo objects, features which are to be read
+    row_ids : 1d ndarray of ints, sorted ids of consecutive data points, the i-th row of return_array corresponds to
+    row_ids[i]
+    return_array : 2d ndarray, see return_features_numpy_base
+    metrics : Metrics object or None, if not None, the time spent reading and decoding each feature is added to its
+    latency histogram (stage 'db read') and the time spent copying values into return_array to the 'copy' stage.
+    default value: None
+
+    Returns
+    -------
+    None
+    """
+    if len(row_ids) == 0:
+        return None
+    counter = 0
+    for info in infos:
+        read_start = time()
+        ids, values = featurestore.read_numpy(session, info, int(row_ids[0]), int(row_ids[-1]))
+        if metrics is not None:
+            metrics.record_latency(info.name, time() - read_start, 'db read')
+        copy_start = time()
+        if info.kind == 'array':
+            columns = slice(counter, counter + info.length)
+            counter += info.length
+        else:
+            columns = counter
+            counter += 1
+        if np.array_equal(ids, row_ids):
+            return_array[:, columns] = values
+        else:
+            positions = np.searchsorted(ids, row_ids)
+            positions[positions == len(ids)] = 0
+            found = ids[positions] == row_ids if len(ids) > 0 else np.zeros(len(row_ids), dtype=bool)
+            if not found.all():
+                missing_path = session.query(set_object).get(int(row_ids[np.argmin(found)])).path
+                raise errors.InsufficientData(info.name, 'feature', missing_path)
+            return_array[:, columns] = values[positions]
+        if metrics is not None:
+            metrics.add_time('copy', time() - copy_start)
+    return None
+
+
+def _columns_amt(infos):
+    """
+    Returns the amount of columns needed to store features in a 2d array (1d numpy arrays are unrolled)
+    """
+    columns_amt = 0
+    for info in infos:
+        if info.kind == 'array':
+            columns_amt += info.length
+        else:
+            columns_amt += 1
+    return columns_amt
+
+
+def return_features_numpy_base(dbpath, set_object, points_amt, names, metrics=None):
     """
     Generic function which returns a 2d numpy array of extracted features
 
@@ -179,63 +733,125 @@ def return_features_numpy_base(dbpath, set_object, points_amt, names):
     ----------
     dbpath : string, path to SQLite database file
     set_object : object (either TestSet or TrainSet) which is stored in the database
-    points_amt : int, number of data points in the database
+    points_amt : int, number of data points in the database, as known by the caller (the array has one row per data
+    point read from the database, which differs if the database was synced by another dataset object or process)
     names : list of strings, a list of feature names which are to be retrieved from the database, if equal to 'all',
     all features will be returned
+    metrics : Metrics object, if not None, it is reset and collects the time spent reading each feature (see
+    _fill_features). default value: None
 
     Returns
     -------
     return_array : ndarray of features, each row corresponds to a single datapoint. If a single feature
     is a 1d numpy array, then it will be unrolled into the resulting array. Higher-dimensional numpy arrays are not
-    supported.
+    supported. Columns are in the order of names (or in the order the features were created, if names is equal to
+    'all').
     """
-    engine = create_engine('sqlite:////' + dbpath)
-    session_cl = sessionmaker(bind=engine)
-    session = session_cl()
-    tmp_object = session.query(set_object).get(1)
+    session = database.get_session(dbpath)
+    try:
+        infos = featurestore.feature_infos(session, names)
+        row_ids = np.array([row_id for (row_id,) in session.query(set_object.id)
+                            .filter(set_object.deleted.isnot(True)).order_by(set_object.id)], dtype=np.int64)
+        if metrics is not None:
+            metrics.start('return_features_numpy', len(row_ids))
+        return_array = np.zeros([len(row_ids), _columns_amt(infos)])
+        _fill_features(session, set_object, infos, row_ids, return_array, metrics)
+    finally:
+        session.close()
+    if metrics is not None:
+        metrics.advance(len(row_ids))
+        metrics.finish()
+    return return_array
+
 
+def iter_features_numpy_base(dbpath, set_object, names, batch_size):
+    """
+    Generic function which iterates over the extracted features in chunks of consecutive data points (in the order of
+    their ids), so that only one chunk is kept in memory at a time
+
+    Parameters
+    ----------
+    dbpath : string, path to SQLite database file
+    set_object : object (either TestSet or TrainSet) which is stored in the database
+    names : list of strings, a list of feature names which are to be retrieved from the database, if equal to 'all',
+    all features will be returned
+    batch_size : int, maximal amount of data points in a chunk
+
+    Returns
+    -------
+    A generator of (ids, features) tuples: ids is a 1d ndarray of data point ids, features is a 2d ndarray, as
+    returned by return_features_numpy_base, with one row per id
+    """
+    session = database.get_session(dbpath)
+    try:
+        infos = featurestore.feature_infos(session, names)
+        columns_amt = _columns_amt(infos)
+        last_id = None
+        while True:
+            query = session.query(set_object.id).filter(set_object.deleted.isnot(True))
+            if last_id is not None:
+                query = query.filter(set_object.id > last_id)
+            row_ids = np.array([row_id for (row_id,) in query.order_by(set_object.id).limit(batch_size)],
+                               dtype=np.int64)
+            if len(row_ids) == 0:
+                break
+            return_array = np.zeros([len(row_ids), columns_amt])
+            _fill_features(session, set_object, infos, row_ids, return_array)
+            last_id = int(row_ids[-1])
+            yield row_ids, return_array
+    finally:
+        session.close()
+
+
+def return_features_memmap_base(dbpath, set_object, points_amt, names, metrics=None):
+    """
+    Generic function which returns a 2d array of extracted features as a read-only np.memmap of a .npy file. The file
+    is kept in a cache folder next to the database (<database file>.cache) and is reused as long as the selected
+    features and the data points are unchanged: the name of the file is built from the feature names, the versions
+    of the features (increased every time their values are written) and the amount of data points, so any extraction,
+    dump, copy or deletion makes older files unreachable (they are removed when the array is built again).
+
+    Parameters
+    ----------
+    dbpath : string, path to SQLite database file
+    set_object : object (either TestSet or TrainSet) which is stored in the database
+    points_amt : int, number of data points in the database, as known by the caller (see return_features_numpy_base)
+    names : list of strings, a list of feature names which are to be retrieved from the database, if equal to 'all',
+    all features will be returned
+    metrics : Metrics object, if not None, it collects the timings of reading the features when the cached file is
+    (re)built (see return_features_numpy_base). default value: None
+
+    Returns
+    -------
+    return_array : read-only np.memmap of features, see return_features_numpy_base
+    """
+    session = database.get_session(dbpath)
+    infos = featurestore.feature_infos(session, names)
+    data_state = [(info.id, info.version) for info in infos]
+    data_state.extend(session.query(func.count(set_object.id), func.max(set_object.id))
+                      .filter(set_object.deleted.isnot(True)).one())
     if names == 'all':
-        columns_amt = 0
-        for feature in tmp_object.features:
-            if type(tmp_object.features[feature]) is np.ndarray:
-                columns_amt += tmp_object.features[feature].shape[0]
-            else:
-                columns_amt += 1
-        return_array = np.zeros([points_amt, columns_amt])
-        for i in enumerate(session.query(set_object).order_by(set_object.id)):
-            counter = 0
-            for feature in i[1].features:
-                feature_val = i[1].features[feature]
-                if type(feature_val) is np.ndarray:
-                    columns_amt = feature_val.shape[0]
-                    return_array[i[0], counter:counter + columns_amt] = feature_val[:]
-                    counter += feature_val.shape[0]
-                else:
-                    return_array[i[0], counter] = feature_val
-                    counter += 1
+        names_key = sha1('all').hexdigest()[:16]
     else:
-        columns_amt = 0
-        for feature in tmp_object.features:
-            if feature in names:
-                if type(tmp_object.features[feature]) is np.ndarray:
-                    columns_amt += tmp_object.features[feature].shape[0]
-                else:
-                    columns_amt += 1
-        return_array = np.zeros([points_amt, columns_amt])
-        for i in enumerate(session.query(set_object).order_by(set_object.id)):
-            counter = 0
-            for feature in i[1].features:
-                if feature in names:
-                    feature_val = i[1].features[feature]
-                    if type(feature_val) is np.ndarray:
-                        columns_amt = feature_val.shape[0]
-                        return_array[i[0], counter:counter + columns_amt] = feature_val[:]
-                        counter += feature_val.shape[0]
-                    else:
-                        return_array[i[0], counter] = feature_val
-                        counter += 1
+        names_key = sha1(repr([info.name for info in infos])).hexdigest()[:16]
+    state_key = sha1(repr(data_state)).hexdigest()[:16]
     session.close()
-    return return_array
+
+    cache_dir = dbpath + '.cache'
+    cache_path = join(cache_dir, names_key + '-' + state_key + '.npy')
+    if not isfile(cache_path):
+        if not isdir(cache_dir):
+            makedirs(cache_dir)
+        return_array = return_features_numpy_base(dbpath, set_object, points_amt, names, metrics)
+        tmp_path = cache_path + '.' + str(getpid()) + '.tmp'
+        with open(tmp_path, 'wb') as cache_file:
+            np.save(cache_file, return_array)
+        rename(tmp_path, cache_path)
+        for f_name in listdir(cache_dir):
+            if f_name.startswith(names_key + '-') and f_name.endswith('.npy') and \
+                    f_name != names_key + '-' + state_key + '.npy':
+                remove(join(cache_dir, f_name))
+    return np.load(cache_path, mmap_mode='r')
 
 
 def return_real_id_base(dbpath, set_object):
@@ -251,16 +867,30 @@ def return_real_id_base(dbpath, set_object):
     -------
     return_list : list of real_id values for the dataset (a real_id is the filename minus the suffix and prefix)
     """
-    engine = create_engine('sqlite:////' + dbpath)
-    session_cl = sessionmaker(bind=engine)
-    session = session_cl()
+    session = database.get_session(dbpath)
     return_list = []
-    for i in session.query(set_object).order_by(set_object.id):
-        return_list.append(i.real_id)
+    for (real_id,) in session.query(set_object.real_id).filter(set_object.deleted.isnot(True)).order_by(set_object.id):
+        return_list.append(real_id)
     session.close()
     return return_list
 
 
+def return_paths_base(dbpath, set_object):
+    """
+    Generic function which returns the ids and paths of all data points (with a single query)
+
+    Parameters
+    ----------
+    dbpath : string, path to SQLite database file
+    set_object : object (either TestSet or TrainSet) which is stored in the database
+
+    Returns
+    -------
+    rows : list of (id, path) tuples, ordered by id (paths are relative to the folder containing the data point files)
+    """
+    return _select_paths(dbpath, set_object, 1, -1)
+
+
 def return_feature_list_base(dbpath, set_object):
     """
     Generic function which returns a list of the names of all available features
@@ -274,13 +904,10 @@ def return_feature_list_base(dbpath, set_object):
     -------
     return_list : list of strings corresponding to all available features
     """
-    engine = create_engine('sqlite:////' + dbpath)
-    session_cl = sessionmaker(bind=engine)
-    session = session_cl()
+    session = database.get_session(dbpath)
     return_list = []
-    tmp_object = session.query(set_object).get(1)
-    for feature in tmp_object.features:
-        return_list.append(feature)
+    for info in featurestore.feature_infos(session):
+        return_list.append(info.name)
     session.close()
     return return_list
 
@@ -300,24 +927,25 @@ def return_feature_list_numpy_base(dbpath, set_object):
     return_list : list of tuples containing the name of the feature and the length of the corresponding list or
     1d numpy array
     """
-    engine = create_engine('sqlite:////' + dbpath)
-    session_cl = sessionmaker(bind=engine)
-    session = session_cl()
+    session = database.get_session(dbpath)
     return_list = []
-    tmp_object = session.query(set_object).get(1)
-    for feature in tmp_object.features:
-        if type(tmp_object.features[feature]) is np.ndarray:
-            flength = tmp_object.features[feature].shape[0]
+    for info in featurestore.feature_infos(session):
+        if info.kind == 'array':
+            flength = info.length
         else:
             flength = 1
-        return_list.append((feature, flength))
+        return_list.append((info.name, flength))
     session.close()
     return return_list
 
 
-def copy_features_base(dbpath_origin, dbpath_destination, set_object, force_copy=False):
+def copy_features_base(dbpath_origin, dbpath_destination, set_object, force_copy=False, names='all'):
     """
-    Generic function which copies features from one database to another (base object should be of the same type)
+    Generic function which copies features from one database to another (base object should be of the same type),
+    data points are matched by their real_id; the origin database is attached to the destination one and each
+    feature is copied with a single statement. The origin database is only read (it is not opened with the pragmas of
+    the library), raises LegacyDatabase if it was created by an older version of the library and has to be migrated
+    first (by opening it as a dataset)
 
     Parameters
     ----------
@@ -326,37 +954,46 @@ def copy_features_base(dbpath_origin, dbpath_destination, set_object, force_copy
     set_object : object (either TestSet or TrainSet) which is stored in the database
     force_copy : boolean, if True - will overwrite features with same name when copying, if False, won't;
     default value: False
+    names : list of strings, names of the features which are to be copied, if equal to 'all', all features are copied.
+    default value: 'all'
 
     Returns
     -------
     None
     """
-    engine_origin = create_engine('sqlite:////' + dbpath_origin)
-    engine_destination = create_engine('sqlite:////' + dbpath_destination)
-    session_cl_origin = sessionmaker(bind=engine_origin)
-    session_cl_destination = sessionmaker(bind=engine_destination)
-    session_origin = session_cl_origin()
-    session_destination = session_cl_destination()
-    if force_copy is True:
-        for i in session_origin.query(set_object).order_by(set_object.id):
-            dest_obj = session_destination.query(set_object).get(i.id)
-            for feature in i.features:
-                if dest_obj.features is not None:
-                    dest_obj.features[feature] = i.features[feature]
-                else:
-                    dest_obj.features = {feature: i.features[feature]}
-    else:
-        for i in session_origin.query(set_object).order_by(set_object.id):
-            dest_obj = session_destination.query(set_object).get(i.id)
-            for feature in i.features:
-                if dest_obj.features is not None:
-                    if (feature not in dest_obj.features) or force_copy is True:
-                        dest_obj.features[feature] = i.features[feature]
-                else:
-                    dest_obj.features = {feature: i.features[feature]}
-    session_origin.close()
-    session_destination.commit()
-    session_destination.close()
+    if not isfile(dbpath_origin):
+        raise errors.EmptyDatabase(dbpath_origin)
+    connection = database.get_engine(dbpath_destination).connect()
+    connection.execute('ATTACH DATABASE ? AS origin', (dbpath_origin,))
+    try:
+        if featurestore.needs_migration(connection, set_object, 'origin'):
+            raise errors.LegacyDatabase(dbpath_origin)
+        session_origin = sessionmaker(bind=connection.execution_options(schema_translate_map={None: 'origin'}))()
+        try:
+            infos = featurestore.feature_infos(session_origin, names)
+        finally:
+            session_origin.close()
+        session_cl = sessionmaker(bind=connection)
+        session = session_cl()
+        try:
+            for info in infos:
+                dest_info = featurestore.feature_info(session, info.name)
+                if dest_info is not None and (dest_info.kind, dest_info.dtype, dest_info.shape, dest_info.codec) != \
+                        (info.kind, info.dtype, info.shape, info.codec):
+                    if force_copy is False:
+                        continue
+                    featurestore.drop_feature(session, dest_info)
+                    dest_info = None
+                if dest_info is None:
+                    dest_info = featurestore.create_feature(session, info.name, info.kind, info.dtype, info.length,
+                                                            info.shape, info.codec)
+                featurestore.copy_values(session, info, dest_info, set_object, force_copy)
+            session.commit()
+        finally:
+            session.close()
+    finally:
+        connection.execute('DETACH DATABASE origin')
+        connection.close()
     return None
 
 
@@ -374,12 +1011,8 @@ def return_single_real_id_base(dbpath, set_object, object_id):
     -------
     real_id : string
     """
-    engine = create_engine('sqlite:////' + dbpath)
-    session_cl = sessionmaker(bind=engine)
-    session = session_cl()
-    tmp_object = session.query(set_object).get(object_id)
-    session.close()
-    return tmp_object.real_id
+    table = set_object.__table__
+    return database.get_engine(dbpath).execute(select([table.c.real_id]).where(table.c.id == object_id)).scalar()
 
 
 def return_single_path_base(dbpath, set_object, object_id):
@@ -397,12 +1030,8 @@ def return_single_path_base(dbpath, set_object, object_id):
     -------
     path : string
     """
-    engine = create_engine('sqlite:////' + dbpath)
-    session_cl = sessionmaker(bind=engine)
-    session = session_cl()
-    tmp_object = session.query(set_object).get(object_id)
-    session.close()
-    return tmp_object.path
+    table = set_object.__table__
+    return database.get_engine(dbpath).execute(select([table.c.path]).where(table.c.id == object_id)).scalar()
 
 
 def return_single_features_base(dbpath, set_object, object_id):
@@ -419,12 +1048,112 @@ def return_single_features_base(dbpath, set_object, object_id):
     -------
     features : dict containing the features
     """
-    engine = create_engine('sqlite:////' + dbpath)
-    session_cl = sessionmaker(bind=engine)
-    session = session_cl()
-    tmp_object = session.query(set_object).get(object_id)
-    session.close()
-    return tmp_object.features
+    return return_features_many_base(dbpath, set_object, [object_id])[0]
+
+
+def return_features_many_base(dbpath, set_object, object_ids):
+    """
+    Generic function which returns the features of several objects specified by their ids (with a single query for
+    all features, see featurestore.read_rows, instead of one call of return_single_features_base per object)
+
+    Parameters
+    ----------
+    dbpath : string, path to SQLite database file
+    set_object : object (either TestSet or TrainSet) which is stored in the database
+    object_ids : list of ints, ids of objects in database
+
+    Returns
+    -------
+    features : list of dicts containing the features, one per object id
+    """
+    object_ids = list(object_ids)
+    features = []
+    connection = database.get_engine(dbpath).raw_connection()
+    try:
+        for start in xrange(0, len(object_ids), featurestore.BATCH_SIZE):
+            features.extend(featurestore.read_rows(connection, object_ids[start:start + featurestore.BATCH_SIZE]))
+    finally:
+        connection.close()
+    return features
+
+
+def _real_id_key(real_id):
+    """
+    Returns a real_id as it is stored in the database (real_id's passed as numbers are converted to strings)
+    """
+    if isinstance(real_id, basestring):
+        return real_id
+    return str(real_id)
+
+
+def return_id_mapping_base(dbpath, set_object):
+    """
+    Generic function which returns the ids and real_id's of all data points (with a single query)
+
+    Parameters
+    ----------
+    dbpath : string, path to SQLite database file
+    set_object : object (either TestSet or TrainSet) which is stored in the database
+
+    Returns
+    -------
+    ids : 1d ndarray of ints, ids of the data points in increasing order
+    real_ids : 1d ndarray of objects (strings), real_id's of the data points, in the same order
+    order : 1d ndarray of ints, the positions of the data points sorted by real_id (data points with the same real_id
+    are sorted by id), used to look up ids by real_id with a binary search
+    """
+    table = set_object.__table__
+    rows = database.get_engine(dbpath).execute(select([table.c.id, table.c.real_id]).where(table.c.deleted.isnot(True))
+                                               .order_by(table.c.id)).fetchall()
+    ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    real_ids = np.empty(len(rows), dtype=object)
+    real_ids[:] = [row[1] for row in rows]
+    return ids, real_ids, np.argsort(real_ids, kind='mergesort')
+
+
+def _lookup_ids(mapping, real_ids):
+    """
+    Returns the ids of the data points with the given real_id's (-1 for unknown real_id's), see return_id_mapping_base
+    """
+    ids, stored, order = mapping
+    keys = np.empty(len(real_ids), dtype=object)
+    keys[:] = [_real_id_key(real_id) for real_id in real_ids]
+    result = np.empty(len(keys), dtype=np.int64)
+    result.fill(-1)
+    if len(ids) == 0 or len(keys) == 0:
+        return result
+    positions = np.minimum(np.searchsorted(stored[order], keys), len(order) - 1)
+    found = stored[order][positions] == keys
+    result[found] = ids[order[positions[found]]]
+    return result
+
+
+def return_rows_by_real_id_base(dbpath, set_object, real_ids):
+    """
+    Generic function which finds data points by their real_id (with indexed queries, one per batch of real_id's)
+
+    Parameters
+    ----------
+    dbpath : string, path to SQLite database file
+    set_object : object (either TestSet or TrainSet) which is stored in the database
+    real_ids : list of strings (or numbers), real_id's of the data points
+
+    Returns
+    -------
+    rows : dict mapping real_id's (as strings) to (id, path) tuples, unknown real_id's are missing; if several data
+    points have the same real_id, the one with the smallest id is used
+    """
+    keys = list(set(_real_id_key(real_id) for real_id in real_ids))
+    table = set_object.__table__
+    engine = database.get_engine(dbpath)
+    rows = {}
+    for start in xrange(0, len(keys), featurestore.BATCH_SIZE):
+        for row_id, real_id, row_path in engine.execute(
+                select([table.c.id, table.c.real_id, table.c.path])
+                .where(table.c.real_id.in_(keys[start:start + featurestore.BATCH_SIZE]))
+                .where(table.c.deleted.isnot(True)).order_by(table.c.id)):
+            rows.setdefault(real_id, (row_id, row_path))
+    return rows
 
 
 def return_single_convert_numpy_base(dbpath, folder_path, set_object, object_id, converter, add_args=None):
@@ -446,18 +1175,66 @@ def return_single_convert_numpy_base(dbpath, folder_path, set_object, object_id,
     -------
     result : ndarray
     """
-    engine = create_engine('sqlite:////' + dbpath)
-    session_cl = sessionmaker(bind=engine)
-    session = session_cl()
-    tmp_object = session.query(set_object).get(object_id)
-    session.close()
+    object_path = return_single_path_base(dbpath, set_object, object_id)
     if add_args is None:
-        return converter(join(folder_path, tmp_object.path))
+        return converter(join(folder_path, object_path))
     else:
-        return converter(join(folder_path, tmp_object.path), add_args)
+        return converter(join(folder_path, object_path), add_args)
 
 
-def return_multiple_convert_numpy_base(dbpath, folder_path, set_object, start_id, end_id, converter, add_args=None):
+def _select_paths(dbpath, set_object, start_id, end_id, object_ids=None):
+    """
+    Returns the ids and paths of the data points with ids in the range (start_id, end_id), with a single query
+
+    Parameters
+    ----------
+    dbpath : string, path to SQLite database file
+    set_object : object (either TestSet or TrainSet) which is stored in the database
+    start_id : the id of the first object
+    end_id : the id of the last object, if equal to -1, all objects with ids bigger than or equal to start_id are
+    selected
+    object_ids : list or 1d numpy array of ints, if not None, the data points with these ids are selected instead (in
+    the same order, with one query per batch of ids), raises InsufficientData for an unknown id. default value: None
+
+    Returns
+    -------
+    rows : list of (id, path) tuples of the data points which are not flagged as deleted, ordered by id
+    """
+    table = set_object.__table__
+    engine = database.get_engine(dbpath)
+    if object_ids is not None:
+        object_ids = [int(object_id) for object_id in object_ids]
+        keys = list(set(object_ids))
+        paths = {}
+        for start in xrange(0, len(keys), featurestore.BATCH_SIZE):
+            paths.update(engine.execute(select([table.c.id, table.c.path])
+                                        .where(table.c.id.in_(keys[start:start + featurestore.BATCH_SIZE]))
+                                        .where(table.c.deleted.isnot(True))).fetchall())
+        for object_id in object_ids:
+            if object_id not in paths:
+                raise errors.InsufficientData(str(object_id), 'data point id')
+        return [(object_id, paths[object_id]) for object_id in object_ids]
+    query = select([table.c.id, table.c.path]).where(table.c.deleted.isnot(True)).where(table.c.id >= start_id)
+    if end_id != -1:
+        query = query.where(table.c.id <= end_id)
+    return engine.execute(query.order_by(table.c.id)).fetchall()
+
+
+def _convert_tasks(rows, folder_path, converter, add_args):
+    """
+    Returns the tasks (see _extraction_worker) which convert the files of a list of (id, path) rows
+    """
+    tasks = []
+    for row_id, row_path in rows:
+        if add_args is None:
+            tasks.append((converter, join(folder_path, row_path)))
+        else:
+            tasks.append((converter, join(folder_path, row_path), add_args))
+    return tasks
+
+
+def return_multiple_convert_numpy_base(dbpath, folder_path, set_object, start_id, end_id, converter, add_args=None,
+                                       n_jobs=1, pool=None, backend='thread', prefetch=64):
     """
     Generic function which converts several objects, with ids in the range (start_id, end_id)
     into a 2d numpy array and returns the array, the conversion is done by the 'converter' function
@@ -468,88 +1245,176 @@ def return_multiple_convert_numpy_base(dbpath, folder_path, set_object, start_id
     folder_path : string, path to folder where the files are stored
     set_object : object (either TestSet or TrainSet) which is stored in the database
     start_id : the id of the first object to be converted
-    end_id : the id of the last object to be converted
+    end_id : the id of the last object to be converted, if equal to -1, all objects from start_id on are converted
     converter : function, which takes the path of a data point and *args as parameters and returns a numpy array
+    (arrays with more than one dimension are flattened)
     add_args : optional arguments for the converter (list/dictionary/tuple/whatever). if None, the
     converter should take only one input argument - the file path. default value: None
+    n_jobs : int, number of workers running the converter, if equal to -1, one worker per CPU is used.
+    default value: 1
+    pool : pool object (see _open_pool) used to run the converter, if not None, n_jobs and backend are ignored.
+    default value: None
+    backend : string, 'thread' or 'process', the kind of pool created when n_jobs is not 1 (with 'process', the
+    converter must be picklable). default value: 'thread'
+    prefetch : int, maximal amount of files being converted ahead of the one written to the array. default value: 64
 
     Returns
     -------
     result : 2-dimensional ndarray
     """
-    engine = create_engine('sqlite:////' + dbpath)
-    session_cl = sessionmaker(bind=engine)
-    session = session_cl()
-    tmp_object = session.query(set_object).get(start_id)
-    if add_args is None:
-        converted = converter(join(folder_path, tmp_object.path))
-    else:
-        converted = converter(join(folder_path, tmp_object.path), add_args)
-    if len(converted.shape) == 0:
-        columns_amt = 1
-    else:
-        columns_amt = converted.shape[0]
-    return_array = np.zeros([end_id - start_id + 1, columns_amt])
-    for i in xrange(end_id - start_id + 1):
-        tmp_object = session.query(set_object).get(start_id + i)
-        if add_args is None:
-            return_array[i, :] = converter(join(folder_path, tmp_object.path))
-        else:
-            return_array[i, :] = converter(join(folder_path, tmp_object.path), add_args)
-    session.close()
+    rows = _select_paths(dbpath, set_object, start_id, end_id)
+    return_array = np.zeros([len(rows), 0])
+    pool, owned = _open_pool(n_jobs, pool, backend)
+    try:
+        results = _imap_bounded(pool, _convert_tasks(rows, folder_path, converter, add_args), prefetch)
+        for a, converted in enumerate(results):
+            converted = np.asarray(converted).ravel()
+            if a == 0:
+                return_array = np.zeros([len(rows), converted.shape[0]])
+            return_array[a, :] = converted
+    finally:
+        if owned is True:
+            pool.close()
+            pool.join()
     return return_array
 
 
-def dump_feature_base(dbpath, set_object, points_amt, feature_name, feature, force_extraction=True):
+def iter_convert_numpy_base(dbpath, folder_path, set_object, start_id, end_id, converter, add_args=None,
+                            batch_size=1000, n_jobs=1, pool=None, backend='thread', prefetch=64, object_ids=None):
     """
-    Generic function which dumps a list of lists or ndarray of features into database (allows to
-    copy features from a pre-existing .txt/.csv/.whatever file, for example)
+    Generic function which converts several objects, with ids in the range (start_id, end_id), and yields the results
+    in chunks of consecutive objects (the conversion of the next files goes on in the pool while a chunk is being used)
 
     Parameters
     ----------
     dbpath : string, path to SQLite database file
+    folder_path : string, path to folder where the files are stored
     set_object : object (either TestSet or TrainSet) which is stored in the database
-    points_amt : int, number of data points in the database
-    feature : list of lists or ndarray, contains the data to be written to the database
+    start_id : the id of the first object to be converted
+    end_id : the id of the last object to be converted, if equal to -1, all objects from start_id on are converted
+    converter : function, which takes the path of a data point and *args as parameters and returns a numpy array
+    (arrays with more than one dimension are flattened)
+    add_args : optional arguments for the converter, see return_multiple_convert_numpy_base. default value: None
+    batch_size : int, maximal amount of objects in a chunk. default value: 1000
+    n_jobs : int, number of workers running the converter, see return_multiple_convert_numpy_base. default value: 1
+    pool : pool object, see return_multiple_convert_numpy_base. default value: None
+    backend : string, 'thread' or 'process', see return_multiple_convert_numpy_base. default value: 'thread'
+    prefetch : int, maximal amount of files being converted ahead of the one written to the array. default value: 64
+    object_ids : list or 1d ndarray of ints, if not None, these objects are converted (in this order) instead of the
+    range (start_id, end_id). default value: None
+
+    Returns
+    -------
+    A generator of (ids, result) tuples: ids is a 1d ndarray of object ids, result is a 2d ndarray with one row per id
+    """
+    rows = _select_paths(dbpath, set_object, start_id, end_id, object_ids)
+    pool, owned = _open_pool(n_jobs, pool, backend)
+    try:
+        results = _imap_bounded(pool, _convert_tasks(rows, folder_path, converter, add_args), prefetch)
+        for start in xrange(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            return_array = None
+            for a, converted in enumerate(islice(results, len(batch))):
+                converted = np.asarray(converted).ravel()
+                if a == 0:
+                    return_array = np.zeros([len(batch), converted.shape[0]])
+                return_array[a, :] = converted
+            yield np.array([row[0] for row in batch], dtype=np.int64), return_array
+    finally:
+        if owned is True:
+            pool.close()
+            pool.join()
+
+
+def _feature_columns(feature):
+    """
+    Splits the data passed to dump_feature into real_id's (None if the values are ordered by id) and values, values
+    which are numbers or arrays of the same shape are stacked into a single ndarray
+    """
+    if isinstance(feature, (list, tuple, np.ndarray)):
+        real_ids = None
+        values = feature
+    elif hasattr(feature, 'index') and hasattr(feature, 'values'):
+        # a pandas Series or DataFrame, indexed by real_id
+        real_ids = list(feature.index)
+        values = np.asarray(feature.values)
+    else:
+        real_ids = list(feature.keys())
+        values = [feature[real_id] for real_id in real_ids]
+    if not isinstance(values, np.ndarray):
+        values = [np.asarray(value) if isinstance(value, (list, tuple)) else value for value in values]
+        try:
+            stacked = np.asarray(values)
+        except ValueError:
+            stacked = None
+        if stacked is not None and stacked.dtype.kind in 'biuf' and stacked.ndim >= 1:
+            values = stacked
+    return real_ids, values
+
+
+def dump_feature_base(dbpath, set_object, points_amt, feature_name, feature, force_extraction=True, codec=None):
+    """
+    Generic function which dumps a list of lists, an ndarray or a mapping of features into database (allows to
+    copy features from a pre-existing .txt/.csv/.npy/.whatever file, for example); all values are written with a single
+    statement in one transaction, rows of a 2d ndarray are written without being copied
+
+    Parameters
+    ----------
+    dbpath : string, path to SQLite database file
+    set_object : object (either TestSet or TrainSet) which is stored in the database
+    points_amt : int, number of data points in the database, as known by the caller (a list or an ndarray must have
+    one element per data point currently in the database, counted when the values are written)
+    feature_name : string, name of the feature
+    feature : list of lists or ndarray, contains the data to be written to the database (the i-th element/row
+    corresponds to the data point with the i-th smallest id), or a mapping (a dictionary, a pandas Series or DataFrame)
+    of real_id's to values (data points whose real_id is missing get no value); lists of numbers are stored as 1d numpy
+    arrays
     force_extraction : boolean, if True - will overwrite any existing feature with this name
-    default value: False
+    default value: True
+    codec : string, name of the codec applied to the stored values when the feature is created, for array and object
+    features (see serialization, for example 'zlib'), if None, the values are stored uncompressed. default value: None
 
     Returns
     -------
     None
     """
-    engine = create_engine('sqlite:////' + dbpath)
-    session_cl = sessionmaker(bind=engine)
-    session = session_cl()
-    a = 0
-
-    tmp_object = session.query(set_object).get(1)
-    if type(feature) is np.ndarray:
-        if feature.shape[0] != points_amt:
-            raise errors.WrongSize(feature_name)
-        else:
-            if tmp_object.features is None:
-                for i in session.query(set_object).order_by(set_object.id):
-                    i.features = {feature_name: feature_name[a, :]}
-                    a += 1
-            elif (feature_name not in tmp_object.features) or force_extraction is True:
-                for i in session.query(set_object).order_by(set_object.id):
-                    i.features[feature_name] = feature_name[a, :]
-                    a += 1
-    else:
-        if len(feature) != points_amt:
-            raise errors.WrongSize(feature_name)
-        else:
-            if tmp_object.features is None:
-                for i in session.query(set_object).order_by(set_object.id):
-                    i.features = {feature_name: feature_name[a]}
-                    a += 1
-            elif (feature_name not in tmp_object.features) or force_extraction is True:
-                for i in session.query(set_object).order_by(set_object.id):
-                    i.features[feature_name] = feature_name[a]
-                    a += 1
-    session.commit()
-    session.close()
+    real_ids, values = _feature_columns(feature)
+    if len(values) == 0:
+        raise errors.WrongSize(feature_name)
+    session = database.get_session(dbpath)
+    try:
+        table = set_object.__table__
+        if real_ids is None:
+            # the values are matched with the data points in the database now (points_amt may be out of date if the
+            # database was synced by another dataset object)
+            ids = [row_id for (row_id,) in session.execute(select([table.c.id]).where(table.c.deleted.isnot(True))
+                                                           .order_by(table.c.id))]
+            if len(values) != len(ids):
+                raise errors.WrongSize(feature_name)
+        info = featurestore.feature_info(session, feature_name)
+        if info is None or force_extraction is True:
+            if info is not None:
+                featurestore.drop_feature(session, info)
+            info = featurestore.create_feature_for_value(session, feature_name, values[0], codec)
+            if real_ids is not None:
+                positions = dict((real_id if isinstance(real_id, basestring) else str(real_id), a)
+                                 for a, real_id in enumerate(real_ids))
+                ids = []
+                found = []
+                for row_id, real_id in session.execute(select([table.c.id, table.c.real_id])
+                                                       .where(table.c.deleted.isnot(True)).order_by(table.c.id)):
+                    a = positions.get(real_id)
+                    if a is not None:
+                        ids.append(row_id)
+                        found.append(a)
+                if isinstance(values, np.ndarray):
+                    values = values[found]
+                else:
+                    values = [values[a] for a in found]
+            featurestore.write_columns(session, info, ids, featurestore.encode_many(info, values))
+        session.commit()
+    finally:
+        session.close()
     return None
 
 
@@ -567,28 +1432,239 @@ def delete_feature_base(dbpath, set_object, name):
     -------
     None
     """
-    engine = create_engine('sqlite:////' + dbpath)
-    session_cl = sessionmaker(bind=engine)
-    session = session_cl()
-    tmp_object = session.query(set_object).get(1)
-    if tmp_object.features is not None and name in tmp_object.features:
-        for i in session.query(set_object).order_by(set_object.id):
-            del i.features[name]
+    session = database.get_session(dbpath)
+    info = featurestore.feature_info(session, name)
+    if info is not None:
+        featurestore.drop_feature(session, info)
     session.commit()
     session.close()
     return None
 
 
+def _scan_directory(path_to_set, relative_path, file_prefix='', file_suffix='', filter_names=False):
+    """
+    Lists the files and the subdirectories of a single directory (with scandir, if available, which gets the type of
+    an entry without a stat call per entry); as in os.walk, symbolic links to directories are neither listed nor
+    followed
+
+    Parameters
+    ----------
+    path_to_set : string, path to the folder containing the data point files
+    relative_path : string, path to the directory relative to path_to_set ('' for path_to_set itself)
+    file_prefix : string, see _scan_files. default value: ''
+    file_suffix : string, see _scan_files. default value: ''
+    filter_names : boolean, see _scan_files. default value: False
+
+    Returns
+    -------
+    files : list of (file path relative to path_to_set, modification time, size) tuples
+    subdirectories : list of strings, paths to the subdirectories relative to path_to_set
+    """
+    files = []
+    subdirectories = []
+    if scandir is not None:
+        for entry in scandir(join(path_to_set, relative_path)):
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    subdirectories.append(join(relative_path, entry.name))
+            elif not filter_names or (entry.name.startswith(file_prefix) and entry.name.endswith(file_suffix)):
+                f_stat = entry.stat()
+                files.append((join(relative_path, entry.name), f_stat.st_mtime, f_stat.st_size))
+    else:
+        for f_name in listdir(join(path_to_set, relative_path)):
+            f_path = join(path_to_set, relative_path, f_name)
+            if isdir(f_path):
+                if not islink(f_path):
+                    subdirectories.append(join(relative_path, f_name))
+            elif not filter_names or (f_name.startswith(file_prefix) and f_name.endswith(file_suffix)):
+                f_stat = stat(f_path)
+                files.append((join(relative_path, f_name), f_stat.st_mtime, f_stat.st_size))
+    return files, subdirectories
+
+
+def shard_of(f_name, shards_amt):
+    """
+    Returns the index of the shard a data point file belongs to in a sharded dataset (see sharding.ShardedDataSet):
+    file names are hash-partitioned, so the shard of a file doesn't change when files are added or removed
+
+    Parameters
+    ----------
+    f_name : string, path of the file relative to the folder of the dataset (its name, for a file which is not in a
+    subfolder)
+    shards_amt : int, amount of shards
+
+    Returns
+    -------
+    index : int, from 0 to shards_amt - 1
+    """
+    if isinstance(f_name, unicode):
+        f_name = f_name.encode('utf-8')
+    return (crc32(f_name) & 0xffffffff) % shards_amt
+
+
+def _scan_files(path_to_set, file_prefix='', file_suffix='', filter_names=False, n_jobs=1, shard=None):
+    """
+    Lists the data point files in a folder (and its subfolders), level by level; the directories of a level can be
+    scanned in parallel (by threads, which helps on network file systems, where each listing waits for the server)
+
+    Parameters
+    ----------
+    path_to_set : string, path to the folder containing the data point files
+    file_prefix : string, if filter_names is True, only files whose names start with it are listed. default value: ''
+    file_suffix : string, if filter_names is True, only files whose names end with it are listed. default value: ''
+    filter_names : boolean, if True, files whose names don't match file_prefix and file_suffix are skipped.
+    default value: False
+    n_jobs : int, number of threads scanning directories, if equal to -1, one thread per CPU is used.
+    default value: 1
+    shard : (index, shards_amt) tuple or None, if not None, only the files of this shard are listed (see shard_of).
+    default value: None
+
+    Returns
+    -------
+    files : dict mapping the paths of the files relative to path_to_set (their names, for the files which are not in
+    subfolders) to (modification time, size) tuples
+    """
+    files = {}
+    pool, owned = _open_pool(n_jobs, None, 'thread')
+    try:
+        level = ['']
+        while len(level) > 0:
+            tasks = [(_scan_directory, path_to_set, path, file_prefix, file_suffix, filter_names) for path in level]
+            level = []
+            for dir_files, subdirectories in _imap_extractor(pool, tasks, 1):
+                for f_name, f_mtime, f_size in dir_files:
+                    if shard is None or shard_of(f_name, shard[1]) == shard[0]:
+                        files[f_name] = (f_mtime, f_size)
+                level.extend(subdirectories)
+    finally:
+        if owned is True:
+            pool.close()
+            pool.join()
+    return files
+
+
+def sync_base(dbpath, path_to_set, set_object, file_prefix, file_suffix, filter_names=False, scan_jobs=1,
+              shard=None):
+    """
+    Generic function which brings the database up to date with the folder containing the data point files: files
+    which are not in the database yet are added (with a single bulk insert, in the order of their paths, which are
+    stored relative to path_to_set, while the real_id is made from the name of the file), data points
+    whose file disappeared are flagged as deleted (their rows are kept, so their ids are not reused, but all other
+    functions of this module ignore them: they are not extracted, counted, returned or converted), and data points
+    whose file has a different modification time or size are considered changed: all their feature values are
+    removed, so that the next extraction recomputes them
+
+    Parameters
+    ----------
+    dbpath : string, path to SQLite database file
+    path_to_set : string, path to the folder containing the data point files
+    set_object : object (either TestSet or TrainSet) which is stored in the database
+    file_prefix : string to cut off from start of filename when creating the 'real_id' field for data point
+    file_suffix : string to cut off from end of filename when creating the 'real_id' field for data point
+    filter_names : boolean, if True, only files whose names start with file_prefix and end with file_suffix are data
+    points. default value: False
+    scan_jobs : int, number of threads scanning the folder and its subfolders (see _scan_files). default value: 1
+    shard : (index, shards_amt) tuple or None, if not None, the database is a shard of a sharded dataset and only
+    holds the files of this shard (see shard_of). default value: None
+
+    Returns
+    -------
+    result : dict with the amount of 'added', 'deleted' and 'changed' data points
+    """
+    files = _scan_files(path_to_set, file_prefix, file_suffix, filter_names, scan_jobs, shard)
+    session = database.get_session(dbpath)
+    table = set_object.__table__
+    stored = set()
+    changed_ids = []
+    deleted_ids = []
+    for row_id, row_path, row_mtime, row_size, row_deleted in session.query(set_object.id, set_object.path,
+                                                                          set_object.mtime, set_object.size,
+                                                                          set_object.deleted):
+        stored.add(row_path)
+        if row_path not in files:
+            if row_deleted is not True:
+                deleted_ids.append(row_id)
+            continue
+        f_mtime, f_size = files[row_path]
+        if row_deleted is True or (row_mtime is not None and (row_mtime, row_size) != (f_mtime, f_size)):
+            changed_ids.append(row_id)
+        if (row_mtime, row_size, row_deleted) != (f_mtime, f_size, False):
+            session.execute(table.update().where(table.c.id == row_id).values(mtime=f_mtime, size=f_size,
+                                                                              deleted=False))
+
+    new_rows = []
+    for f_name in sorted(files):
+        if f_name not in stored:
+            new_rows.append({'real_id': cutoff_filename(file_prefix, file_suffix, basename(f_name)), 'path': f_name,
+                             'mtime': files[f_name][0], 'size': files[f_name][1], 'deleted': False, 'features': None})
+    if len(new_rows) > 0:
+        session.execute(table.insert(), new_rows)
+    for start in xrange(0, len(deleted_ids), featurestore.BATCH_SIZE):
+        session.execute(table.update().where(table.c.id.in_(deleted_ids[start:start + featurestore.BATCH_SIZE]))
+                        .values(deleted=True))
+    for info in featurestore.feature_infos(session):
+        featurestore.delete_values(session, info, changed_ids)
+    session.commit()
+    session.close()
+    return {'added': len(new_rows), 'deleted': len(deleted_ids), 'changed': len(changed_ids)}
+
+
+def return_points_amt_base(dbpath, set_object):
+    """
+    Generic function which returns the amount of data points in the database (data points flagged as deleted are not
+    counted)
+
+    Parameters
+    ----------
+    dbpath : string, path to SQLite database file
+    set_object : object (either TestSet or TrainSet) which is stored in the database
+
+    Returns
+    -------
+    points_amt : int
+    """
+    session = database.get_session(dbpath)
+    points_amt = session.query(func.count(set_object.id)).filter(set_object.deleted.isnot(True)).scalar()
+    session.close()
+    return points_amt
+
+
+def _align_labels(dbpath, set_object, ids, original, path_to_labels):
+    """
+    Returns the labels of the data points with the given ids (read with a single query over the range of the ids) as a
+    2d numpy array, one row per id; raises InsufficientData if a data point has no labels
+    """
+    if len(ids) == 0:
+        return np.zeros([0, 0])
+    session = database.get_session(dbpath)
+    try:
+        label_ids, labels = labelstore.read_numpy(session, original, int(ids[0]), int(ids[-1]))
+    finally:
+        session.close()
+    positions = np.searchsorted(label_ids, ids)
+    missing = np.ones(len(ids), dtype=bool)
+    found = positions < len(label_ids)
+    missing[found] = label_ids[positions[found]] != ids[found]
+    if np.any(missing):
+        raise errors.InsufficientData(return_single_path_base(dbpath, set_object, int(ids[np.argmax(missing)])),
+                                      'labels', path_to_labels)
+    return labels[positions]
+
+
 class DataSetBase:
     """
     Generic class for a data set. Assumes that each data point is a separate file in the same directory.
     Saves some basic data, checks whether a database already exists, if it does, calculates the amount of
-    data points in it.
+    data points in it (features stored by older versions of the library are moved to per-feature tables when
+    an existing database is opened, see featurestore.ensure_schema).
     file_prefix and file_suffix are used to convert the file name into an id (in case one might need one):
     for example, if:
     file_prefix = ''
     file_suffix = '.jpg'
     then the file '12345.jpg' will have a 'real_id' of '12345' associated with it.
+    The timings of the last extraction (or return_features_numpy call) are kept in the metrics attribute (an
+    instrumentation.Metrics object: metrics.as_dict() returns them, metrics.add_callback(function) registers a function
+    which receives progress events, with rows per second and ETA, while an extraction runs).
 
     Initialization parameters
     ----------
@@ -599,24 +1675,68 @@ class DataSetBase:
     db_name : string, name of the SQLite database file
     file_prefix : string to cut off from start of filename when creating the 'real_id' field for data point
     file_suffix : string to cut off from end of filename when creating the 'real_id' field for data point
+    pragmas : dict, PRAGMA statements executed on every connection to the database (see database.configure), if None,
+    database.DEFAULT_PRAGMAS are used (WAL journal, synchronous=NORMAL, bigger page cache, memory-mapped I/O).
+    default value: None
+    filter_names : boolean, if True, only files whose names start with file_prefix and end with file_suffix are data
+    points (other files in the folder are ignored). default value: False
+    scan_jobs : int, number of threads scanning the folder (and its subfolders, in parallel) in prepopulate and sync,
+    if equal to -1, one thread per CPU is used. default value: 1
     """
-    def __init__(self, set_object, db_base, path_to_set, path_to_db, db_name, file_prefix, file_suffix):
+    def __init__(self, set_object, db_base, path_to_set, path_to_db, db_name, file_prefix, file_suffix, pragmas=None,
+                 filter_names=False, scan_jobs=1):
         self.path_to_set = path_to_set
+        self.filter_names = filter_names
+        self.scan_jobs = scan_jobs
+        # (index, shards_amt) if the dataset is a shard of a sharded dataset (see sharding.ShardedDataSet)
+        self.shard = None
 
         self.file_prefix = file_prefix
         self.file_suffix = file_suffix
         self._set_object = set_object
         self._db_base = db_base
         dbpath = join(path_to_db, db_name)
+        database.configure(dbpath, pragmas)
         if isfile(dbpath):
             self._prepopulated = True
         else:
             self._prepopulated = False
         self.points_amt = 0
         if self._prepopulated is True:
-            for (dirpath, dirnames, filenames) in walk(self.path_to_set):
-                self.points_amt = len(filenames)
+            featurestore.ensure_schema(database.get_engine(dbpath), set_object)
+            self.points_amt = return_points_amt_base(dbpath, set_object)
         self.dbpath = dbpath
+        self._id_mapping = None
+        self.metrics = instrumentation.Metrics()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    @property
+    def engine(self):
+        """
+        The SQLAlchemy engine of the database, shared by all the calls made for this dataset (see database.get_engine)
+        """
+        return database.get_engine(self.dbpath)
+
+    def close(self):
+        """
+        Closes the pooled connections to the database (a new engine is created if the dataset is used afterwards);
+        called automatically when the dataset is used as a context manager
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        None
+        """
+        database.dispose(self.dbpath)
+        return None
 
     def prepopulate(self):
         """
@@ -631,37 +1751,69 @@ class DataSetBase:
         None
         """
         if self._prepopulated is False:
-            engine = create_engine('sqlite:////' + self.dbpath)
+            engine = database.get_engine(self.dbpath)
             self._db_base.metadata.create_all(engine)
+            featurestore.ensure_schema(engine, self._set_object)
             self._prepopulated = True
-            session_cl = sessionmaker(bind=engine)
-            session = session_cl()
-
-            for (dirpath, dirnames, filenames) in walk(self.path_to_set):
-                for f_name in filenames:
-                    datapoint = self._set_object(real_id=cutoff_filename(self.file_prefix, self.file_suffix, f_name),
-                                                 path=f_name, features=None)
-                    session.add(datapoint)
-                    self.points_amt += 1
-            session.commit()
-            session.close()
+            sync_base(self.dbpath, self.path_to_set, self._set_object, self.file_prefix, self.file_suffix,
+                      self.filter_names, self.scan_jobs, self.shard)
+            self.points_amt = return_points_amt_base(self.dbpath, self._set_object)
+            self._id_mapping = None
         return None
 
-    def extract_feature(self, extractor, force_extraction=False, verbose=0, add_args=None, custom_name=None):
+    def sync(self):
+        """
+        Brings an existing database up to date with the folder containing the data point files (without rebuilding
+        it): new files are added, data points whose file disappeared are flagged as deleted (they stay in the
+        database, but are left out of extraction, points_amt, returned features, labels and real_id's, and
+        conversions), and the feature values of data points whose file changed (different modification time
+        or size) are removed, so that the next extract_feature call recomputes only them
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        A dict with the amount of 'added', 'deleted' and 'changed' data points
+        """
+        if self._prepopulated is False:
+            raise errors.EmptyDatabase(self.dbpath)
+        result = sync_base(self.dbpath, self.path_to_set, self._set_object, self.file_prefix, self.file_suffix,
+                           self.filter_names, self.scan_jobs, self.shard)
+        self.points_amt = return_points_amt_base(self.dbpath, self._set_object)
+        self._id_mapping = None
+        return result
+
+    def extract_feature(self, extractor, force_extraction=False, verbose=0, add_args=None, custom_name=None, n_jobs=1,
+                        pool=None, chunksize=16, batch_size=1000, cache=None, codec=None):
         """
         Extracts a feature and stores it in the database
 
         Parameters
         ----------
         extractor : function, which takes the path of a data point and *args as parameters and returns a feature
-        force_extraction : boolean, if True - will re-extract feature even if a feature with this name already
-        exists in the database, otherwise, will only extract if the feature doesn't exist in the database.
-        default value: False
+        force_extraction : boolean, if True - will re-extract feature for all data points even if a feature with this
+        name already exists in the database, otherwise, will only extract it for the data points which don't have a
+        value of this feature in the database. default value: False
         verbose : int, if bigger than 0, will print the current number of the file for which data is being extracted
         add_args : optional arguments for the extractor (list/dictionary/tuple/whatever). if None, the
         extractor should take only one input argument - the file path. default value: None
         custom_name : string, optional name for the feature (it will be stored in the database with the custom_name
         instead of extractor function name). if None, the extractor function name will be used. default value: None
+        n_jobs : int, number of worker processes used to run the extractor, if equal to -1, one process per CPU is
+        used. The extractor (and add_args) must be picklable, i.e. defined at the top level of a module.
+        default value: 1
+        pool : object with an imap(function, iterable, chunksize) method (for example, a multiprocessing.Pool) used to
+        run the extractor, if not None, n_jobs is ignored. default value: None
+        chunksize : int, amount of data points sent to a worker process at once. default value: 16
+        batch_size : int, amount of data points after which the extracted values are committed to the database.
+        default value: 1000
+        cache : ExtractionCache object, if not None, the extractor is only called for files for which the cache has no
+        value yet (see extractcache.ExtractionCache) and the extracted values are added to the cache.
+        default value: None
+        codec : string, name of the codec applied to the stored values when the feature is created, for array and
+        object features (see serialization, for example 'zlib'), if None, the values are stored uncompressed.
+        default value: None
 
         Returns
         -------
@@ -671,10 +1823,12 @@ class DataSetBase:
             raise errors.EmptyDatabase(self.dbpath)
         else:
             return extract_feature_base(self.dbpath, self.path_to_set, self._set_object, extractor, force_extraction,
-                                        verbose, add_args, custom_name)
+                                        verbose, add_args, custom_name, n_jobs, pool, chunksize, batch_size, cache,
+                                        codec, self.metrics)
 
     def extract_feature_dependent_feature(self, extractor, force_extraction=False, verbose=0, add_args=None,
-                                          custom_name=None):
+                                          custom_name=None, n_jobs=1, pool=None, chunksize=16, batch_size=1000,
+                                          codec=None):
         """
         Extracts a feature which may be dependent on other features and stores it in the database
 
@@ -682,14 +1836,25 @@ class DataSetBase:
         ----------
         extractor : function, which takes the path of a data point, a dictionary of all other features and *args as
         parameters and returns a feature
-        force_extraction : boolean, if True - will re-extract feature even if a feature with this name already
-        exists in the database, otherwise, will only extract if the feature doesn't exist in the database.
-        default value: False
+        force_extraction : boolean, if True - will re-extract feature for all data points even if a feature with this
+        name already exists in the database, otherwise, will only extract it for the data points which don't have a
+        value of this feature in the database. default value: False
         verbose : int, if bigger than 0, will print the current number of the file for which data is being extracted
         add_args : optional arguments for the extractor (list/dictionary/tuple/whatever). if None, the
         extractor should take only one input argument - the file path. default value: None
         custom_name : string, optional name for the feature (it will be stored in the database with the custom_name
         instead of extractor function name). if None, the extractor function name will be used. default value: None
+        n_jobs : int, number of worker processes used to run the extractor, if equal to -1, one process per CPU is
+        used. The extractor (and add_args) must be picklable, i.e. defined at the top level of a module.
+        default value: 1
+        pool : object with an imap(function, iterable, chunksize) method (for example, a multiprocessing.Pool) used to
+        run the extractor, if not None, n_jobs is ignored. default value: None
+        chunksize : int, amount of data points sent to a worker process at once. default value: 16
+        batch_size : int, amount of data points after which the extracted values are committed to the database.
+        default value: 1000
+        codec : string, name of the codec applied to the stored values when the feature is created, for array and
+        object features (see serialization, for example 'zlib'), if None, the values are stored uncompressed.
+        default value: None
 
         Returns
         -------
@@ -699,7 +1864,99 @@ class DataSetBase:
             raise errors.EmptyDatabase(self.dbpath)
         else:
             return extract_feature_dependent_feature_base(self.dbpath, self.path_to_set, self._set_object, extractor,
-                                                          force_extraction, verbose, add_args, custom_name)
+                                                          force_extraction, verbose, add_args, custom_name, n_jobs,
+                                                          pool, chunksize, batch_size, codec, self.metrics)
+
+    def extract_features(self, extractors, force_extraction=False, verbose=0, add_args=None, n_jobs=1, pool=None,
+                         chunksize=16, batch_size=1000, codec=None, loader=None):
+        """
+        Extracts several features in a single pass over the data points and stores them in the database; extractors
+        which depend on other features should declare them with scheduler.requires, the features are then computed in
+        the order of their dependencies (which can also be features stored by previous calls), so there is no need to
+        order the calls by hand
+
+        Parameters
+        ----------
+        extractors : list of extractor functions or of (name, extractor) tuples (the name of a feature is the name of
+        its extractor, unless given explicitly), an extractor decorated with requires(names) takes the path of a data
+        point, a dictionary of the features it requires and *args as parameters, any other extractor takes the path of
+        a data point and *args
+        force_extraction : boolean, if True - will re-extract the features for all data points, otherwise, will only
+        extract the features which are missing for each data point. default value: False
+        verbose : int, if bigger than 0, will print the current number of the file for which data is being extracted
+        add_args : optional arguments for all the extractors (list/dictionary/tuple/whatever). default value: None
+        n_jobs : int, number of worker processes used to run the extractors, if equal to -1, one process per CPU is
+        used. The extractors (and add_args) must be picklable, i.e. defined at the top level of a module.
+        default value: 1
+        pool : object with an imap(function, iterable, chunksize) method (for example, a multiprocessing.Pool) used to
+        run the extractors, if not None, n_jobs is ignored. default value: None
+        chunksize : int, amount of data points sent to a worker process at once. default value: 16
+        batch_size : int, amount of data points after which the extracted values are committed to the database.
+        default value: 1000
+        codec : string, name of the codec applied to the stored values when the features are created, for array and
+        object features (see serialization, for example 'zlib'), if None, the values are stored uncompressed.
+        default value: None
+        loader : function, if not None, it is called once per data point with the path of its file and its result
+        (for example, a decoded image) is passed to the extractors instead of the path, so a file is read and decoded
+        only once for all the features. It must be picklable if n_jobs is not 1. default value: None
+
+        Returns
+        -------
+        stages : list of lists of feature names, features of a stage only depend on features of previous stages
+        """
+        if self._prepopulated is False:
+            raise errors.EmptyDatabase(self.dbpath)
+        else:
+            return extract_features_base(self.dbpath, self.path_to_set, self._set_object, extractors, force_extraction,
+                                         verbose, add_args, n_jobs, pool, chunksize, batch_size, codec, loader,
+                                         self.metrics)
+
+    def extract_feature_batched(self, extractor, loader, force_extraction=False, verbose=0, add_args=None,
+                                custom_name=None, batch_size=256, n_jobs=1, pool=None, backend='thread', prefetch=None,
+                                codec=None):
+        """
+        Extracts a feature with a batch extractor, which is called once per batch of data points with their files
+        loaded into a single stacked array (for example, (N, H, W) for N same-sized greyscale images), so that it can
+        be written as a few vectorized numpy operations; the i-th element of its result is stored as the value of the
+        i-th data point of the batch
+
+        Parameters
+        ----------
+        extractor : function, which takes an (N, ...) array and *args as parameters and returns an array (or a list) of
+        N values. The stacked array is reused for the next batch, so the extractor should not keep references to it
+        loader : function, which takes the path of a data point and returns a numpy array, all arrays should have the
+        same shape and dtype (otherwise, WrongSize is raised)
+        force_extraction : boolean, if True - will re-extract feature for all data points, otherwise, will only
+        extract it for the data points which don't have a value of this feature in the database. default value: False
+        verbose : int, if bigger than 0, will print the amount of processed data points after each batch.
+        default value: 0
+        add_args : optional arguments for the extractor (list/dictionary/tuple/whatever). if None, the
+        extractor should take only one input argument - the stacked array. default value: None
+        custom_name : string, optional name for the feature (it will be stored in the database with the custom_name
+        instead of extractor function name). if None, the extractor function name will be used. default value: None
+        batch_size : int, amount of data points passed to the extractor at once. default value: 256
+        n_jobs : int, number of workers running the loader, if equal to -1, one worker per CPU is used.
+        default value: 1
+        pool : pool object (for example, a multiprocessing.Pool) used to run the loader, if not None, n_jobs and
+        backend are ignored. default value: None
+        backend : string, 'thread' or 'process', the kind of pool created when n_jobs is not 1 (with 'process', the
+        loader must be picklable). default value: 'thread'
+        prefetch : int, maximal amount of files being loaded ahead of the one copied into the stacked array, if None,
+        batch_size is used. default value: None
+        codec : string, name of the codec applied to the stored values when the feature is created, for array and
+        object features (see serialization, for example 'zlib'), if None, the values are stored uncompressed.
+        default value: None
+
+        Returns
+        -------
+        None
+        """
+        if self._prepopulated is False:
+            raise errors.EmptyDatabase(self.dbpath)
+        else:
+            return extract_feature_batched_base(self.dbpath, self.path_to_set, self._set_object, extractor, loader,
+                                                force_extraction, verbose, add_args, custom_name, batch_size, n_jobs,
+                                                pool, backend, prefetch, codec, self.metrics)
 
     def return_features(self, names='all'):
         """
@@ -720,7 +1977,7 @@ class DataSetBase:
         else:
             return return_features_base(self.dbpath, self._set_object, names)
 
-    def return_features_numpy(self, names='all'):
+    def return_features_numpy(self, names='all', mmap=False):
         """
         Returns a 2d numpy array of extracted features
 
@@ -728,6 +1985,10 @@ class DataSetBase:
         ----------
         names : list of strings, a list of feature names which are to be retrieved from the database, if equal to 'all',
         all features will be returned, default value: 'all'
+        mmap : boolean, if True, the array is cached in a .npy file next to the database and returned as a read-only
+        np.memmap, so repeated calls (from this or other processes) only map the file instead of reading the database;
+        the file is rebuilt after the selected features or data points change (see return_features_memmap_base).
+        default value: False
 
         Returns
         -------
@@ -736,8 +1997,66 @@ class DataSetBase:
         """
         if self._prepopulated is False:
             raise errors.EmptyDatabase(self.dbpath)
+        elif mmap is True:
+            return return_features_memmap_base(self.dbpath, self._set_object, self.points_amt, names, self.metrics)
         else:
-            return return_features_numpy_base(self.dbpath, self._set_object, self.points_amt, names)
+            return return_features_numpy_base(self.dbpath, self._set_object, self.points_amt, names, self.metrics)
+
+    def return_feature_matrix(self, names='all'):
+        """
+        Returns a lazy 2d view of features (see featurematrix.FeatureMatrix): its shape and columns are known without
+        reading any values, and indexing it, for example X[1000:2000, ['mean', 'histogram']], reads only the requested
+        data points and features
+
+        Parameters
+        ----------
+        names : list of strings, a list of feature names which are to be retrieved from the database, if equal to
+        'all', all features will be used (in the order they were created). default value: 'all'
+
+        Returns
+        -------
+        A FeatureMatrix object, with the same columns as the array returned by return_features_numpy(names)
+        """
+        if self._prepopulated is False:
+            raise errors.EmptyDatabase(self.dbpath)
+        return featurematrix.FeatureMatrix(self.dbpath, self._set_object, names)
+
+    def iter_batches(self, names='all', batch_size=1000, with_labels=True):
+        """
+        Iterates over the extracted features in chunks of consecutive data points (in the order of their ids), only
+        one chunk is kept in memory at a time (useful for out-of-core training, e.g. with partial_fit)
+
+        Parameters
+        ----------
+        names : list of strings, a list of feature names which are to be retrieved from the database, if equal to 'all',
+        all features will be returned, default value: 'all'
+        batch_size : int, maximal amount of data points in a chunk, default value: 1000
+        with_labels : boolean, ignored for unlabeled datasets (the labels are always None), default value: True
+
+        Returns
+        -------
+        A generator of (ids, X_chunk, y_chunk) tuples: ids is a 1d numpy array of data point ids, X_chunk is a 2d
+        numpy array of features (see return_features_numpy), y_chunk is None
+        """
+        if self._prepopulated is False:
+            raise errors.EmptyDatabase(self.dbpath)
+        for ids, features in iter_features_numpy_base(self.dbpath, self._set_object, names, batch_size):
+            yield ids, features, None
+
+    def clear_cache(self):
+        """
+        Removes all the cached feature arrays (see return_features_numpy) of the dataset
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        None
+        """
+        if isdir(self.dbpath + '.cache'):
+            rmtree(self.dbpath + '.cache')
+        return None
 
     def return_real_id(self):
         """
@@ -755,6 +2074,128 @@ class DataSetBase:
         else:
             return return_real_id_base(self.dbpath, self._set_object)
 
+    def return_paths(self):
+        """
+        Returns the ids and paths of all data points
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        A list of (id, path) tuples, ordered by id (paths are relative to path_to_set)
+        """
+        if self._prepopulated is False:
+            raise errors.EmptyDatabase(self.dbpath)
+        return return_paths_base(self.dbpath, self._set_object)
+
+    def return_id_mapping(self):
+        """
+        Returns the ids and real_id's of all data points; the arrays are read once and cached (until the next sync),
+        so that, for example, predictions can be joined back to real_id's with return_real_id_numpy(ids)
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        ids : 1d numpy array of ints, ids of the data points in increasing order
+        real_ids : 1d numpy array of objects (strings), real_id's of the data points, in the same order
+        """
+        if self._prepopulated is False:
+            raise errors.EmptyDatabase(self.dbpath)
+        if self._id_mapping is None:
+            self._id_mapping = return_id_mapping_base(self.dbpath, self._set_object)
+        return self._id_mapping[0], self._id_mapping[1]
+
+    def return_real_id_numpy(self, object_ids=None):
+        """
+        Returns the real_id's of data points (a vectorized lookup in the cached mapping, see return_id_mapping)
+
+        Parameters
+        ----------
+        object_ids : list or 1d numpy array of ints, ids of the data points, if None, the real_id's of all data points
+        are returned (in the order of their ids). default value: None
+
+        Returns
+        -------
+        real_ids : 1d numpy array of objects (strings), one per object id, raises InsufficientData (naming the unknown
+        ids) if some ids are not in the database
+        """
+        ids, real_ids = self.return_id_mapping()
+        if object_ids is None:
+            return real_ids.copy()
+        object_ids = np.asarray(object_ids, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(ids, object_ids), max(len(ids) - 1, 0))
+        if len(ids) == 0:
+            unknown = object_ids
+        else:
+            unknown = object_ids[ids[positions] != object_ids]
+        if len(unknown) > 0:
+            # the message names the unknown ids (the first ten of them)
+            raise errors.InsufficientData(', '.join(str(object_id) for object_id in unknown[:10]) +
+                                          (', ...' if len(unknown) > 10 else ''), 'data point id', self.dbpath)
+        return real_ids[positions]
+
+    def return_ids_numpy(self, real_ids):
+        """
+        Returns the ids of data points specified by their real_id's (a vectorized binary search in the cached mapping,
+        see return_id_mapping), if several data points have the same real_id, the smallest id is returned
+
+        Parameters
+        ----------
+        real_ids : list or 1d numpy array of strings (or numbers, which are converted to strings)
+
+        Returns
+        -------
+        ids : 1d numpy array of ints, one per real_id, -1 for real_id's which are not in the database
+        """
+        self.return_id_mapping()
+        return _lookup_ids(self._id_mapping, real_ids)
+
+    def get_by_real_id(self, real_id):
+        """
+        Returns a data point specified by its real_id (found with an indexed query)
+
+        Parameters
+        ----------
+        real_id : string (or number, which is converted to a string)
+
+        Returns
+        -------
+        point : dict with the 'id', 'path' and 'features' (a dict) of the data point, or None if the real_id is not in
+        the database
+        """
+        return self.get_many_by_real_id([real_id])[0]
+
+    def get_many_by_real_id(self, real_ids):
+        """
+        Returns several data points specified by their real_id's (with one indexed query per batch of real_id's and a
+        single read of their features, see return_single_features_many)
+
+        Parameters
+        ----------
+        real_ids : list of strings (or numbers, which are converted to strings)
+
+        Returns
+        -------
+        points : list of data points (see get_by_real_id), one per real_id
+        """
+        if self._prepopulated is False:
+            raise errors.EmptyDatabase(self.dbpath)
+        real_ids = list(real_ids)
+        rows = return_rows_by_real_id_base(self.dbpath, self._set_object, real_ids)
+        found = [rows.get(_real_id_key(real_id)) for real_id in real_ids]
+        features = iter(return_features_many_base(self.dbpath, self._set_object,
+                                                   [row[0] for row in found if row is not None]))
+        points = []
+        for row in found:
+            if row is None:
+                points.append(None)
+            else:
+                points.append({'id': row[0], 'path': row[1], 'features': next(features)})
+        return points
+
     def return_feature_list(self):
         """
         Returns a list of the names of all available features
@@ -782,21 +2223,25 @@ class DataSetBase:
         """
         return return_feature_list_numpy_base(self.dbpath, self._set_object)
 
-    def copy_features(self, dbpath_origin, force_copy=False):
+    def copy_features(self, dbpath_origin, force_copy=False, names='all'):
         """
-        Copies features from one database to another (base object should be of the same type)
+        Copies features from one database to another (base object should be of the same type), data points are
+        matched by their real_id. The origin database is not changed: if it was created by an older version of the
+        library, LegacyDatabase is raised (opening it as a dataset migrates it)
 
         Parameters
         ----------
         dbpath_origin : string, path to SQLite database file from which the features will be copied
         force_copy : boolean, if True - will overwrite features with same name when copying, if False, won't;
         default value: False
+        names : list of strings, names of the features which are to be copied, if equal to 'all', all features are
+        copied. default value: 'all'
 
         Returns
         -------
         None
         """
-        copy_features_base(dbpath_origin, self.dbpath, self._set_object, force_copy)
+        copy_features_base(dbpath_origin, self.dbpath, self._set_object, force_copy, names)
         return None
 
     def return_single_real_id(self, object_id):
@@ -842,6 +2287,21 @@ class DataSetBase:
         """
         return return_single_features_base(self.dbpath, self._set_object, object_id)
 
+    def return_single_features_many(self, object_ids):
+        """
+        Returns the features of several objects specified by their ids, much faster than calling
+        return_single_features for each of them
+
+        Parameters
+        ----------
+        object_ids : list of ints, ids of objects in database
+
+        Returns
+        -------
+        features : list of dicts containing the features, one per object id
+        """
+        return return_features_many_base(self.dbpath, self._set_object, object_ids)
+
     def return_single_convert_numpy(self, object_id, converter, add_args=None):
         """
         Converts an object specified by the object_id into a numpy array and returns the array,
@@ -861,7 +2321,8 @@ class DataSetBase:
         return return_single_convert_numpy_base(self.dbpath, self.path_to_set, self._set_object, object_id, converter,
                                                 add_args)
 
-    def return_multiple_convert_numpy(self, start_id, end_id, converter, add_args=None):
+    def return_multiple_convert_numpy(self, start_id, end_id, converter, add_args=None, n_jobs=1, pool=None,
+                                      backend='thread', prefetch=64):
         """
         Converts several objects, with ids in the range (start_id, end_id)
         into a 2d numpy array and returns the array, the conversion is done by the 'converter' function
@@ -872,34 +2333,79 @@ class DataSetBase:
         end_id : the id of the last object to be converted, if equal to -1, will convert all data points in range
         (start_id, <id of last element in database>)
         converter : function, which takes the path of a data point and *args as parameters and returns a numpy array
+        (arrays with more than one dimension are flattened)
         add_args : optional arguments for the converter (list/dictionary/tuple/whatever). if None, the
         converter should take only one input argument - the file path. default value: None
+        n_jobs : int, number of workers running the converter, if equal to -1, one worker per CPU is used.
+        default value: 1
+        pool : pool object (for example, a multiprocessing.Pool) used to run the converter, if not None, n_jobs and
+        backend are ignored. default value: None
+        backend : string, 'thread' or 'process', the kind of pool created when n_jobs is not 1 (with 'process', the
+        converter must be picklable). default value: 'thread'
+        prefetch : int, maximal amount of files being converted ahead of the one written to the array.
+        default value: 64
 
         Returns
         -------
         result : 2-dimensional ndarray
         """
-        if end_id == -1:
-            end_id = self.points_amt
         return return_multiple_convert_numpy_base(self.dbpath, self.path_to_set, self._set_object, start_id, end_id,
-                                                  converter, add_args)
+                                                  converter, add_args, n_jobs, pool, backend, prefetch)
+
+    def iter_convert_numpy(self, start_id, end_id, converter, add_args=None, batch_size=1000, n_jobs=1, pool=None,
+                           backend='thread', prefetch=64, object_ids=None):
+        """
+        Converts several objects, with ids in the range (start_id, end_id), and yields the results in chunks of
+        consecutive objects, the conversion is done by the 'converter' function (the next files are converted in the
+        background while a chunk is being used)
+
+        Parameters
+        ----------
+        start_id : the id of the first object to be converted
+        end_id : the id of the last object to be converted, if equal to -1, will convert all data points in range
+        (start_id, <id of last element in database>)
+        converter : function, see return_multiple_convert_numpy
+        add_args : optional arguments for the converter, see return_multiple_convert_numpy. default value: None
+        batch_size : int, maximal amount of objects in a chunk. default value: 1000
+        n_jobs : int, number of workers running the converter, see return_multiple_convert_numpy. default value: 1
+        pool : pool object, see return_multiple_convert_numpy. default value: None
+        backend : string, 'thread' or 'process', see return_multiple_convert_numpy. default value: 'thread'
+        prefetch : int, maximal amount of files being converted ahead of the one written to the array.
+        default value: 64
+        object_ids : list or 1d numpy array of ints, if not None, these objects are converted (in this order, for
+        example shuffled ids) instead of the range (start_id, end_id). default value: None
+
+        Returns
+        -------
+        A generator of (ids, result) tuples: ids is a 1d numpy array of object ids, result is a 2d numpy array with one
+        row per id
+        """
+        return iter_convert_numpy_base(self.dbpath, self.path_to_set, self._set_object, start_id, end_id, converter,
+                                       add_args, batch_size, n_jobs, pool, backend, prefetch, object_ids)
 
-    def dump_feature(self, feature_name, feature, force_extraction=True):
+    def dump_feature(self, feature_name, feature, force_extraction=True, codec=None):
         """
-        Dumps a list of lists or ndarray of features into database (allows to
-        copy features from a pre-existing .txt/.csv/.whatever file, for example)
+        Dumps a list of lists, an ndarray or a mapping of features into database (allows to
+        copy features from a pre-existing .txt/.csv/.npy/.whatever file, for example)
 
         Parameters
         ----------
-        feature : list of lists or ndarray, contains the data to be written to the database
+        feature_name : string, name of the feature
+        feature : list of lists or ndarray, contains the data to be written to the database (the i-th element/row
+        corresponds to the data point with the i-th smallest id), or a mapping (a dictionary, a pandas Series or
+        DataFrame) of real_id's to values
         force_extraction : boolean, if True - will overwrite any existing feature with this name
-        default value: False
+        default value: True
+        codec : string, name of the codec applied to the stored values when the feature is created, for array and
+        object features (see serialization, for example 'zlib'), if None, the values are stored uncompressed.
+        default value: None
 
         Returns
         -------
         None
         """
-        dump_feature_base(self.dbpath, self._set_object, self.points_amt, feature_name, feature, force_extraction)
+        dump_feature_base(self.dbpath, self._set_object, self.points_amt, feature_name, feature, force_extraction,
+                          codec)
         return None
 
     def delete_feature(self, name):
@@ -920,11 +2426,17 @@ class UnlabeledDataSet(DataSetBase):
     data point, default value: ''
     file_suffix : string, optional, string to cut off from end of filename when creating the 'real_id' field for
     data point, default value: ''
+    pragmas : dict, optional, PRAGMA statements executed on every connection to the database (see
+    database.configure), default value: None
+    filter_names : boolean, optional, if True, only files whose names start with file_prefix and end with file_suffix
+    are data points, default value: False
+    scan_jobs : int, optional, number of threads scanning the folder in prepopulate and sync, default value: 1
 
     """
-    def __init__(self, path_to_set, path_to_db, custom_name='test.db', file_prefix='', file_suffix=''):
+    def __init__(self, path_to_set, path_to_db, custom_name='test.db', file_prefix='', file_suffix='', pragmas=None,
+                 filter_names=False, scan_jobs=1):
         DataSetBase.__init__(self, testset.TestSet, testset.Base, path_to_set, path_to_db, custom_name, file_prefix,
-                             file_suffix)
+                             file_suffix, pragmas, filter_names, scan_jobs)
 
 
 class LabeledDataSet(DataSetBase):
@@ -935,7 +2447,9 @@ class LabeledDataSet(DataSetBase):
     ----------
     path_to_set : string, path to the folder containing the data point files
     path_to_db : string, path to the folder where the SQLite database is stored
-    path_to_labels : string, path to the CSV file in which the labels are stored
+    path_to_labels : string, path to the CSV file in which the labels are stored (the first column contains the
+    real_id's of the data points, the other columns contain their labels)
+    delimiter : string, optional, the delimiter used in the labels CSV file, default value: ','
     custom_name : string, optional, name of database file, default value: 'test.db'
     label_dict : dict, optional, defines a custom mapping of labels. Example: if label_dict is equal to
     {'a': 1}, then a label 'a' will be stored as 1 in the database (original labels are also stored)
@@ -945,10 +2459,15 @@ class LabeledDataSet(DataSetBase):
     data point, default value: ''
     file_suffix : string, optional, string to cut off from end of filename when creating the 'real_id' field for
     data point, default value: ''
+    pragmas : dict, optional, PRAGMA statements executed on every connection to the database (see
+    database.configure), default value: None
+    filter_names : boolean, optional, if True, only files whose names start with file_prefix and end with file_suffix
+    are data points, default value: False
+    scan_jobs : int, optional, number of threads scanning the folder in prepopulate and sync, default value: 1
 
     """
     def __init__(self, path_to_set, path_to_db, path_to_labels, delimiter=',', custom_name='train.db', label_dict=None,
-                 label_header=True, file_prefix='', file_suffix=''):
+                 label_header=True, file_prefix='', file_suffix='', pragmas=None, filter_names=False, scan_jobs=1):
 
         self.label_header = label_header
         self.path_to_labels = path_to_labels
@@ -956,7 +2475,67 @@ class LabeledDataSet(DataSetBase):
         self.label_dict = label_dict
 
         DataSetBase.__init__(self, trainset.TrainSet, trainset.Base, path_to_set, path_to_db, custom_name, file_prefix,
-                             file_suffix)
+                             file_suffix, pragmas, filter_names, scan_jobs)
+        if self._prepopulated is True:
+            labelstore.ensure_schema(database.get_engine(self.dbpath), self._set_object)
+
+    def prepopulate(self):
+        """
+        Creates a database file (if it doesn't exist, writes each data point's path, real_id into it) and loads the
+        labels from the labels CSV file (see load_labels)
+
+        Parameters
+        ----------
+        self
+
+        Returns
+        -------
+        None
+        """
+        if self._prepopulated is False:
+            DataSetBase.prepopulate(self)
+            labelstore.ensure_schema(database.get_engine(self.dbpath), self._set_object)
+            self.load_labels()
+        return None
+
+    def sync(self):
+        """
+        Brings an existing database up to date with the folder containing the data point files (see
+        DataSetBase.sync) and reloads the labels, so that new data points get theirs
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        A dict with the amount of 'added', 'deleted' and 'changed' data points
+        """
+        result = DataSetBase.sync(self)
+        if result['added'] > 0:
+            self.load_labels()
+        return result
+
+    def load_labels(self):
+        """
+        Reads the labels CSV file (in a single pass), matches its rows with the data points by real_id, applies
+        label_dict and stores the labels as numbers (replacing the previously stored labels)
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        result : int, amount of data points for which labels were found
+        """
+        if self._prepopulated is False:
+            raise errors.EmptyDatabase(self.dbpath)
+        real_ids, fields = labelstore.parse_csv(self.path_to_labels, self.delimiter, self.label_header)
+        original_kind, original, transformed = labelstore.transform_labels(fields, self.label_dict)
+        session = database.get_session(self.dbpath)
+        try:
+            return labelstore.store_labels(session, self._set_object, real_ids, original_kind, original, transformed)
+        finally:
+            session.close()
 
     def return_labels(self, original=False):
         """
@@ -972,54 +2551,87 @@ class LabeledDataSet(DataSetBase):
         A list of lists, each 'inside list' corresponds to a single data point, each element of the 'inside list' is a
         label
         """
+        return self.return_labels_numpy(original).tolist()
+
+    def return_labels_numpy(self, original=False, object_ids=None):
+        """
+        Returns a 2d numpy array of labels (read with a single query)
+
+        Parameters
+        ----------
+        original : if True, will return original labels, if False, will return transformed labels (as defined by
+        label_dict), default value: False
+        object_ids : list or 1d numpy array of ints, if not None, only the labels of these objects are returned (in
+        the same order), default value: None
+
+        Returns
+        -------
+        A numpy array of labels, each row corresponds to a single datapoint (of strings if the original labels are
+        requested and are not numbers, of floats otherwise)
+        """
         if self._prepopulated is False:
             raise errors.EmptyDatabase(self.dbpath)
-        else:
-            engine = create_engine('sqlite:////' + self.dbpath)
-            trainset.Base.metadata.create_all(engine)
-            session_cl = sessionmaker(bind=engine)
-            session = session_cl()
-            return_list = []
-            for i in session.query(trainset.TrainSet).order_by(trainset.TrainSet.id):
-                if original is True:
-                    row_list = i.labels['original']
-                else:
-                    row_list = i.labels['transformed']
-                return_list.append(row_list[:])
-            session.close()
-            return return_list
-
-    def return_labels_numpy(self, original=False):
+        if object_ids is None:
+            table = self._set_object.__table__
+            ids = np.array([row[0] for row in database.get_engine(self.dbpath)
+                            .execute(select([table.c.id]).where(table.c.deleted.isnot(True)).order_by(table.c.id))],
+                           dtype=np.int64)
+            return _align_labels(self.dbpath, self._set_object, ids, original, self.path_to_labels)
+        ids = np.asarray(object_ids, dtype=np.int64)
+        order = np.argsort(ids, kind='mergesort')
+        labels = _align_labels(self.dbpath, self._set_object, ids[order], original, self.path_to_labels)
+        return_array = np.empty_like(labels)
+        return_array[order] = labels
+        return return_array
+
+    def iter_batches(self, names='all', batch_size=1000, with_labels=True, original=False):
         """
-        Returns a 2d numpy array of labels
+        Iterates over the extracted features and the labels in chunks of consecutive data points (in the order of
+        their ids), only one chunk is kept in memory at a time (useful for out-of-core training, e.g. with partial_fit)
 
         Parameters
         ----------
+        names : list of strings, a list of feature names which are to be retrieved from the database, if equal to 'all',
+        all features will be returned, default value: 'all'
+        batch_size : int, maximal amount of data points in a chunk, default value: 1000
+        with_labels : boolean, if False, the labels are not read and y_chunk is None, default value: True
         original : if True, will return original labels, if False, will return transformed labels (as defined by
         label_dict), default value: False
 
         Returns
         -------
-        A numpy array of labels, each row corresponds to a single datapoint
+        A generator of (ids, X_chunk, y_chunk) tuples: ids is a 1d numpy array of data point ids, X_chunk is a 2d
+        numpy array of features (see return_features_numpy), y_chunk is a 2d numpy array of labels (see
+        return_labels_numpy) or None
         """
         if self._prepopulated is False:
             raise errors.EmptyDatabase(self.dbpath)
-        else:
-            engine = create_engine('sqlite:////' + self.dbpath)
-            trainset.Base.metadata.create_all(engine)
-            session_cl = sessionmaker(bind=engine)
-            session = session_cl()
-            tmp_object = session.query(trainset.TrainSet).get(1)
-
-            columns_amt = len(tmp_object.labels['original'])
-            return_array = np.zeros([self.points_amt, columns_amt])
-            for i in enumerate(session.query(trainset.TrainSet).order_by(trainset.TrainSet.id)):
-                if original is False:
-                    return_array[i[0], :] = i[1].labels['transformed']
-                else:
-                    return_array[i[0], :] = i[1].labels['original']
-            session.close()
-            return return_array
+        for ids, features in iter_features_numpy_base(self.dbpath, self._set_object, names, batch_size):
+            if with_labels is False:
+                yield ids, features, None
+            else:
+                yield ids, features, _align_labels(self.dbpath, self._set_object, ids, original,
+                                                   self.path_to_labels)
+
+    def get_many_by_real_id(self, real_ids):
+        """
+        Returns several data points specified by their real_id's, with their labels (see
+        DataSetBase.get_many_by_real_id)
+
+        Parameters
+        ----------
+        real_ids : list of strings (or numbers, which are converted to strings)
+
+        Returns
+        -------
+        points : list of dicts with the 'id', 'path', 'features' and 'labels' (see return_single_labels) of the data
+        points (None for real_id's which are not in the database), one per real_id
+        """
+        points = DataSetBase.get_many_by_real_id(self, real_ids)
+        known = [point for point in points if point is not None]
+        for point, labels in izip(known, self.return_single_labels_many([point['id'] for point in known])):
+            point['labels'] = labels
+        return points
 
     def return_single_labels(self, object_id):
         """
@@ -1031,11 +2643,26 @@ class LabeledDataSet(DataSetBase):
 
         Returns
         -------
-        result : list of labels
+        result : dict with the 'original' and 'transformed' lists of labels, or None if the object has no labels
         """
-        engine = create_engine('sqlite:////' + self.dbpath)
-        trainset.Base.metadata.create_all(engine)
-        session_cl = sessionmaker(bind=engine)
-        session = session_cl()
-        tmp_object = session.query(trainset.TrainSet).get(object_id)
-        return tmp_object.labels
\ No newline at end of file
+        return self.return_single_labels_many([object_id])[0]
+
+    def return_single_labels_many(self, object_ids):
+        """
+        Returns all labels for several objects specified by their ids (with a single query)
+
+        Parameters
+        ----------
+        object_ids : list of ints, ids of objects in database
+
+        Returns
+        -------
+        result : list of labels (see return_single_labels), one per object id
+        """
+        object_ids = [int(object_id) for object_id in object_ids]
+        session = database.get_session(self.dbpath)
+        try:
+            labels = labelstore.read_rows(session, object_ids)
+        finally:
+            session.close()
+        return [labels.get(object_id) for object_id in object_ids]
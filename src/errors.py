@@ -27,9 +27,27 @@ class EmptyDatabase(Exception):
         return 'Database at ' + str(self.path) + ' is empty, run prepopulate() first'
 
 
+class LegacyDatabase(Exception):
+    def __init__(self, path):
+        self.path = path
+
+    def __str__(self):
+        return 'Database at ' + str(self.path) + ' was created by an older version of the library, open it as a ' + \
+               'dataset once to migrate it'
+
+
 class WrongSize(Exception):
     def __init__(self, name):
         self.name = name
 
     def __str__(self):
-        return 'Feature ' + str(self.name) + ' has wrong size, cannot dump to database'
\ No newline at end of file
+        return 'Feature ' + str(self.name) + ' has wrong size, cannot dump to database'
+
+
+class DependencyError(Exception):
+    def __init__(self, name, reason):
+        self.name = name
+        self.reason = reason
+
+    def __str__(self):
+        return 'Feature ' + str(self.name) + ' ' + str(self.reason)
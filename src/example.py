@@ -9,19 +9,34 @@ from os import path
 from skimage.io import imread
 import skimage.filter
 from src.dataset import UnlabeledDataSet, LabeledDataSet
+from src.scheduler import requires
 
 
-def otsu(fpath):
+def grey_image(fpath):
+    """
+    Reads an image as greyscale (used as the loader, so each image is decoded once for all features)
+    """
+    return imread(fpath, as_grey=True)
+
+
+def otsu(img):
     """
     Returns value of otsu threshold for an image
     """
-    img = imread(fpath, as_grey=True)
     thresh = skimage.filter.threshold_otsu(img)
 
     return thresh
 
 
-def otsu_squared(fpath, features):
+def mean_brightness(img):
+    """
+    Returns the mean brightness of an image
+    """
+    return img.mean()
+
+
+@requires('otsu')
+def otsu_squared(img, features):
     """
     Returns squared value of otsu threshold for an image
     """
@@ -54,10 +69,8 @@ traindata = LabeledDataSet(trainset_path, path.dirname(path.realpath(__file__)),
 testdata.prepopulate()
 traindata.prepopulate()
 
-traindata.extract_feature(otsu)
-traindata.extract_feature_dependent_feature(otsu_squared)
-testdata.extract_feature(otsu)
-testdata.extract_feature_dependent_feature(otsu_squared)
+traindata.extract_features([otsu_squared, otsu, mean_brightness], loader=grey_image)
+testdata.extract_features([otsu_squared, otsu, mean_brightness], loader=grey_image)
 
 train_labels = traindata.return_labels_numpy(True)
 
@@ -0,0 +1,165 @@
+"""
+Provides a cache of extracted feature values which can be shared between datasets and databases
+"""
+__author__ = 'George Oblapenko'
+__license__ = "GPL"
+__maintainer__ = "George Oblapenko"
+__email__ = "kunstmord@kunstmord.com"
+
+import cPickle as pickle
+from os import stat
+from os.path import realpath
+from time import time
+from hashlib import sha1
+from sqlalchemy import Column, String, Integer, Float, LargeBinary, MetaData, Table, select, func
+import database
+
+BATCH_SIZE = 500
+
+
+class ExtractionCache:
+    """
+    A cache of extracted feature values, stored in its own SQLite file. A value is identified by the file it was
+    extracted from (either by its contents or by its path, modification time and size), the extractor (its name and
+    code) and the additional arguments of the extractor, so extract_feature can skip the extractor for any file which
+    has already been processed, even if it was done for another dataset or database.
+
+    Initialization parameters
+    ----------
+    path : string, path to the SQLite file of the cache (it is created if it doesn't exist)
+    max_size : int, maximal total size (in bytes) of the cached values, if exceeded, the least recently used values are
+    evicted; if None, the size is not limited. default value: None
+    content_hash : boolean, if True, files are identified by the SHA1 hash of their contents (which survives copying
+    and renaming, but requires reading each file), otherwise, by their path, modification time and size.
+    default value: False
+    """
+    def __init__(self, path, max_size=None, content_hash=False):
+        self.path = path
+        self.max_size = max_size
+        self.content_hash = content_hash
+        self._engine = database.get_engine(path)
+        self._table = Table('extraction cache', MetaData(), Column('key', String(40), primary_key=True),
+                            Column('value', LargeBinary), Column('size', Integer), Column('last_used', Float))
+        self._table.create(bind=self._engine, checkfirst=True)
+
+    def key(self, fpath, extractor, add_args=None):
+        """
+        Returns the key under which the value of an extractor for a file is cached
+
+        Parameters
+        ----------
+        fpath : string, path to the file
+        extractor : function
+        add_args : optional arguments for the extractor. default value: None
+
+        Returns
+        -------
+        key : string
+        """
+        key = sha1()
+        if self.content_hash is True:
+            with open(fpath, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    key.update(block)
+        else:
+            f_stat = stat(fpath)
+            key.update(repr((realpath(fpath), f_stat.st_mtime, f_stat.st_size)))
+        key.update(extractor.__module__ + '.' + extractor.__name__)
+        code = getattr(extractor, '__code__', None)
+        if code is not None:
+            key.update(code.co_code)
+            key.update(repr(code.co_consts))
+        key.update(pickle.dumps(add_args, pickle.HIGHEST_PROTOCOL))
+        return key.hexdigest()
+
+    def get_many(self, keys):
+        """
+        Returns the cached values for a list of keys
+
+        Parameters
+        ----------
+        keys : list of strings
+
+        Returns
+        -------
+        values : dict mapping keys to values, keys which are not in the cache are missing
+        """
+        values = {}
+        table = self._table
+        with self._engine.begin() as connection:
+            for start in xrange(0, len(keys), BATCH_SIZE):
+                batch = keys[start:start + BATCH_SIZE]
+                found = []
+                for key, value in connection.execute(select([table.c.key, table.c.value])
+                                                     .where(table.c.key.in_(batch))):
+                    values[key] = pickle.loads(value)
+                    found.append(key)
+                if len(found) > 0:
+                    connection.execute(table.update().where(table.c.key.in_(found)).values(last_used=time()))
+        return values
+
+    def put_many(self, values):
+        """
+        Stores values in the cache (and evicts the least recently used ones if the cache is too big)
+
+        Parameters
+        ----------
+        values : dict mapping keys to values
+
+        Returns
+        -------
+        None
+        """
+        if len(values) == 0:
+            return None
+        now = time()
+        rows = []
+        for key, value in values.iteritems():
+            value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            rows.append({'key': key, 'value': value, 'size': len(value), 'last_used': now})
+        with self._engine.begin() as connection:
+            connection.execute(self._table.insert().prefix_with('OR REPLACE'), rows)
+        if self.max_size is not None:
+            self.evict(self.max_size)
+        return None
+
+    def evict(self, max_size):
+        """
+        Removes the least recently used values until the total size of the cache is at most max_size
+
+        Parameters
+        ----------
+        max_size : int, size in bytes
+
+        Returns
+        -------
+        None
+        """
+        table = self._table
+        with self._engine.begin() as connection:
+            total = connection.execute(select([func.coalesce(func.sum(table.c.size), 0)])).scalar()
+            if total <= max_size:
+                return None
+            evicted = []
+            for key, size in connection.execute(select([table.c.key, table.c.size]).order_by(table.c.last_used)):
+                if total <= max_size:
+                    break
+                evicted.append(key)
+                total -= size
+            for start in xrange(0, len(evicted), BATCH_SIZE):
+                connection.execute(table.delete().where(table.c.key.in_(evicted[start:start + BATCH_SIZE])))
+        return None
+
+    def clear(self):
+        """
+        Removes all values from the cache
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        None
+        """
+        self._engine.execute(self._table.delete())
+        return None
@@ -0,0 +1,155 @@
+"""
+Provides FeatureMatrix, a lazy view of the features of a dataset as a 2d array (one row per data point, 1d array
+features unrolled into several columns, as in return_features_numpy). Creating the view only reads the descriptions of
+the features and the ids of the data points; indexing it (X[rows, cols]) reads only the requested data points and only
+the features which have a requested column.
+"""
+__author__ = 'George Oblapenko'
+__license__ = "GPL"
+__maintainer__ = "George Oblapenko"
+__email__ = "kunstmord@kunstmord.com"
+
+import numpy as np
+import errors
+import database
+import featurestore
+
+# if the requested rows cover less than 1 / SPARSE_RATIO of the id range they span, they are read by id, otherwise,
+# the whole range is read with a single range query
+SPARSE_RATIO = 4
+
+
+class FeatureMatrix:
+    """
+    A lazy 2d view of features (see the module docstring), returned by DataSetBase.return_feature_matrix. Supports
+    numpy-like indexing, X[rows] and X[rows, cols], where rows are ints, slices, lists or arrays of ints, or boolean
+    masks, and cols can also be feature names (or lists of names, a name selects all the columns of a feature). Rows
+    and columns are selected independently (X[rows, cols] is X[rows][:, cols], also for lists of both), the result is
+    a numpy array of floats. The view reflects the features and data points which existed when it was created.
+
+    Initialization parameters
+    ----------
+    dbpath : string, path to SQLite database file
+    set_object : object (either TestSet or TrainSet) which is stored in the database
+    names : list of strings, names of the features, if equal to 'all', all features are used (in the order they were
+    created). default value: 'all'
+    """
+    def __init__(self, dbpath, set_object, names='all'):
+        self.dbpath = dbpath
+        self._set_object = set_object
+        session = database.get_session(dbpath)
+        try:
+            self._infos = featurestore.feature_infos(session, names)
+            self._ids = np.array([row_id for (row_id,) in session.query(set_object.id)
+                                  .filter(set_object.deleted.isnot(True)).order_by(set_object.id)], dtype=np.int64)
+        finally:
+            session.close()
+        self.columns = []
+        self._spans = []
+        for info in self._infos:
+            start = len(self.columns)
+            if info.kind == 'array':
+                self.columns.extend(info.name + '[' + str(a) + ']' for a in xrange(info.length))
+            else:
+                self.columns.append(info.name)
+            self._spans.append((start, len(self.columns)))
+        self.names = [info.name for info in self._infos]
+
+    @property
+    def shape(self):
+        return len(self._ids), len(self.columns)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __array__(self, dtype=None):
+        if dtype is None:
+            return self[:, :]
+        return self[:, :].astype(dtype)
+
+    @property
+    def ids(self):
+        """
+        Ids of the data points, the i-th row of the matrix corresponds to ids[i]
+        """
+        return self._ids.copy()
+
+    def column_index(self, name):
+        """
+        Returns the columns of a feature: an int for a scalar feature, a slice for an array feature
+        """
+        if name not in self.names:
+            raise errors.InsufficientData(name, 'feature')
+        info = self._infos[self.names.index(name)]
+        start, end = self._spans[self.names.index(name)]
+        if info.kind == 'array':
+            return slice(start, end)
+        return start
+
+    def _column_positions(self, cols):
+        """
+        Converts a column index into an array of column positions
+        """
+        if isinstance(cols, basestring):
+            cols = self.column_index(cols)
+        elif isinstance(cols, (list, tuple)) and len(cols) > 0 and isinstance(cols[0], basestring):
+            positions = []
+            for name in cols:
+                index = self.column_index(name)
+                if isinstance(index, slice):
+                    positions.extend(xrange(index.start, index.stop))
+                else:
+                    positions.append(index)
+            return np.array(positions, dtype=np.int64)
+        return np.arange(len(self.columns), dtype=np.int64)[cols].reshape(-1)
+
+    def _read(self, positions, columns):
+        """
+        Reads the values of the given rows and columns (1d arrays of positions) into a 2d array
+        """
+        result = np.zeros([len(positions), len(columns)])
+        if len(positions) == 0 or len(columns) == 0:
+            return result
+        row_ids = self._ids[positions]
+        unique_ids = np.unique(row_ids)
+        sparse = (unique_ids[-1] - unique_ids[0] + 1) > SPARSE_RATIO * len(unique_ids)
+        session = database.get_session(self.dbpath)
+        try:
+            for info, (start, end) in zip(self._infos, self._spans):
+                selected = np.nonzero((columns >= start) & (columns < end))[0]
+                if len(selected) == 0:
+                    continue
+                if sparse:
+                    ids, values = featurestore.read_numpy(session, info, ids=unique_ids.tolist())
+                else:
+                    ids, values = featurestore.read_numpy(session, info, int(unique_ids[0]), int(unique_ids[-1]))
+                rows = np.searchsorted(ids, row_ids)
+                rows[rows == len(ids)] = 0
+                found = ids[rows] == row_ids if len(ids) > 0 else np.zeros(len(row_ids), dtype=bool)
+                if not found.all():
+                    missing_path = session.query(self._set_object).get(int(row_ids[np.argmin(found)])).path
+                    raise errors.InsufficientData(info.name, 'feature', missing_path)
+                if info.kind == 'array':
+                    result[:, selected] = values[rows[:, np.newaxis], columns[selected] - start]
+                else:
+                    result[:, selected] = values[rows][:, np.newaxis]
+        finally:
+            session.close()
+        return result
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            if len(key) != 2:
+                raise IndexError('FeatureMatrix supports 2 indices, got ' + str(len(key)))
+            rows, cols = key
+        else:
+            rows, cols = key, slice(None)
+        positions = np.arange(len(self._ids), dtype=np.int64)[rows].reshape(-1)
+        columns = self._column_positions(cols)
+        result = self._read(positions, columns)
+        if isinstance(cols, (int, long, np.integer)) or \
+                (isinstance(cols, basestring) and not isinstance(self.column_index(cols), slice)):
+            result = result[:, 0]
+        if isinstance(rows, (int, long, np.integer)):
+            result = result[0]
+        return result
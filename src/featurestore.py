@@ -0,0 +1,695 @@
+"""
+Provides per-feature (columnar) storage for extracted features. Each feature is stored in its own table
+('feature <id>') with one row per data point, so reading or writing a feature only touches that feature's data.
+Scalars are stored in native REAL/INTEGER columns, numeric numpy arrays as fixed-width BLOBs of their raw buffer
+(their dtype and shape are kept in the 'feature info' table), any other value is pickled. The BLOBs of a feature can be
+compressed with one of the codecs in serialization, chosen when the feature is created.
+"""
+__author__ = 'George Oblapenko'
+__license__ = "GPL"
+__maintainer__ = "George Oblapenko"
+__email__ = "kunstmord@kunstmord.com"
+
+import cPickle as pickle
+from itertools import izip
+import numpy as np
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Column, String, Integer, Float, LargeBinary, MetaData, Table, select, inspect
+import errors
+import serialization
+
+Base = declarative_base()
+metadata = MetaData()
+
+BATCH_SIZE = 1000
+# maximal amount of SELECT statements combined into one query (SQLite allows up to 500)
+COMPOUND_SIZE = 400
+
+_value_tables = {}
+
+
+class FeatureInfo(Base):
+    """
+    SQLAlchemy class describing a stored feature (kind is one of 'real', 'integer', 'array', 'object'; dtype, length
+    (the amount of elements) and shape (comma-separated, only set for arrays with more than one dimension) are only
+    meaningful for arrays; codec is the name of the codec applied to array and object BLOBs, None means 'raw';
+    version is increased every time values of the feature are written)
+    """
+    __tablename__ = 'feature info'
+    # ids are never reused, so a recreated feature can't be mistaken for an older one with the same id
+    __table_args__ = {'sqlite_autoincrement': True}
+    id = Column(Integer, primary_key=True)
+    name = Column(String(120), unique=True)
+    kind = Column(String(10))
+    dtype = Column(String(20))
+    length = Column(Integer)
+    shape = Column(String(60))
+    codec = Column(String(20))
+    version = Column(Integer, default=0)
+
+
+def value_table(info):
+    """
+    Returns the table in which the values of a feature are stored
+
+    Parameters
+    ----------
+    info : FeatureInfo object
+
+    Returns
+    -------
+    table : SQLAlchemy Table with an 'id' column (the id of the data point) and a 'value' column
+    """
+    key = (info.id, info.kind)
+    if key not in _value_tables:
+        if info.kind == 'real':
+            value_type = Float
+        elif info.kind == 'integer':
+            value_type = Integer
+        else:
+            value_type = LargeBinary
+        _value_tables[key] = Table(table_name(info), MetaData(), Column('id', Integer, primary_key=True),
+                                   Column('value', value_type))
+    return _value_tables[key]
+
+
+def table_name(info):
+    """
+    Returns the name of the table in which the values of a feature are stored
+
+    Parameters
+    ----------
+    info : FeatureInfo object
+
+    Returns
+    -------
+    name : string
+    """
+    return 'feature ' + str(info.id)
+
+
+def describe_value(value):
+    """
+    Determines how a feature should be stored, based on one of its values
+
+    Parameters
+    ----------
+    value : a feature value
+
+    Returns
+    -------
+    (kind, dtype, length, shape) : tuple, dtype and length are None unless the value is a numeric numpy array, shape is
+    None unless the array has more than one dimension
+    """
+    if isinstance(value, np.ndarray) and value.ndim >= 1 and value.dtype.kind in 'biuf':
+        if value.ndim == 1:
+            return 'array', value.dtype.str, value.size, None
+        return 'array', value.dtype.str, value.size, ','.join(str(dimension) for dimension in value.shape)
+    if isinstance(value, (bool, int, long, np.integer, np.bool_)):
+        return 'integer', None, None, None
+    if isinstance(value, (float, np.floating)):
+        return 'real', None, None, None
+    return 'object', None, None, None
+
+
+def array_shape(info):
+    """
+    Returns the shape of the arrays of an array feature
+
+    Parameters
+    ----------
+    info : FeatureInfo object
+
+    Returns
+    -------
+    shape : tuple of ints
+    """
+    if info.shape is None:
+        return (info.length,)
+    return tuple(int(dimension) for dimension in info.shape.split(','))
+
+
+def encode_value(info, value):
+    """
+    Converts a feature value into the form in which it is stored in the database
+
+    Parameters
+    ----------
+    info : FeatureInfo object
+    value : a feature value
+
+    Returns
+    -------
+    The value to be written to the 'value' column
+    """
+    if value is None:
+        return None
+    if info.kind == 'array':
+        value = np.ascontiguousarray(value, dtype=info.dtype)
+        if value.shape != array_shape(info):
+            raise errors.WrongSize(info.name)
+        return serialization.get_codec(info.codec).encode(value.tostring())
+    if info.kind == 'object':
+        return serialization.get_codec(info.codec).encode(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def encode_many(info, values):
+    """
+    Converts a sequence of feature values into the form in which they are written by write_columns; if no codec is
+    used, the rows of a stacked array are not copied (each one becomes a buffer over the array)
+
+    Parameters
+    ----------
+    info : FeatureInfo object
+    values : list of feature values or ndarray (for array features, stacked arrays with one more dimension than the
+    feature, for scalar features, 1d)
+
+    Returns
+    -------
+    A list of values to be written to the 'value' column
+    """
+    shape = array_shape(info) if info.kind == 'array' else None
+    if shape is not None and isinstance(values, np.ndarray) and values.ndim == len(shape) + 1:
+        values = np.ascontiguousarray(values, dtype=info.dtype)
+        if values.shape[1:] != shape:
+            raise errors.WrongSize(info.name)
+        if info.codec is not None:
+            codec = serialization.get_codec(info.codec)
+            return [buffer(codec.encode(row.tostring())) for row in values]
+        row_bytes = values.strides[0]
+        return [buffer(values, a * row_bytes, row_bytes) for a in xrange(values.shape[0])]
+    if info.kind in ('real', 'integer') and isinstance(values, np.ndarray) and values.ndim == 1:
+        return values.tolist()
+    if info.kind in ('array', 'object'):
+        return [None if value is None else buffer(encode_value(info, value)) for value in values]
+    return [encode_value(info, value) for value in values]
+
+
+def decode_value(info, raw):
+    """
+    Converts a value read from the database back into a feature value
+
+    Parameters
+    ----------
+    info : FeatureInfo object
+    raw : the contents of the 'value' column
+
+    Returns
+    -------
+    The feature value
+    """
+    if raw is None:
+        return None
+    if info.kind == 'array':
+        raw = serialization.get_codec(info.codec).decode(raw)
+        return np.frombuffer(raw, dtype=info.dtype).reshape(array_shape(info)).copy()
+    if info.kind == 'object':
+        return pickle.loads(bytes(serialization.get_codec(info.codec).decode(bytes(raw))))
+    return raw
+
+
+def feature_infos(session, names='all'):
+    """
+    Returns the descriptions of stored features
+
+    Parameters
+    ----------
+    session : SQLAlchemy session
+    names : list of strings, if equal to 'all', all features will be returned (in the order they were created),
+    otherwise, the features will be returned in the order of names
+
+    Returns
+    -------
+    infos : list of FeatureInfo objects
+    """
+    if names == 'all':
+        return session.query(FeatureInfo).order_by(FeatureInfo.id).all()
+    infos = dict((info.name, info) for info in session.query(FeatureInfo).filter(FeatureInfo.name.in_(names)))
+    for name in names:
+        if name not in infos:
+            raise errors.InsufficientData(name, 'feature')
+    return [infos[name] for name in names]
+
+
+def feature_info(session, name):
+    """
+    Returns the description of a stored feature or None if it doesn't exist
+
+    Parameters
+    ----------
+    session : SQLAlchemy session
+    name : string, name of the feature
+
+    Returns
+    -------
+    info : FeatureInfo object or None
+    """
+    return session.query(FeatureInfo).filter(FeatureInfo.name == name).first()
+
+
+def create_feature(session, name, kind, dtype=None, length=None, shape=None, codec=None):
+    """
+    Registers a new feature and creates the table for its values
+
+    Parameters
+    ----------
+    session : SQLAlchemy session
+    name : string, name of the feature
+    kind : string, one of 'real', 'integer', 'array', 'object'
+    dtype : string, numpy dtype of the arrays (only for kind 'array')
+    length : int, amount of elements in the arrays (only for kind 'array')
+    shape : string, comma-separated shape of the arrays (only for arrays with more than one dimension)
+    codec : string, name of the codec applied to the stored arrays or pickled objects (see serialization), if None,
+    they are stored as they are. default value: None
+
+    Returns
+    -------
+    info : FeatureInfo object
+    """
+    if codec == 'raw':
+        codec = None
+    if codec is not None:
+        serialization.get_codec(codec)
+    info = FeatureInfo(name=name, kind=kind, dtype=dtype, length=length, shape=shape, codec=codec, version=0)
+    session.add(info)
+    session.flush()
+    value_table(info).create(bind=session.connection())
+    return info
+
+
+def create_feature_for_value(session, name, value, codec=None):
+    """
+    Registers a new feature, the way it is stored is determined by one of its values (see describe_value)
+
+    Parameters
+    ----------
+    session : SQLAlchemy session
+    name : string, name of the feature
+    value : a value of the feature
+    codec : string, name of the codec applied to the stored arrays or pickled objects (see create_feature).
+    default value: None
+
+    Returns
+    -------
+    info : FeatureInfo object
+    """
+    kind, dtype, length, shape = describe_value(value)
+    if kind not in ('array', 'object'):
+        codec = None
+    return create_feature(session, name, kind, dtype, length, shape, codec)
+
+
+def drop_feature(session, info):
+    """
+    Deletes a feature and all its values
+
+    Parameters
+    ----------
+    session : SQLAlchemy session
+    info : FeatureInfo object
+
+    Returns
+    -------
+    None
+    """
+    value_table(info).drop(bind=session.connection())
+    session.delete(info)
+    session.flush()
+    return None
+
+
+def write_values(session, info, rows, replace=True):
+    """
+    Writes encoded values of a feature and increases its version
+
+    Parameters
+    ----------
+    session : SQLAlchemy session
+    info : FeatureInfo object
+    rows : list of dicts with 'id' and 'value' keys, values should already be encoded (see encode_value)
+    replace : boolean, if True, existing values are overwritten, if False, they are kept. default value: True
+
+    Returns
+    -------
+    None
+    """
+    if len(rows) > 0:
+        if replace is True:
+            statement = value_table(info).insert().prefix_with('OR REPLACE')
+        else:
+            statement = value_table(info).insert().prefix_with('OR IGNORE')
+        session.execute(statement, rows)
+        info.version = (info.version or 0) + 1
+    return None
+
+
+def write_columns(session, info, ids, values, replace=True):
+    """
+    Writes the values of a feature for several data points with a single executemany call on the DB-API connection
+    of the session (without building a dictionary per row), and increases the version of the feature
+
+    Parameters
+    ----------
+    session : SQLAlchemy session
+    info : FeatureInfo object
+    ids : list of ints, ids of the data points
+    values : list of values encoded by encode_many, one per id
+    replace : boolean, if True, existing values are overwritten, if False, they are kept. default value: True
+
+    Returns
+    -------
+    None
+    """
+    if len(ids) > 0:
+        if replace is True:
+            statement = 'INSERT OR REPLACE'
+        else:
+            statement = 'INSERT OR IGNORE'
+        cursor = session.connection().connection.cursor()
+        cursor.executemany(statement + ' INTO "' + table_name(info) + '" (id, value) VALUES (?, ?)', izip(ids, values))
+        cursor.close()
+        info.version = (info.version or 0) + 1
+    return None
+
+
+def copy_values(session, origin_info, info, set_object, replace=True, schema='origin'):
+    """
+    Copies the values of a feature from an attached database with a single statement, data points are matched by
+    their real_id (not by their id), and increases the version of the feature
+
+    Parameters
+    ----------
+    session : SQLAlchemy session, its connection should have the origin database attached
+    origin_info : FeatureInfo object of the feature in the origin database
+    info : FeatureInfo object of the feature in the destination database (with the same kind, dtype and length)
+    set_object : object (either TestSet or TrainSet) which is stored in both databases
+    replace : boolean, if True, existing values are overwritten, if False, they are kept. default value: True
+    schema : string, name under which the origin database is attached. default value: 'origin'
+
+    Returns
+    -------
+    result : int, amount of copied values
+    """
+    if replace is True:
+        statement = 'INSERT OR REPLACE'
+    else:
+        statement = 'INSERT OR IGNORE'
+    statement += ' INTO main."' + table_name(info) + '" (id, value) SELECT destination.id, value_origin.value' + \
+                 ' FROM "' + schema + '"."' + table_name(origin_info) + '" AS value_origin' + \
+                 ' JOIN "' + schema + '"."' + set_object.__tablename__ + '" AS set_origin' + \
+                 ' ON set_origin.id = value_origin.id' + \
+                 ' JOIN main."' + set_object.__tablename__ + '" AS destination' + \
+                 ' ON destination.real_id = set_origin.real_id'
+    copied = session.execute(statement).rowcount
+    if copied > 0:
+        info.version = (info.version or 0) + 1
+    return copied
+
+
+def delete_values(session, info, ids):
+    """
+    Deletes the values of a feature for some data points and increases its version
+
+    Parameters
+    ----------
+    session : SQLAlchemy session
+    info : FeatureInfo object
+    ids : list of ints, ids of the data points
+
+    Returns
+    -------
+    None
+    """
+    table = value_table(info)
+    for start in xrange(0, len(ids), BATCH_SIZE):
+        session.execute(table.delete().where(table.c.id.in_(ids[start:start + BATCH_SIZE])))
+    if len(ids) > 0:
+        info.version = (info.version or 0) + 1
+    return None
+
+
+def read_values(session, info, ids=None, decode=True):
+    """
+    Reads the values of a feature
+
+    Parameters
+    ----------
+    session : SQLAlchemy session
+    info : FeatureInfo object
+    ids : list of ints, ids of the data points for which the values are read, if None, all values are read.
+    default value: None
+    decode : boolean, if False, the values are returned as they are stored in the database. default value: True
+
+    Returns
+    -------
+    values : dict mapping data point ids to the feature values (data points without a value are missing)
+    """
+    table = value_table(info)
+    query = select([table.c.id, table.c.value])
+    if ids is None:
+        rows = session.execute(query).fetchall()
+    else:
+        rows = []
+        for start in xrange(0, len(ids), BATCH_SIZE):
+            rows.extend(session.execute(query.where(table.c.id.in_(ids[start:start + BATCH_SIZE]))))
+    if decode is True:
+        return dict((row_id, decode_value(info, raw)) for row_id, raw in rows)
+    return dict(rows)
+
+
+def read_rows(connection, ids):
+    """
+    Reads the values of all features for a few data points, with a single query for up to COMPOUND_SIZE features (the
+    value tables are combined with UNION ALL), which makes per-data point access cheap
+
+    Parameters
+    ----------
+    connection : DB-API connection (for example, engine.raw_connection())
+    ids : list of ints, ids of the data points
+
+    Returns
+    -------
+    features : list of dicts mapping feature names to values, one per id (features without a value are missing)
+    """
+    ids = [int(row_id) for row_id in ids]
+    positions = dict((row_id, a) for a, row_id in enumerate(ids))
+    features = [{} for row_id in ids]
+    cursor = connection.cursor()
+    infos = [FeatureInfo(id=row[0], name=row[1], kind=row[2], dtype=row[3], length=row[4], shape=row[5],
+                         codec=row[6]) for row in
+             cursor.execute('SELECT id, name, kind, dtype, length, shape, codec FROM "feature info" ORDER BY id')]
+    id_list = ', '.join(str(row_id) for row_id in ids)
+    for start in xrange(0, len(infos), COMPOUND_SIZE):
+        query = ' UNION ALL '.join('SELECT ' + str(k) + ', id, value FROM "' + table_name(info) +
+                                   '" WHERE id IN (' + id_list + ')'
+                                   for k, info in enumerate(infos[start:start + COMPOUND_SIZE], start))
+        for k, row_id, raw in cursor.execute(query):
+            features[positions[row_id]][infos[k].name] = decode_value(infos[k], raw)
+    cursor.close()
+    # an id passed more than once gets a copy of the values read for it
+    return [features[a] if positions[row_id] == a else dict(features[positions[row_id]])
+            for a, row_id in enumerate(ids)]
+
+
+def read_numpy(session, info, lower=None, upper=None, ids=None):
+    """
+    Reads the values of a feature with a single query and converts them into a float array without decoding them one
+    by one (arrays are decoded with a single np.frombuffer call on the concatenated BLOBs)
+
+    Parameters
+    ----------
+    session : SQLAlchemy session
+    info : FeatureInfo object
+    lower : int, if not None, only data points with an id bigger than or equal to lower are read. default value: None
+    upper : int, if not None, only data points with an id smaller than or equal to upper are read. default value: None
+    ids : list of ints, if not None, only data points with these ids are read. default value: None
+
+    Returns
+    -------
+    ids : 1d ndarray of ints, ids of the data points for which a value is stored (in increasing order)
+    values : ndarray of floats, 1d for scalar features, 2d (one row per id, arrays with more than one dimension are
+    flattened) for array features
+    """
+    query = 'SELECT id, value FROM "' + table_name(info) + '"'
+    conditions = []
+    parameters = []
+    if lower is not None:
+        conditions.append('id >= ?')
+        parameters.append(lower)
+    if upper is not None:
+        conditions.append('id <= ?')
+        parameters.append(upper)
+    if ids is not None:
+        conditions.append('id IN (' + ', '.join(str(int(row_id)) for row_id in ids) + ')')
+    if len(conditions) > 0:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    cursor = session.connection().connection.cursor()
+    rows = cursor.execute(query + ' ORDER BY id', parameters).fetchall()
+    cursor.close()
+
+    ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    if info.kind == 'array':
+        values = np.empty([len(rows), info.length])
+        if len(rows) > 0:
+            if info.codec is None:
+                data = b''.join(bytes(row[1]) for row in rows)
+            else:
+                codec = serialization.get_codec(info.codec)
+                data = b''.join(bytes(codec.decode(bytes(row[1]))) for row in rows)
+            values[:] = np.frombuffer(data, dtype=info.dtype).reshape(len(rows), info.length)
+    elif info.kind == 'object':
+        values = np.array([decode_value(info, row[1]) for row in rows], dtype=float)
+    else:
+        values = np.array([row[1] for row in rows], dtype=float)
+    return ids, values
+
+
+def add_missing_columns(engine, table):
+    """
+    Adds the columns of a table which are missing in the database (tables created by older versions of the library)
+
+    Parameters
+    ----------
+    engine : SQLAlchemy engine
+    table : SQLAlchemy Table
+
+    Returns
+    -------
+    None
+    """
+    existing = set(column['name'] for column in inspect(engine).get_columns(table.name))
+    for column in table.columns:
+        if column.name not in existing:
+            engine.execute('ALTER TABLE "' + table.name + '" ADD COLUMN "' + column.name + '" ' +
+                           column.type.compile(engine.dialect))
+    return None
+
+
+def add_missing_indexes(engine, table):
+    """
+    Creates the indexes of a table which are missing in the database (tables created by older versions of the library)
+
+    Parameters
+    ----------
+    engine : SQLAlchemy engine
+    table : SQLAlchemy Table
+
+    Returns
+    -------
+    None
+    """
+    for index in table.indexes:
+        engine.execute('CREATE ' + ('UNIQUE ' if index.unique else '') + 'INDEX IF NOT EXISTS "' + index.name +
+                       '" ON "' + table.name + '" (' + ', '.join('"' + column.name + '"' for column in index.columns) +
+                       ')')
+    return None
+
+
+def flag_duplicate_paths(engine, set_object):
+    """
+    Prepares the table of the set object of an older database for the unique index of the paths: older versions of
+    the library stored only the names of the files found in subfolders, so files with the same name in different
+    subfolders have the same path. All these data points but the first one are flagged as deleted and their path is
+    cleared (the next sync adds their files again, with paths relative to the folder of the dataset). Does nothing if
+    the unique index already exists.
+
+    Parameters
+    ----------
+    engine : SQLAlchemy engine
+    set_object : object (either TestSet or TrainSet) which is stored in the database
+
+    Returns
+    -------
+    result : int, amount of flagged data points
+    """
+    table = set_object.__table__
+    index_names = [index.name for index in table.indexes if index.unique]
+    existing = set(row[0] for row in engine.execute("SELECT name FROM sqlite_master WHERE type = 'index'"))
+    if all(name in existing for name in index_names):
+        return 0
+    duplicate_ids = [row[0] for row in engine.execute(
+        'SELECT id FROM "' + table.name + '" WHERE path IS NOT NULL AND id NOT IN (SELECT MIN(id) FROM "' +
+        table.name + '" WHERE path IS NOT NULL GROUP BY path)')]
+    for start in xrange(0, len(duplicate_ids), BATCH_SIZE):
+        engine.execute(table.update().where(table.c.id.in_(duplicate_ids[start:start + BATCH_SIZE]))
+                       .values(path=None, deleted=True))
+    return len(duplicate_ids)
+
+
+def needs_migration(connection, set_object, schema='main'):
+    """
+    Checks, without changing the database, whether it was created by an older version of the library and has to be
+    migrated by ensure_schema (the 'feature info' table or some of its columns are missing, or features are still
+    stored in the 'features' column)
+
+    Parameters
+    ----------
+    connection : SQLAlchemy connection
+    set_object : object (either TestSet or TrainSet) which is stored in the database
+    schema : string, name of the database on the connection (for example, the name under which it is attached).
+    default value: 'main'
+
+    Returns
+    -------
+    result : boolean
+    """
+    cursor = connection.connection.cursor()
+    try:
+        def columns(table):
+            return set(row[1] for row in cursor.execute('PRAGMA "' + schema + '".table_info("' + table + '")'))
+        if not set(column.name for column in FeatureInfo.__table__.columns) <= columns(FeatureInfo.__tablename__):
+            return True
+        if 'features' in columns(set_object.__tablename__):
+            return cursor.execute('SELECT 1 FROM "' + schema + '"."' + set_object.__tablename__ +
+                                  '" WHERE features IS NOT NULL LIMIT 1').fetchone() is not None
+        return False
+    finally:
+        cursor.close()
+
+
+def ensure_schema(engine, set_object):
+    """
+    Creates the 'feature info' table if it doesn't exist, adds the columns missing in it and in the table of the set
+    object, and moves features stored by older versions (a pickled dictionary per data point, in the 'features'
+    column) into per-feature tables; the indexes missing in the table of the set object are created as well (data
+    points with duplicate paths are flagged as deleted first, see flag_duplicate_paths)
+
+    Parameters
+    ----------
+    engine : SQLAlchemy engine
+    set_object : object (either TestSet or TrainSet) which is stored in the database
+
+    Returns
+    -------
+    None
+    """
+    Base.metadata.create_all(engine)
+    add_missing_columns(engine, FeatureInfo.__table__)
+    add_missing_columns(engine, set_object.__table__)
+    flag_duplicate_paths(engine, set_object)
+    add_missing_indexes(engine, set_object.__table__)
+    session_cl = sessionmaker(bind=engine)
+    session = session_cl()
+    infos = dict((info.name, info) for info in session.query(FeatureInfo))
+    while True:
+        legacy_rows = session.query(set_object).filter(set_object.features.isnot(None)).order_by(set_object.id)\
+            .limit(BATCH_SIZE).all()
+        if len(legacy_rows) == 0:
+            break
+        new_values = {}
+        for i in legacy_rows:
+            for feature, value in i.features.items():
+                if feature not in infos:
+                    infos[feature] = create_feature_for_value(session, feature, value)
+                new_values.setdefault(feature, []).append({'id': i.id,
+                                                           'value': encode_value(infos[feature], value)})
+            i.features = None
+        for feature in new_values:
+            write_values(session, infos[feature], new_values[feature])
+        session.commit()
+    session.close()
+    return None
@@ -0,0 +1,236 @@
+"""
+Provides Metrics, which collects timings while features are extracted or read: the total time spent in each stage
+(for example, 'db read', 'file io', 'extractor', 'serialization', 'commit'), a latency histogram per extractor and the
+progress of the operation (rows per second, ETA). Every dataset has a Metrics object (DataSetBase.metrics), which is
+reset at the start of each instrumented operation; callbacks added to it receive progress events during the operation.
+"""
+__author__ = 'George Oblapenko'
+__license__ = "GPL"
+__maintainer__ = "George Oblapenko"
+__email__ = "kunstmord@kunstmord.com"
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import time
+
+# upper bounds (in seconds) of the buckets of the latency histograms, the last bucket has no upper bound
+LATENCY_BOUNDS = (1e-5, 3e-5, 1e-4, 3e-4, 1e-3, 3e-3, 1e-2, 3e-2, 0.1, 0.3, 1., 3., 10.)
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets (see LATENCY_BOUNDS)
+    """
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.
+        self.min = None
+        self.max = None
+
+    def add(self, seconds):
+        """
+        Adds a measurement to the histogram
+        """
+        self.counts[bisect_left(LATENCY_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def as_dict(self):
+        """
+        Returns the histogram as a dictionary: bucket bounds and counts, amount of measurements, mean, min and max
+        """
+        return {'bounds': list(LATENCY_BOUNDS), 'counts': list(self.counts), 'count': self.count,
+                'mean': self.total / self.count if self.count > 0 else None, 'min': self.min, 'max': self.max}
+
+
+class Metrics:
+    """
+    Collects the timings of an operation (see the module docstring). Stage times measured in worker processes are
+    summed, so with n_jobs > 1 they can be bigger than the wall-clock time of the operation.
+
+    Initialization parameters
+    ----------
+    callbacks : list of functions, each is called with an event dictionary (see add_callback). default value: None
+    report_every : float, minimal amount of seconds between two 'progress' events. default value: 1.0
+    """
+    def __init__(self, callbacks=None, report_every=1.0):
+        self.callbacks = list(callbacks or [])
+        self.report_every = report_every
+        self.reset()
+
+    def reset(self, operation=None, total=None):
+        """
+        Clears the collected timings
+
+        Parameters
+        ----------
+        operation : string, name of the operation which is measured next. default value: None
+        total : int, amount of rows the operation will process (used for the ETA), if known. default value: None
+
+        Returns
+        -------
+        None
+        """
+        self.operation = operation
+        self.total = total
+        self.done = 0
+        self.stages = {}
+        self.latencies = {}
+        self._started = time()
+        self._finished = None
+        self._reported = self._started
+        return None
+
+    def add_callback(self, callback):
+        """
+        Adds a function which is called with an event dictionary (see as_dict, plus the 'event' key, equal to 'start',
+        'progress' or 'finish') at the start and the end of each operation and, while it runs, at most every
+        report_every seconds
+
+        Parameters
+        ----------
+        callback : function
+
+        Returns
+        -------
+        None
+        """
+        self.callbacks.append(callback)
+        return None
+
+    def _emit(self, event):
+        if len(self.callbacks) > 0:
+            data = self.as_dict()
+            data['event'] = event
+            for callback in self.callbacks:
+                callback(data)
+
+    def start(self, operation, total=None):
+        """
+        Resets the timings (see reset) and sends a 'start' event to the callbacks
+        """
+        self.reset(operation, total)
+        self._emit('start')
+        return None
+
+    def set_total(self, total):
+        """
+        Sets the amount of rows the operation will process (when it becomes known after the start)
+        """
+        self.total = total
+        return None
+
+    def advance(self, amount=1):
+        """
+        Marks rows as processed, sends a 'progress' event if the last one was sent more than report_every seconds ago
+        """
+        self.done += amount
+        if len(self.callbacks) > 0 and time() - self._reported >= self.report_every:
+            self._reported = time()
+            self._emit('progress')
+        return None
+
+    def finish(self):
+        """
+        Stops the clock of the operation and sends a 'finish' event to the callbacks
+        """
+        self._finished = time()
+        self._emit('finish')
+        return None
+
+    def add_time(self, stage, seconds, calls=1):
+        """
+        Adds time spent in a stage
+        """
+        if stage in self.stages:
+            self.stages[stage][0] += seconds
+            self.stages[stage][1] += calls
+        else:
+            self.stages[stage] = [seconds, calls]
+        return None
+
+    @contextmanager
+    def timer(self, stage):
+        """
+        Context manager which adds the time spent in its block to a stage
+        """
+        start = time()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time() - start)
+
+    def record_latency(self, name, seconds, stage='extractor'):
+        """
+        Adds a single call of an extractor (or loader) to its latency histogram and to a stage
+        """
+        if name not in self.latencies:
+            self.latencies[name] = Histogram()
+        self.latencies[name].add(seconds)
+        self.add_time(stage, seconds)
+        return None
+
+    @property
+    def elapsed(self):
+        """
+        Wall-clock time of the operation (so far, if it is still running)
+        """
+        if self._finished is not None:
+            return self._finished - self._started
+        return time() - self._started
+
+    @property
+    def rate(self):
+        """
+        Processed rows per second
+        """
+        elapsed = self.elapsed
+        if elapsed <= 0:
+            return None
+        return self.done / elapsed
+
+    @property
+    def eta(self):
+        """
+        Estimated amount of seconds until the operation is finished (None if the total amount of rows is unknown)
+        """
+        rate = self.rate
+        if self.total is None or not rate:
+            return None
+        return max(self.total - self.done, 0) / rate
+
+    def as_dict(self):
+        """
+        Returns the collected metrics
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        metrics : dict with the 'operation', 'total' and 'done' rows, 'elapsed' seconds, 'rate' (rows per second),
+        'eta' (seconds), 'stages' (a dict mapping stage names to {'seconds', 'calls'} dicts) and 'latencies' (a dict
+        mapping extractor names to histograms, see Histogram.as_dict)
+        """
+        return {'operation': self.operation, 'total': self.total, 'done': self.done, 'elapsed': self.elapsed,
+                'rate': self.rate, 'eta': self.eta,
+                'stages': dict((stage, {'seconds': seconds, 'calls': calls})
+                               for stage, (seconds, calls) in self.stages.iteritems()),
+                'latencies': dict((name, histogram.as_dict()) for name, histogram in self.latencies.iteritems())}
+
+
+@contextmanager
+def maybe_timer(metrics, stage):
+    """
+    Same as metrics.timer(stage), does nothing if metrics is None
+    """
+    if metrics is None:
+        yield
+    else:
+        with metrics.timer(stage):
+            yield
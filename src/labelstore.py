@@ -0,0 +1,290 @@
+"""
+Provides numeric storage for the labels of a labeled dataset. The labels of a data point are stored in the 'labels'
+table as fixed-width BLOBs of float64 values (the amount of labels per data point is kept in the 'label info' table),
+so all labels are read with a single query and decoded with a single np.frombuffer call. Original labels which are
+not numbers are pickled.
+"""
+__author__ = 'George Oblapenko'
+__license__ = "GPL"
+__maintainer__ = "George Oblapenko"
+__email__ = "kunstmord@kunstmord.com"
+
+import csv
+import cPickle as pickle
+from itertools import izip
+import numpy as np
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Column, String, Integer, LargeBinary, select
+import errors
+
+Base = declarative_base()
+
+BATCH_SIZE = 1000
+
+
+class LabelInfo(Base):
+    """
+    SQLAlchemy class describing the stored labels (a single row: width is the amount of labels per data point,
+    original_kind is 'real' if the original labels are numbers, 'object' otherwise)
+    """
+    __tablename__ = 'label info'
+    id = Column(Integer, primary_key=True)
+    width = Column(Integer)
+    original_kind = Column(String(10))
+
+
+class Labels(Base):
+    """
+    SQLAlchemy class for the labels of a data point (id is the id of the data point)
+    """
+    __tablename__ = 'labels'
+    id = Column(Integer, primary_key=True)
+    original = Column(LargeBinary)
+    transformed = Column(LargeBinary)
+
+
+def parse_csv(path, delimiter=',', header=True):
+    """
+    Reads a CSV file of labels, the first column of which contains the real_id's of data points and the other columns
+    contain their labels
+
+    Parameters
+    ----------
+    path : string, path to the CSV file
+    delimiter : string, the delimiter used in the file. default value: ','
+    header : boolean, if True, the first row of the file is a header row and is skipped. default value: True
+
+    Returns
+    -------
+    real_ids : 1d ndarray of strings
+    fields : 2d ndarray of strings, one row per real_id
+    """
+    with open(path, 'rb') as f:
+        rows = [row for row in csv.reader(f, delimiter=delimiter) if len(row) > 0]
+    if header is True:
+        rows = rows[1:]
+    if len(rows) == 0:
+        return np.zeros(0, dtype=str), np.zeros([0, 0], dtype=str)
+    table = np.array(rows, dtype=str)
+    if table.ndim != 2:
+        raise errors.WrongSize('labels (rows of ' + str(path) + ' have different lengths)')
+    return np.char.strip(table[:, 0]), table[:, 1:]
+
+
+def transform_labels(fields, label_dict=None):
+    """
+    Converts the labels read from a CSV file into numbers; labels found in label_dict are replaced by their mapped
+    values, labels which are numbers are kept as they are (the mapping is applied once per distinct label of a column)
+
+    Parameters
+    ----------
+    fields : 2d ndarray of strings (see parse_csv), surrounding whitespace is ignored
+    label_dict : dict, defines a custom mapping of labels (keys are compared with the labels as strings), if None,
+    each distinct label of a column which is not a number is replaced by its index in the sorted list of the distinct
+    labels of this column which are not numbers. default value: None
+
+    Returns
+    -------
+    original_kind : string, 'real' if the original labels are numbers, 'object' otherwise
+    original : 2d ndarray of original labels, of floats if original_kind is 'real', of strings otherwise
+    transformed : 2d ndarray of floats
+    """
+    try:
+        original = fields.astype(np.float64)
+        original_kind = 'real'
+    except ValueError:
+        original = np.char.strip(fields)
+        original_kind = 'object'
+    if original_kind == 'real' and label_dict is None:
+        return original_kind, original, original
+    if label_dict is None:
+        lookup = {}
+    else:
+        lookup = dict((str(key), value) for key, value in label_dict.iteritems())
+    transformed = np.empty(fields.shape)
+    for column in xrange(fields.shape[1]):
+        # labels are stripped and mapped once per distinct value of the column
+        distinct, inverse = np.unique(fields[:, column], return_inverse=True)
+        distinct = np.char.strip(distinct)
+        mapped = np.empty(len(distinct))
+        unknown = []
+        for a, label in enumerate(distinct):
+            try:
+                mapped[a] = float(lookup.get(label, label))
+            except ValueError:
+                if label_dict is not None:
+                    raise errors.InsufficientData(label, 'label mapping')
+                unknown.append(a)
+        codes = dict((label, code) for code, label in enumerate(sorted(set(distinct[unknown]))))
+        for a in unknown:
+            mapped[a] = codes[distinct[a]]
+        transformed[:, column] = mapped[inverse]
+    return original_kind, original, transformed
+
+
+def store_labels(session, set_object, real_ids, original_kind, original, transformed):
+    """
+    Replaces the stored labels: the labels of each data point are found by its real_id (with a dictionary, in a single
+    pass over the data points), data points without labels get none
+
+    Parameters
+    ----------
+    session : SQLAlchemy session
+    set_object : object (TrainSet) which is stored in the database
+    real_ids : 1d ndarray of strings (see parse_csv)
+    original_kind : string (see transform_labels)
+    original : 2d ndarray of original labels (see transform_labels)
+    transformed : 2d ndarray of transformed labels (see transform_labels)
+
+    Returns
+    -------
+    result : int, amount of data points which have labels
+    """
+    row_index = dict(izip(real_ids.tolist(), xrange(len(real_ids))))
+    transformed = np.ascontiguousarray(transformed, dtype=np.float64)
+    if original_kind == 'real':
+        original = np.ascontiguousarray(original, dtype=np.float64)
+    table = set_object.__table__
+    rows = []
+    for row_id, real_id in session.execute(select([table.c.id, table.c.real_id])):
+        a = row_index.get(real_id)
+        if a is None:
+            continue
+        if original_kind == 'real':
+            original_value = original[a].tostring()
+        else:
+            original_value = pickle.dumps(original[a].tolist(), pickle.HIGHEST_PROTOCOL)
+        rows.append({'id': row_id, 'original': original_value, 'transformed': transformed[a].tostring()})
+    session.execute(Labels.__table__.delete())
+    session.execute(LabelInfo.__table__.delete())
+    session.add(LabelInfo(id=1, width=transformed.shape[1], original_kind=original_kind))
+    if len(rows) > 0:
+        session.execute(Labels.__table__.insert(), rows)
+    session.commit()
+    return len(rows)
+
+
+def label_info(session):
+    """
+    Returns the LabelInfo object of the database, or None if no labels are stored
+    """
+    return session.query(LabelInfo).get(1)
+
+
+def _decode_rows(info, rows, original):
+    """
+    Converts (id, BLOB) rows read from the 'labels' table into an array of ids and a 2d array of labels
+    """
+    ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    if original is True and info.original_kind == 'object':
+        values = np.array([pickle.loads(bytes(row[1])) for row in rows], dtype=str).reshape(len(rows), info.width)
+    else:
+        values = np.empty([len(rows), info.width])
+        if len(rows) > 0:
+            values[:] = np.frombuffer(b''.join(bytes(row[1]) for row in rows),
+                                      dtype=np.float64).reshape(len(rows), info.width)
+    return ids, values
+
+
+def read_numpy(session, original=False, lower=None, upper=None):
+    """
+    Reads the stored labels with a single query
+
+    Parameters
+    ----------
+    session : SQLAlchemy session
+    original : boolean, if True, the original labels are read, otherwise, the transformed ones. default value: False
+    lower : int, if not None, only data points with an id bigger than or equal to lower are read. default value: None
+    upper : int, if not None, only data points with an id smaller than or equal to upper are read. default value: None
+
+    Returns
+    -------
+    ids : 1d ndarray of ints, ids of the data points which have labels (in increasing order)
+    values : 2d ndarray (one row per id), of floats, or of strings for original labels which are not numbers
+    """
+    info = label_info(session)
+    if info is None:
+        return np.zeros(0, dtype=np.int64), np.zeros([0, 0])
+    if original is True:
+        query = 'SELECT id, original FROM labels'
+    else:
+        query = 'SELECT id, transformed FROM labels'
+    conditions = []
+    parameters = []
+    if lower is not None:
+        conditions.append('id >= ?')
+        parameters.append(lower)
+    if upper is not None:
+        conditions.append('id <= ?')
+        parameters.append(upper)
+    if len(conditions) > 0:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    cursor = session.connection().connection.cursor()
+    rows = cursor.execute(query + ' ORDER BY id', parameters).fetchall()
+    cursor.close()
+    return _decode_rows(info, rows, original)
+
+
+def read_rows(session, ids):
+    """
+    Reads the labels of several data points
+
+    Parameters
+    ----------
+    session : SQLAlchemy session
+    ids : list of ints, ids of the data points
+
+    Returns
+    -------
+    labels : dict mapping ids to {'original': list, 'transformed': list} dictionaries, ids without labels are missing
+    """
+    info = label_info(session)
+    labels = {}
+    if info is None:
+        return labels
+    table = Labels.__table__
+    for start in xrange(0, len(ids), BATCH_SIZE):
+        rows = session.execute(select([table.c.id, table.c.original, table.c.transformed])
+                               .where(table.c.id.in_(ids[start:start + BATCH_SIZE]))).fetchall()
+        original = _decode_rows(info, [(row[0], row[1]) for row in rows], True)[1]
+        transformed = _decode_rows(info, [(row[0], row[2]) for row in rows], False)[1]
+        for a, row in enumerate(rows):
+            labels[row[0]] = {'original': original[a].tolist(), 'transformed': transformed[a].tolist()}
+    return labels
+
+
+def ensure_schema(engine, set_object):
+    """
+    Creates the label tables if they don't exist and moves labels stored by older versions (a pickled dictionary per
+    data point, in the 'labels' column of the set object) into them
+
+    Parameters
+    ----------
+    engine : SQLAlchemy engine
+    set_object : object (TrainSet) which is stored in the database
+
+    Returns
+    -------
+    None
+    """
+    Base.metadata.create_all(engine)
+    session_cl = sessionmaker(bind=engine)
+    session = session_cl()
+    legacy_rows = session.query(set_object.id, set_object.real_id, set_object.labels)\
+        .filter(set_object.labels.isnot(None)).order_by(set_object.id).all()
+    if len(legacy_rows) > 0:
+        real_ids = np.array([row[1] for row in legacy_rows], dtype=object)
+        original = np.array([row[2]['original'] for row in legacy_rows])
+        transformed = np.array([row[2]['transformed'] for row in legacy_rows], dtype=np.float64)
+        try:
+            original = original.astype(np.float64)
+            original_kind = 'real'
+        except ValueError:
+            original = original.astype(str)
+            original_kind = 'object'
+        store_labels(session, set_object, real_ids, original_kind, original, transformed)
+        session.execute(set_object.__table__.update().values(labels=None))
+        session.commit()
+    session.close()
+    return None
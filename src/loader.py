@@ -0,0 +1,153 @@
+"""
+Provides DataLoader, which iterates over the data points of a dataset in (shuffled) batches, converting the files of the
+upcoming batches in background workers, so that file decoding overlaps with the processing of the current batch
+"""
+__author__ = 'George Oblapenko'
+__license__ = "GPL"
+__maintainer__ = "George Oblapenko"
+__email__ = "kunstmord@kunstmord.com"
+
+from threading import Thread, Event
+from Queue import Queue, Full, Empty
+from itertools import izip
+import numpy as np
+import dataset
+
+
+class DataLoader:
+    """
+    Iterates over the data points of a dataset in batches of converted files (one pass over the dataset per
+    iteration). The ids (and labels, for a labeled dataset) are read once per pass, the files of the upcoming batches
+    are converted in a background thread with DataSetBase.iter_convert_numpy (which runs the converter in a pool of
+    workers if n_jobs is not 1) and the ready batches are queued.
+
+    Initialization parameters
+    ----------
+    data_set : UnlabeledDataSet or LabeledDataSet object (prepopulated)
+    converter : function, which takes the path of a data point and *args as parameters and returns a numpy array
+    (arrays with more than one dimension are flattened)
+    batch_size : int, maximal amount of data points in a batch. default value: 32
+    shuffle : boolean, if True, the order of the data points is shuffled on each pass. default value: True
+    add_args : optional arguments for the converter (list/dictionary/tuple/whatever). if None, the
+    converter should take only one input argument - the file path. default value: None
+    n_jobs : int, number of workers running the converter, if equal to -1, one worker per CPU is used.
+    default value: 1
+    backend : string, 'thread' or 'process', the kind of pool created when n_jobs is not 1 (with 'process', the
+    converter must be picklable). default value: 'thread'
+    prefetch : int, maximal amount of ready batches waiting to be used. default value: 2
+    original : if True, will return original labels, if False, will return transformed labels (as defined by
+    label_dict), ignored for unlabeled datasets. default value: False
+    drop_last : boolean, if True, the last batch is skipped if it is smaller than batch_size. default value: False
+    seed : int or None, seed of the random generator used for shuffling. default value: None
+    """
+    def __init__(self, data_set, converter, batch_size=32, shuffle=True, add_args=None, n_jobs=1, backend='thread',
+                 prefetch=2, original=False, drop_last=False, seed=None):
+        self.data_set = data_set
+        self.converter = converter
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.add_args = add_args
+        self.n_jobs = n_jobs
+        self.backend = backend
+        self.prefetch = prefetch
+        self.original = original
+        self.drop_last = drop_last
+        self._random = np.random.RandomState(seed)
+
+    def __len__(self):
+        if self.drop_last is True:
+            return self.data_set.points_amt // self.batch_size
+        return (self.data_set.points_amt + self.batch_size - 1) // self.batch_size
+
+    def _read_ids(self):
+        """
+        Returns the ids of the data points in the order of the current pass and their labels (or None)
+        """
+        ids = np.array([row[0] for row in self.data_set.return_paths()], dtype=np.int64)
+        if self.shuffle is True:
+            ids = ids[self._random.permutation(len(ids))]
+        if self.drop_last is True:
+            ids = ids[:len(ids) - len(ids) % self.batch_size]
+        if not isinstance(self.data_set, dataset.LabeledDataSet):
+            return ids, None
+        return ids, self.data_set.return_labels_numpy(self.original, ids)
+
+    def _produce(self, ids, labels, batches, stop):
+        """
+        Converts the files batch by batch (see DataSetBase.iter_convert_numpy) and puts (ids, X, y) tuples into the
+        batches queue, followed by None (or by the exception raised by the converter); stops early if the stop event is
+        set
+        """
+        results = self.data_set.iter_convert_numpy(1, -1, self.converter, self.add_args, self.batch_size, self.n_jobs,
+                                                   backend=self.backend,
+                                                   prefetch=max(self.batch_size, 1) * max(self.prefetch, 1),
+                                                   object_ids=ids)
+        try:
+            for start, (batch_ids, features) in izip(xrange(0, len(ids), self.batch_size), results):
+                if labels is None:
+                    batch_labels = None
+                else:
+                    batch_labels = labels[start:start + self.batch_size]
+                if self._put(batches, (batch_ids, features, batch_labels), stop) is False:
+                    return None
+            self._put(batches, None, stop)
+        except Exception as e:
+            self._put(batches, e, stop)
+        finally:
+            results.close()
+        return None
+
+    @staticmethod
+    def _put(batches, item, stop):
+        """
+        Puts an item into the queue, waiting for a free slot unless the stop event is set; returns False if stopped
+        """
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def iter_with_ids(self):
+        """
+        Iterates over the dataset once, see DataLoader
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        A generator of (ids, X, y) tuples: ids is a 1d numpy array of data point ids, X is a 2d numpy array with one
+        converted file per row, y is a 2d numpy array of labels (None for an unlabeled dataset)
+        """
+        ids, labels = self._read_ids()
+        batches = Queue(max(self.prefetch, 1))
+        stop = Event()
+        producer = Thread(target=self._produce, args=(ids, labels, batches, stop))
+        producer.daemon = True
+        producer.start()
+        try:
+            while True:
+                try:
+                    item = batches.get(timeout=0.1)
+                except Empty:
+                    if not producer.is_alive():
+                        raise RuntimeError('DataLoader worker thread exited unexpectedly')
+                    continue
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            producer.join()
+
+    def __iter__(self):
+        """
+        Iterates over the dataset once, yielding (X, y) tuples (see iter_with_ids)
+        """
+        for ids, features, labels in self.iter_with_ids():
+            yield features, labels
@@ -0,0 +1,164 @@
+"""
+Provides the dependency handling of extract_features: extractors declare the features they need with the requires
+decorator, the extractors of a run are ordered by their dependencies (a DAG, checked for missing features and cycles)
+and all of them are computed in a single pass over the data points, one task per data point (in which the file can be
+decoded once by a shared loader, whose result is passed to all extractors).
+"""
+__author__ = 'George Oblapenko'
+__license__ = "GPL"
+__maintainer__ = "George Oblapenko"
+__email__ = "kunstmord@kunstmord.com"
+
+from time import time
+import errors
+
+
+def requires(*names):
+    """
+    Decorator which declares the features an extractor depends on; such an extractor is called with the path of a
+    data point and a dictionary containing only these features (followed by add_args, if any)
+
+    Parameters
+    ----------
+    names : strings, names of the features the extractor needs
+
+    Returns
+    -------
+    A decorator which sets the 'requires' attribute of the extractor
+    """
+    def decorator(extractor):
+        extractor.requires = tuple(names)
+        return extractor
+    return decorator
+
+
+def build_plan(extractors, stored_names):
+    """
+    Orders extractors so that every feature is computed after the features it depends on
+
+    Parameters
+    ----------
+    extractors : list of extractor functions or of (name, extractor) tuples (the name of a feature is the name of its
+    extractor, unless given explicitly)
+    stored_names : collection of strings, names of the features stored in the database
+
+    Returns
+    -------
+    plan : list of (name, extractor, requires) tuples in the order of computation, requires is None for extractors
+    which don't depend on other features
+    stages : list of lists of names, features in the same stage don't depend on each other, a stage only depends on
+    previous stages
+    """
+    nodes = {}
+    order = []
+    for item in extractors:
+        if isinstance(item, tuple):
+            name, extractor = item
+        else:
+            name, extractor = item.__name__, item
+        if name in nodes:
+            raise errors.DependencyError(name, 'is computed by more than one extractor')
+        nodes[name] = (extractor, getattr(extractor, 'requires', None))
+        order.append(name)
+
+    depth = {}
+    for name in order:
+        for needed in nodes[name][1] or ():
+            if needed not in nodes and needed not in stored_names:
+                raise errors.DependencyError(name, 'requires ' + str(needed) + ', which is neither stored nor computed')
+
+    def visit(name, path):
+        if name in depth:
+            return depth[name]
+        if name in path:
+            raise errors.DependencyError(name, 'is part of a dependency cycle: ' + ' -> '.join(path + [name]))
+        level = 0
+        for needed in nodes[name][1] or ():
+            if needed in nodes:
+                level = max(level, visit(needed, path + [name]) + 1)
+        depth[name] = level
+        return level
+
+    for name in order:
+        visit(name, [])
+    stages = [[] for level in xrange(max(depth.values()) + 1)] if len(depth) > 0 else []
+    for name in order:
+        stages[depth[name]].append(name)
+    plan = [(name, nodes[name][0], nodes[name][1]) for stage in stages for name in stage]
+    return plan, stages
+
+
+def input_names(plan):
+    """
+    Returns the names of the features the extractors of a plan need as inputs
+    """
+    names = set()
+    for name, extractor, needed in plan:
+        names.update(needed or ())
+    return names
+
+
+def run_row(plan, path, stored, missing, add_args=None, loader=None, timings=None):
+    """
+    Computes the missing features of a single data point (module-level, so that it can be sent to worker processes)
+
+    Parameters
+    ----------
+    plan : list of (name, extractor, requires) tuples, see build_plan
+    path : string, path to the file of the data point
+    stored : dict, stored features of the data point which are needed as inputs
+    missing : collection of strings, names of the features which are to be computed
+    add_args : optional arguments for the extractors. default value: None
+    loader : function or None, if not None, it is called once with the path of the file and its result (for example,
+    a decoded image) is passed to the extractors instead of the path. default value: None
+    timings : list or None, if not None, a (name, stage, seconds) tuple is appended to it for the loader (stage
+    'file io') and for each extractor (stage 'extractor'). default value: None
+
+    Returns
+    -------
+    values : dict mapping the names of the computed features to their values
+    """
+    if loader is None:
+        data = path
+    else:
+        start = time()
+        data = loader(path)
+        if timings is not None:
+            timings.append((getattr(loader, '__name__', 'loader'), 'file io', time() - start))
+    values = {}
+    for name, extractor, needed in plan:
+        if name not in missing:
+            continue
+        if needed is None:
+            args = (data,)
+        else:
+            inputs = {}
+            for input_name in needed:
+                if input_name in values:
+                    inputs[input_name] = values[input_name]
+                elif input_name in stored:
+                    inputs[input_name] = stored[input_name]
+                else:
+                    raise errors.InsufficientData(input_name, 'feature', path)
+            args = (data, inputs)
+        if add_args is not None:
+            args += (add_args,)
+        start = time()
+        values[name] = extractor(*args)
+        if timings is not None:
+            timings.append((name, 'extractor', time() - start))
+    return values
+
+
+def run_row_timed(plan, path, stored, missing, add_args=None, loader=None):
+    """
+    Same as run_row, but also returns the time spent in the loader and in each extractor
+
+    Returns
+    -------
+    values : dict mapping the names of the computed features to their values
+    timings : list of (name, stage, seconds) tuples, see run_row
+    """
+    timings = []
+    values = run_row(plan, path, stored, missing, add_args, loader, timings)
+    return values, timings
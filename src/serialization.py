@@ -0,0 +1,127 @@
+"""
+Provides the codecs which can be applied to the BLOBs in which array and object features are stored (see
+featurestore): 'raw' stores the bytes as they are, 'zlib' compresses them and 'lz4' (only available if the lz4 package
+is installed) compresses them faster, at a lower ratio. The codec of a feature is chosen when the feature is created
+and kept in the 'feature info' table; other codecs can be added with register_codec.
+"""
+__author__ = 'George Oblapenko'
+__license__ = "GPL"
+__maintainer__ = "George Oblapenko"
+__email__ = "kunstmord@kunstmord.com"
+
+import zlib
+import errors
+
+try:
+    import lz4.block as lz4_block
+except ImportError:
+    lz4_block = None
+
+_codecs = {}
+
+
+class Codec:
+    """
+    A codec which stores the bytes as they are, other codecs should override name, encode and decode
+    """
+    name = 'raw'
+
+    def encode(self, data):
+        """
+        Converts bytes (a string or a buffer) into the form in which they are stored
+        """
+        return data
+
+    def decode(self, data):
+        """
+        Converts stored bytes back into the original ones
+        """
+        return data
+
+
+class ZlibCodec(Codec):
+    """
+    A codec which compresses the bytes with zlib
+
+    Initialization parameters
+    ----------
+    level : int, compression level (1 is the fastest, 9 gives the smallest output). default value: 6
+    """
+    name = 'zlib'
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def encode(self, data):
+        return zlib.compress(data, self.level)
+
+    def decode(self, data):
+        return zlib.decompress(data)
+
+
+class Lz4Codec(Codec):
+    """
+    A codec which compresses the bytes with LZ4 (requires the lz4 package)
+    """
+    name = 'lz4'
+
+    def encode(self, data):
+        return lz4_block.compress(bytes(data))
+
+    def decode(self, data):
+        return lz4_block.decompress(bytes(data))
+
+
+def register_codec(codec):
+    """
+    Makes a codec available to features (under its name)
+
+    Parameters
+    ----------
+    codec : object with a name attribute and encode(data) and decode(data) methods (see Codec)
+
+    Returns
+    -------
+    None
+    """
+    _codecs[codec.name] = codec
+    return None
+
+
+def get_codec(name):
+    """
+    Returns a registered codec
+
+    Parameters
+    ----------
+    name : string, name of the codec, if None, the 'raw' codec is returned
+
+    Returns
+    -------
+    codec : Codec object
+    """
+    if name is None:
+        name = 'raw'
+    if name not in _codecs:
+        raise errors.InsufficientData(name, 'codec')
+    return _codecs[name]
+
+
+def available_codecs():
+    """
+    Returns the names of the registered codecs
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    names : list of strings
+    """
+    return sorted(_codecs)
+
+
+register_codec(Codec())
+register_codec(ZlibCodec())
+if lz4_block is not None:
+    register_codec(Lz4Codec())
@@ -0,0 +1,516 @@
+"""
+Provides ShardedDataSet, which splits one logical dataset across several SQLite files (shards). The data point files
+are hash-partitioned by name (see dataset.shard_of), so each shard is an ordinary database of an UnlabeledDataSet or a
+LabeledDataSet which holds a part of the files and can be copied or opened on its own. Extraction runs one worker
+process per shard (so the shards are written in parallel) and reads are done in parallel threads, one per shard, and
+concatenated. Data points are ordered shard by shard (and by id within a shard): the global id of the i-th data point
+of shard k is the amount of data points in shards 0..k-1 plus i.
+"""
+__author__ = 'George Oblapenko'
+__license__ = "GPL"
+__maintainer__ = "George Oblapenko"
+__email__ = "kunstmord@kunstmord.com"
+
+from os.path import splitext
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import errors
+import dataset
+
+
+def shard_name(custom_name, index):
+    """
+    Returns the name of the database file of a shard: 'train.db' becomes 'train-0.db', 'train-1.db', etc.
+    """
+    base, extension = splitext(custom_name)
+    return base + '-' + str(index) + extension
+
+
+def _open_shard(spec):
+    """
+    Creates the dataset object of a shard from its (class, args, kwargs, shard) specification
+    """
+    data_set_class, args, kwargs, shard = spec
+    data_set = data_set_class(*args, **kwargs)
+    data_set.shard = shard
+    return data_set
+
+
+def _shard_worker(task):
+    """
+    Opens a shard and calls one of its methods (module-level, so that it can be sent to worker processes)
+
+    Parameters
+    ----------
+    task : tuple, (spec, method name, args, kwargs), see _open_shard
+
+    Returns
+    -------
+    The value returned by the method
+    """
+    spec, method, args, kwargs = task
+    data_set = _open_shard(spec)
+    try:
+        return getattr(data_set, method)(*args, **kwargs)
+    finally:
+        data_set.close()
+
+
+def _dump_shard(data_set, part, feature_name, force_extraction, codec):
+    """
+    Dumps the part of a feature which belongs to a shard (see ShardedDataSet.dump_feature), shards without data points
+    are skipped
+    """
+    if data_set.points_amt == 0:
+        return None
+    data_set.dump_feature(feature_name, part, force_extraction, codec)
+    return None
+
+
+class ShardedDataSet:
+    """
+    A dataset split across several SQLite files (see the module docstring), with the methods of a dataset which work
+    on all data points: prepopulate, sync, the extraction methods, return_features(_numpy), return_labels_numpy,
+    iter_batches, return_real_id, get_(many_)by_real_id, return_multiple_convert_numpy, iter_convert_numpy,
+    copy_features, dump_feature and delete_feature (ids passed to and returned by them are global ids). Methods which
+    work on the database of a single dataset are not supported: return_feature_matrix, the return_single_* methods,
+    return_id_mapping, return_real_id_numpy, return_ids_numpy, return_paths and clear_cache (use the dataset objects in
+    the shards attribute, locate finds the shard and the id of a data point in it); a DataLoader can be created for a
+    single shard.
+
+    Initialization parameters
+    ----------
+    data_set_class : UnlabeledDataSet or LabeledDataSet, class of the shards
+    shards_amt : int, amount of shards (it should not be changed after the shards are prepopulated, since the files are
+    assigned to shards by their names)
+    path_to_set : string, path to the folder containing the data point files
+    path_to_db : string, path to the folder where the SQLite databases are stored
+    args : other positional parameters of data_set_class (for example, path_to_labels for a LabeledDataSet)
+    custom_name : string, name from which the names of the database files are made (see shard_name), if None, the
+    default name of data_set_class is used ('test.db' or 'train.db'). default value: None
+    n_jobs : int, maximal amount of shards processed at the same time (by worker processes for extraction, by threads
+    for the other operations), if None, all shards are processed at the same time. default value: None
+    kwargs : other keyword parameters of data_set_class (for example, file_suffix)
+    """
+    def __init__(self, data_set_class, shards_amt, path_to_set, path_to_db, *args, **kwargs):
+        custom_name = kwargs.pop('custom_name', None)
+        self.n_jobs = kwargs.pop('n_jobs', None)
+        if custom_name is None:
+            if issubclass(data_set_class, dataset.LabeledDataSet):
+                custom_name = 'train.db'
+            else:
+                custom_name = 'test.db'
+        self.shards_amt = shards_amt
+        self._specs = []
+        for index in xrange(shards_amt):
+            shard_kwargs = dict(kwargs)
+            shard_kwargs['custom_name'] = shard_name(custom_name, index)
+            self._specs.append((data_set_class, (path_to_set, path_to_db) + args, shard_kwargs,
+                                (index, shards_amt)))
+        self.shards = [_open_shard(spec) for spec in self._specs]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        """
+        Closes the pooled connections to the databases of all shards
+        """
+        for data_set in self.shards:
+            data_set.close()
+        return None
+
+    @property
+    def points_amt(self):
+        """
+        Amount of data points in all shards
+        """
+        return sum(data_set.points_amt for data_set in self.shards)
+
+    def _pool_size(self):
+        if self.n_jobs is None or self.n_jobs == -1:
+            return self.shards_amt
+        return min(self.n_jobs, self.shards_amt)
+
+    def _map_threads(self, function, items=None):
+        """
+        Calls function(data_set) (or function(data_set, item), item being the element of items for that shard) for
+        every shard in a pool of threads, returns the results in the order of the shards
+        """
+        if items is None:
+            tasks = [(data_set,) for data_set in self.shards]
+        else:
+            tasks = zip(self.shards, items)
+        pool = ThreadPool(self._pool_size())
+        try:
+            return pool.map(lambda task: function(*task), tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _map_processes(self, method, *args, **kwargs):
+        """
+        Calls a method of every shard in a pool of worker processes (the shards are reopened in the workers, so the
+        arguments must be picklable), returns the results in the order of the shards
+        """
+        tasks = [(spec, method, args, kwargs) for spec in self._specs]
+        pool = Pool(self._pool_size())
+        try:
+            results = pool.map(_shard_worker, tasks, 1)
+        finally:
+            pool.close()
+            pool.join()
+        for data_set in self.shards:
+            data_set.points_amt = dataset.return_points_amt_base(data_set.dbpath, data_set._set_object)
+        return results
+
+    def offsets(self):
+        """
+        Returns the global id of the first data point of each shard minus one (see the module docstring)
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        offsets : list of ints, one per shard
+        """
+        offsets = []
+        total = 0
+        for data_set in self.shards:
+            offsets.append(total)
+            total += data_set.points_amt
+        return offsets
+
+    def _global_ids(self, data_set, offset, object_ids):
+        """
+        Converts ids of data points in a shard (with the given offset, see offsets) into global ids
+        """
+        return offset + np.searchsorted(data_set.return_id_mapping()[0], object_ids) + 1
+
+    def _split_range(self, start_id, end_id):
+        """
+        Returns a (data_set, offset, object ids) tuple for every shard which has data points with global ids in the
+        range (start_id, end_id), if end_id is equal to -1, the range ends with the last data point
+        """
+        if end_id == -1:
+            end_id = self.points_amt
+        parts = []
+        for data_set, offset in zip(self.shards, self.offsets()):
+            lower = max(start_id - offset, 1)
+            upper = min(end_id - offset, data_set.points_amt)
+            if lower <= upper:
+                parts.append((data_set, offset, data_set.return_id_mapping()[0][lower - 1:upper]))
+        return parts
+
+    def locate(self, global_id):
+        """
+        Finds the shard of a data point specified by its global id
+
+        Parameters
+        ----------
+        global_id : int
+
+        Returns
+        -------
+        data_set : the dataset object of the shard
+        object_id : int, id of the data point in the shard
+        """
+        for data_set, offset in zip(self.shards, self.offsets()):
+            if offset < global_id <= offset + data_set.points_amt:
+                # the ids of a shard have gaps where data points were flagged as deleted by sync
+                return data_set, int(data_set.return_id_mapping()[0][global_id - offset - 1])
+        raise errors.InsufficientData(str(global_id), 'data point id')
+
+    def prepopulate(self):
+        """
+        Creates (or opens) the databases of all shards, each holding the files of its shard (in parallel threads)
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        None
+        """
+        self._map_threads(lambda data_set: data_set.prepopulate())
+        return None
+
+    def sync(self):
+        """
+        Brings the databases of all shards up to date with the folder (see DataSetBase.sync)
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        A dict with the amount of 'added', 'deleted' and 'changed' data points in all shards
+        """
+        result = {'added': 0, 'deleted': 0, 'changed': 0}
+        for shard_result in self._map_threads(lambda data_set: data_set.sync()):
+            for key in result:
+                result[key] += shard_result[key]
+        return result
+
+    def extract_feature(self, extractor, force_extraction=False, verbose=0, add_args=None, custom_name=None,
+                        batch_size=1000, codec=None):
+        """
+        Extracts a feature in all shards, one worker process per shard (the extractor and add_args must be picklable),
+        see DataSetBase.extract_feature for the parameters
+
+        Returns
+        -------
+        None
+        """
+        self._map_processes('extract_feature', extractor, force_extraction, verbose, add_args, custom_name,
+                            batch_size=batch_size, codec=codec)
+        return None
+
+    def extract_feature_dependent_feature(self, extractor, force_extraction=False, verbose=0, add_args=None,
+                                          custom_name=None, batch_size=1000, codec=None):
+        """
+        Extracts a feature which may be dependent on other features in all shards, one worker process per shard, see
+        DataSetBase.extract_feature_dependent_feature for the parameters
+
+        Returns
+        -------
+        None
+        """
+        self._map_processes('extract_feature_dependent_feature', extractor, force_extraction, verbose, add_args,
+                            custom_name, batch_size=batch_size, codec=codec)
+        return None
+
+    def extract_features(self, extractors, force_extraction=False, verbose=0, add_args=None, batch_size=1000,
+                         codec=None, loader=None):
+        """
+        Extracts several features in a single pass in all shards, one worker process per shard, see
+        DataSetBase.extract_features for the parameters
+
+        Returns
+        -------
+        stages : list of lists of feature names (see scheduler.build_plan)
+        """
+        return self._map_processes('extract_features', extractors, force_extraction, verbose, add_args,
+                                   batch_size=batch_size, codec=codec, loader=loader)[0]
+
+    def extract_feature_batched(self, extractor, loader, force_extraction=False, verbose=0, add_args=None,
+                                custom_name=None, batch_size=256, codec=None):
+        """
+        Extracts a feature with a batch extractor in all shards, one worker process per shard (the extractor, the
+        loader and add_args must be picklable), see DataSetBase.extract_feature_batched for the parameters
+
+        Returns
+        -------
+        None
+        """
+        self._map_processes('extract_feature_batched', extractor, loader, force_extraction, verbose, add_args,
+                            custom_name, batch_size=batch_size, codec=codec)
+        return None
+
+    def return_feature_list(self):
+        """
+        Returns the names of the features stored in any of the shards (in the order of the first shard which has them)
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        A list of strings
+        """
+        names = []
+        for data_set in self.shards:
+            names.extend(name for name in data_set.return_feature_list() if name not in names)
+        return names
+
+    def return_features(self, names='all'):
+        """
+        Returns a list of features of all data points, in the order of global ids, see DataSetBase.return_features
+
+        Parameters
+        ----------
+        names : list of strings, names of the features, if equal to 'all', all features are returned (every shard
+        must have the same features). default value: 'all'
+
+        Returns
+        -------
+        A list of lists, one per data point
+        """
+        features = []
+        for part in self._map_threads(lambda data_set: data_set.return_features(names)):
+            features.extend(part)
+        return features
+
+    def return_features_numpy(self, names='all'):
+        """
+        Returns a 2d numpy array of features of all data points (the shards are read in parallel threads and
+        concatenated in the order of global ids), see DataSetBase.return_features_numpy
+
+        Parameters
+        ----------
+        names : list of strings, names of the features, if equal to 'all', all features are returned (every shard
+        must have the same features). default value: 'all'
+
+        Returns
+        -------
+        A 2d numpy array of features, one row per data point
+        """
+        parts = self._map_threads(lambda data_set: data_set.return_features_numpy(names))
+        return np.concatenate([part for part in parts if len(part) > 0] or parts[:1])
+
+    def return_labels_numpy(self, original=False):
+        """
+        Returns a 2d numpy array of the labels of all data points (only for shards of a LabeledDataSet), in the order
+        of global ids, see LabeledDataSet.return_labels_numpy
+
+        Parameters
+        ----------
+        original : if True, will return original labels, if False, will return transformed labels. default value: False
+
+        Returns
+        -------
+        A 2d numpy array of labels, one row per data point
+        """
+        parts = self._map_threads(lambda data_set: data_set.return_labels_numpy(original))
+        return np.concatenate([part for part in parts if len(part) > 0] or parts[:1])
+
+    def iter_batches(self, names='all', batch_size=1000, with_labels=True, original=False):
+        """
+        Iterates over the features (and the labels, for shards of a LabeledDataSet) in chunks of consecutive data
+        points, shard by shard (a chunk doesn't span two shards, so the last chunk of a shard can be smaller than
+        batch_size), see DataSetBase.iter_batches and LabeledDataSet.iter_batches
+
+        Parameters
+        ----------
+        names : list of strings, names of the features, if equal to 'all', all features are returned.
+        default value: 'all'
+        batch_size : int, maximal amount of data points in a chunk. default value: 1000
+        with_labels : boolean, if False, the labels are not read and y_chunk is None. default value: True
+        original : if True, original labels are returned, ignored for shards of an UnlabeledDataSet.
+        default value: False
+
+        Returns
+        -------
+        A generator of (ids, X_chunk, y_chunk) tuples, ids are global ids
+        """
+        for data_set, offset in zip(self.shards, self.offsets()):
+            if isinstance(data_set, dataset.LabeledDataSet):
+                batches = data_set.iter_batches(names, batch_size, with_labels, original)
+            else:
+                batches = data_set.iter_batches(names, batch_size, with_labels)
+            for ids, features, labels in batches:
+                yield self._global_ids(data_set, offset, ids), features, labels
+
+    def return_real_id(self):
+        """
+        Returns a list of the real_id's of all data points, in the order of global ids
+        """
+        real_ids = []
+        for data_set in self.shards:
+            real_ids.extend(data_set.return_real_id())
+        return real_ids
+
+    def get_by_real_id(self, real_id):
+        """
+        Returns a data point specified by its real_id, see get_many_by_real_id
+        """
+        return self.get_many_by_real_id([real_id])[0]
+
+    def get_many_by_real_id(self, real_ids):
+        """
+        Returns several data points specified by their real_id's (every shard is searched, in parallel threads), see
+        DataSetBase.get_many_by_real_id; if several data points have the same real_id, the one with the smallest
+        global id is returned
+
+        Parameters
+        ----------
+        real_ids : list of strings (or numbers, which are converted to strings)
+
+        Returns
+        -------
+        points : list of dicts (None for real_id's which are not in any shard), one per real_id, their 'id' is the
+        global id
+        """
+        real_ids = list(real_ids)
+        points = [None] * len(real_ids)
+        found = self._map_threads(lambda data_set: data_set.get_many_by_real_id(real_ids))
+        for data_set, offset, shard_points in zip(self.shards, self.offsets(), found):
+            for a, point in enumerate(shard_points):
+                if points[a] is None and point is not None:
+                    point['id'] = int(self._global_ids(data_set, offset, [point['id']])[0])
+                    points[a] = point
+        return points
+
+    def iter_convert_numpy(self, start_id, end_id, converter, add_args=None, batch_size=1000, n_jobs=1, pool=None,
+                           backend='thread', prefetch=64):
+        """
+        Converts the objects with global ids in the range (start_id, end_id), shard by shard, and yields the results
+        in chunks (a chunk doesn't span two shards), see DataSetBase.iter_convert_numpy for the parameters
+
+        Returns
+        -------
+        A generator of (ids, result) tuples, ids are global ids
+        """
+        for data_set, offset, object_ids in self._split_range(start_id, end_id):
+            for ids, result in data_set.iter_convert_numpy(1, -1, converter, add_args, batch_size, n_jobs, pool,
+                                                           backend, prefetch, object_ids=object_ids):
+                yield self._global_ids(data_set, offset, ids), result
+
+    def return_multiple_convert_numpy(self, start_id, end_id, converter, add_args=None, n_jobs=1, pool=None,
+                                      backend='thread', prefetch=64):
+        """
+        Converts the objects with global ids in the range (start_id, end_id) into a 2d numpy array, see
+        DataSetBase.return_multiple_convert_numpy for the parameters
+
+        Returns
+        -------
+        result : 2-dimensional ndarray
+        """
+        parts = [result for ids, result in self.iter_convert_numpy(start_id, end_id, converter, add_args, 1000,
+                                                                    n_jobs, pool, backend, prefetch)]
+        if len(parts) == 0:
+            return np.zeros([0, 0])
+        return np.concatenate(parts)
+
+    def copy_features(self, dbpath_origin, force_copy=False, names='all'):
+        """
+        Copies features from a database into all shards (each shard gets the values of its own data points, matched
+        by real_id), see DataSetBase.copy_features
+
+        Returns
+        -------
+        None
+        """
+        self._map_threads(lambda data_set: data_set.copy_features(dbpath_origin, force_copy, names))
+        return None
+
+    def dump_feature(self, feature_name, feature, force_extraction=True, codec=None):
+        """
+        Dumps a feature into all shards, see DataSetBase.dump_feature: a list or an ndarray is split by global id, a
+        mapping keyed by real_id is passed to every shard (which only stores the values of its own data points)
+
+        Returns
+        -------
+        None
+        """
+        if isinstance(feature, (list, tuple, np.ndarray)):
+            parts = [feature[offset:offset + data_set.points_amt]
+                     for data_set, offset in zip(self.shards, self.offsets())]
+        else:
+            parts = [feature] * self.shards_amt
+        self._map_threads(lambda data_set, part: _dump_shard(data_set, part, feature_name, force_extraction, codec),
+                          parts)
+        return None
+
+    def delete_feature(self, feature_name):
+        """
+        Deletes a feature from all shards
+        """
+        self._map_threads(lambda data_set: data_set.delete_feature(feature_name))
+        return None
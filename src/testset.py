@@ -7,7 +7,7 @@ __maintainer__ = "George Oblapenko"
 __email__ = "kunstmord@kunstmord.com"
 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, String, PickleType, Integer, MetaData
+from sqlalchemy import Column, String, PickleType, Integer, Float, Boolean, MetaData
 from misc import MutableDict
 
 Base = declarative_base()
@@ -20,6 +20,14 @@ class TestSet(Base):
     """
     __tablename__ = 'test set'
     id = Column(Integer, primary_key=True)
-    real_id = Column(String(60))
-    path = Column(String(120))
+    # real_id is indexed (and path is unique) so that data points can be looked up by them without a table scan
+    real_id = Column(String(60), index=True)
+    path = Column(String(120), index=True, unique=True)
+    # modification time and size of the file when it was last scanned, used by sync() to detect changed files
+    mtime = Column(Float)
+    size = Column(Integer)
+    # True if the file was not found by the last sync()
+    deleted = Column(Boolean, default=False)
+    # features are stored in per-feature tables (see featurestore), this column is only read when migrating
+    # databases created by older versions
     features = Column(MutableDict.as_mutable(PickleType))
\ No newline at end of file